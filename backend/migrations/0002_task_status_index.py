@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('node', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='taskapp2',
+            name='status',
+            field=models.CharField(db_index=True, max_length=50),
+        ),
+        migrations.AddField(
+            model_name='templateapp2',
+            name='status',
+            field=models.CharField(db_index=True, default='done', max_length=50),
+        ),
+    ]
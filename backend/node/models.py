@@ -5,7 +5,7 @@ class taskApp2(models.Model):
         db_table = 'taskApp2'
 
     task_id = models.CharField(max_length=500, unique=True)
-    status = models.CharField(max_length=50)
+    status = models.CharField(max_length=50, db_index=True)
     server = models.CharField(max_length=100)
     template_id = models.IntegerField()
     decoded_image = models.CharField(max_length=500, default=None)
@@ -27,6 +27,7 @@ class templateApp2(models.Model):
         db_table = 'templateApp2'
 
     sort_id = models.IntegerField()
+    status = models.CharField(max_length=50, default='done', db_index=True)
     source = models.CharField(max_length=500, default=None)
     thumb = models.CharField(max_length=500, null=True, blank=True)
     preview_source = models.CharField(max_length=500, null=True, blank=True)
@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
 from pathlib import Path
+import json
 import os
 from utilities import utils
 
@@ -108,6 +109,12 @@ USE_TZ = True
 
 DATA_PATH = os.environ.get('data_path', './')
 
+# onnxruntime options of the face detector of check_images_for_state, the keys of utilities/onnx_session.create_session_options
+FACE_DETECTOR_SESSION_OPTIONS = json.loads(os.environ.get('face_detector_session_options', '{}'))
+
+# Seconds a queue status page is served from memory, dashboards poll it
+QUEUE_STATUS_CACHE_TTL = float(os.environ.get('queue_status_cache_ttl', 2))
+
 PATHS_CONFIG = utils.load_config(os.path.join(DATA_PATH, 'data/config/paths.cnf'), 
                                  [
                                      'mysql',
@@ -7,10 +7,11 @@ import asyncio
 import shutil
 import io
 import re
+import threading
 import numpy as np
 import cv2 as cv
 from PIL import Image
-from utilities import utils
+from utilities import utils, onnx_session
 from node import settings
 from rest_framework.decorators import api_view
 from rest_framework import response, status
@@ -22,6 +23,31 @@ from .serializer import facetemplateApp2Serializer, templateApp2Serializer, task
 TASK_MANAGER = TaskManager(settings.REBBIT)
 CDN_TEMPLATE_UPLOAD = CDN(settings.CDN_TEMPLATE_UPLOAD_PATH)
 
+FACE_DETECTOR = None
+FACE_DETECTOR_LOCK = threading.Lock()
+# (queue, page, page_size) -> (time.monotonic() of the query, queue status)
+QUEUE_STATUS_CACHE = {}
+QUEUE_STATUS_CACHE_LOCK = threading.Lock()
+QUEUE_STATUS_PAGE_SIZE = 50
+QUEUE_STATUS_MAX_PAGE_SIZE = 500
+
+
+def get_face_detector():
+    """
+    Detection model of buffalo_l (the check-faces profile of the swap service) with the
+    session options of the settings, loaded once and shared by the requests that only need to count faces.
+    """
+    global FACE_DETECTOR
+
+    with FACE_DETECTOR_LOCK:
+        if FACE_DETECTOR is None:
+            model_dir = insightface.utils.ensure_available('models', 'buffalo_l', root='~/.insightface')
+            FACE_DETECTOR = onnx_session.load_model(os.path.join(model_dir, 'det_10g.onnx'),
+                                                    settings.FACE_DETECTOR_SESSION_OPTIONS,
+                                                    cache_directory_path=os.path.join(model_dir, 'optimized'))
+            FACE_DETECTOR.prepare(ctx_id=0, input_size=(640, 640))
+    return FACE_DETECTOR
+
 
 async def write_files(data, decode_img_path):
         base64_png = "iVBORw0KGg"
@@ -176,61 +202,85 @@ async def post_face_swap(request):
             status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
-@api_view(['GET'])
-def get_queue_swapface_status(request):
+def get_queue_status(request, queue_name, get_queue_depth, queued_tasks, serialize_task):
+    """
+    Depth of a task queue from the broker and a page of its queued tasks from their status in the DB,
+    neither touches the tasks in the queue. A page is served from memory for
+    settings.QUEUE_STATUS_CACHE_TTL seconds so dashboards polling it don't load the broker.
+    """
+    try:
+        page = int(request.GET.get('page', 1))
+        page_size = int(request.GET.get('page_size', QUEUE_STATUS_PAGE_SIZE))
+    except ValueError:
+        return response.Response({'error': "page and page_size must be integers"}, status=status.HTTP_400_BAD_REQUEST)
+    if page < 1 or not 0 < page_size <= QUEUE_STATUS_MAX_PAGE_SIZE:
+        return response.Response({'error': f"page must be positive and page_size between 1 and {QUEUE_STATUS_MAX_PAGE_SIZE}"},
+                                 status=status.HTTP_400_BAD_REQUEST)
+
+    key = (queue_name, page, page_size)
+    now = time.monotonic()
+    with QUEUE_STATUS_CACHE_LOCK:
+        cached = QUEUE_STATUS_CACHE.get(key)
+    if cached and now - cached[0] < settings.QUEUE_STATUS_CACHE_TTL:
+        return response.Response(cached[1], status=status.HTTP_200_OK)
 
-    # Try to find a queue with the given request_id
     try:
-        tasks_data = TASK_MANAGER.get_queue_tasks_1() 
-        print(tasks_data)
+        message_count = get_queue_depth()
     except Exception as e:
         # Can't connect to the rebbit
-        return response.Response({'error': f"Unexpected error during get queue status: {str(e)}"}, 
+        return response.Response({'error': f"Unexpected error during get queue status: {str(e)}"},
                                  status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    if len(tasks_data) == 0:
-        return response.Response({"message_count":0, "messages":[]}, status=status.HTTP_200_OK)
-    else:
-        messages = []
-        for task in tasks_data:
-            messages.append({
-                "request_id": task['task_id'],
-                "input": {
-                    "template_id": task["template_id"],
-                    "decoded_image": task["decoded_image"],
-                    "watermark": task["watermark"],
-                    "new": task["new"],
-                    "is_image": task["is_image"]
-                }
-                })
-        return response.Response({"message_count":len(tasks_data), "messages":messages}, status=status.HTTP_200_OK)
+    offset = (page - 1) * page_size
+    data = {
+        "message_count": message_count,
+        "in_queue": queued_tasks.count(),
+        "page": page,
+        "page_size": page_size,
+        "messages": [serialize_task(task) for task in queued_tasks.order_by('id')[offset:offset + page_size]]
+    }
+
+    with QUEUE_STATUS_CACHE_LOCK:
+        for expired_key in [cached_key for cached_key, (cached_at, _) in QUEUE_STATUS_CACHE.items()
+                            if now - cached_at >= settings.QUEUE_STATUS_CACHE_TTL]:
+            del QUEUE_STATUS_CACHE[expired_key]
+        QUEUE_STATUS_CACHE[key] = (now, data)
+    return response.Response(data, status=status.HTTP_200_OK)
+
+
+def serialize_queued_swap_task(task):
+    return {
+        "request_id": task.task_id,
+        "input": {
+            "template_id": task.template_id,
+            "decoded_image": task.decoded_image,
+            "watermark": task.watermark,
+            "new": task.new,
+            "is_image": task.is_image
+        }
+    }
+
+
+def serialize_queued_template(template):
+    return {
+        "input": {
+            "template_id": template.sort_id,
+            "source": template.source,
+            "premium": template.premium
+        }
+    }
+
 
 @api_view(['GET'])
-def get_queue_getface_status(request):
+def get_queue_swapface_status(request):
+    return get_queue_status(request, 'swapface', TASK_MANAGER.get_queue_depth_1,
+                            taskApp2.objects.filter(status='in_queue'), serialize_queued_swap_task)
 
-    # Try to find a queue with the given request_id
-    try:
-        tasks_data = TASK_MANAGER.get_queue_tasks_2() 
-        print(tasks_data)
-    except Exception as e:
-        # Can't connect to the rebbit
-        return response.Response({'error': f"Unexpected error during get queue status: {str(e)}"}, 
-                                 status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    if len(tasks_data) == 0:
-        return response.Response({"message_count":0, "messages":[]}, status=status.HTTP_200_OK)
-    else:
-        messages = []
-        for task in tasks_data:
-            messages.append({
-                "input": {
-                    "template_id": task["template_id"],
-                    "decoded_image": task["decoded_image"],
-                    "new": task["new"],
-                    "is_image": task["is_image"]
-                }
-                })
-        return response.Response({"message_count":len(tasks_data), "messages":messages}, status=status.HTTP_200_OK)
+@api_view(['GET'])
+def get_queue_getface_status(request):
+    return get_queue_status(request, 'getface', TASK_MANAGER.get_queue_depth_2,
+                            templateApp2.objects.filter(status='in_queue'), serialize_queued_template)
 
 
 @api_view(['GET'])
@@ -388,6 +438,7 @@ def post_template(request):
 
 
         template_model_data.update({'sort_id':sort_id,
+                        'status': 'in_queue',
                         'source':source_cdn_path,
                         'premium': premium})
             
@@ -449,17 +500,16 @@ def post_template(request):
 def check_images_for_state(request):
 
     try:
-        face_analyzer = insightface.app.FaceAnalysis(name='buffalo_l')
-        face_analyzer.prepare(ctx_id=0)
+        face_detector = get_face_detector()
         image = request.data['image']
         decoded_data = base64.b64decode(image)
 
         img = Image.open(io.BytesIO(decoded_data))
         opencv_img= cv.cvtColor(np.array(img), cv.COLOR_BGR2RGB)
 
-        faces = face_analyzer.get(opencv_img)
+        faces, _ = face_detector.detect(opencv_img)
 
-        if faces:
+        if len(faces):
             return response.Response({'faces': len(faces)}, status=status.HTTP_200_OK)
         else:
             return response.Response({'faces': 0}, status=status.HTTP_200_OK)
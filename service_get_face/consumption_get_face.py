@@ -1,6 +1,5 @@
 from utilities import task_manage, db_manage
 from utilities.cdn_manager import CDN
-from faceSwapLib.roop import core
 import shutil
 import os
 from utilities import utils
@@ -39,16 +38,24 @@ class Consumer():
     
 
     def task_get_face(self, task):
-        # Implemented task processing logic
+        # Implemented task processing logic, the swap library is loaded with the first task
+        from faceSwapLib.roop import core
+
         template_id = task["template_id"]
+        # The status of the template is the queue status the backend lists
+        query_status = "UPDATE templateApp2 SET status = %s WHERE sort_id = %s;"
 
         try:
             print(f"Processing task: {task}")
+            self.db.execute_query(query_status, ('in_work', template_id))
 
             faces_dir = f'{FACES_PATH + str(template_id)}'
-            os.mkdir(faces_dir)
+            # A redelivered template finds the folder of its first attempt
+            os.makedirs(faces_dir, exist_ok=True)
             
-            core.get_referance_faces_from_source(task["source"], faces_dir)
+            # Also stores the per-frame face index next to the template for the swap service
+            if not core.get_referance_faces_from_source(task["source"], faces_dir, build_face_index=True):
+                raise RuntimeError(f'can\'t get the faces of template {template_id}')
 
             # Prepare the SQL query with placeholders for values
             query = "INSERT INTO facetemplateApp2 (template_id, source) VALUES (%s, %s)"
@@ -74,8 +81,13 @@ class Consumer():
 
             if os.path.isdir(task["source"]):
                 shutil.rmtree(faces_dir) 
+
+            self.db.execute_query(query_status, ('done', template_id))
         except Exception as e:
             print(f'Error: unexpected error during face getting: {str(e)}')
+            self.db.execute_query(query_status, ('Error', template_id))
+            # The task manager nacks the task, it is retried once and then dead-lettered
+            raise
 
 
     def start_consuming(self):
@@ -0,0 +1,123 @@
+import hashlib
+import os
+from typing import Any, Dict, List, Optional
+
+import onnxruntime
+
+# Entry of the config used by the models without their own one
+DEFAULT_MODEL = 'default'
+GRAPH_OPTIMIZATION_LEVELS = {
+    'disable': onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL,
+    'basic': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+    'extended': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+    'all': onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL,
+}
+EXECUTION_MODES = {
+    'sequential': onnxruntime.ExecutionMode.ORT_SEQUENTIAL,
+    'parallel': onnxruntime.ExecutionMode.ORT_PARALLEL,
+}
+
+
+def get_model_options(session_options: Dict[str, Dict[str, Any]], model: Optional[str]) -> Dict[str, Any]:
+    """Options of the model over the default ones of the config, e.g. {"default": {...}, "swapper": {...}}."""
+    return {**session_options.get(DEFAULT_MODEL, {}), **session_options.get(model, {})}
+
+
+def create_session_options(options: Dict[str, Any]) -> onnxruntime.SessionOptions:
+    """
+    SessionOptions of a model config, what it doesn't set keeps the onnxruntime default.
+
+        options:
+            intra_op_threads (int): Threads inside one operator, 0 uses every core
+            inter_op_threads (int): Threads running operators side by side in the parallel execution mode
+            graph_optimization_level (str): disable, basic, extended or all
+            enable_mem_arena (bool): Keep the CPU memory of the tensors between the runs
+            execution_mode (str): sequential or parallel
+            optimized_model_cache (bool): Save the optimized graph and load it instead of optimizing again
+    """
+    session_options = onnxruntime.SessionOptions()
+    if 'intra_op_threads' in options:
+        session_options.intra_op_num_threads = int(options['intra_op_threads'])
+    if 'inter_op_threads' in options:
+        session_options.inter_op_num_threads = int(options['inter_op_threads'])
+    if 'graph_optimization_level' in options:
+        session_options.graph_optimization_level = GRAPH_OPTIMIZATION_LEVELS[options['graph_optimization_level']]
+    if 'enable_mem_arena' in options:
+        session_options.enable_cpu_mem_arena = bool(options['enable_mem_arena'])
+    if 'execution_mode' in options:
+        session_options.execution_mode = EXECUTION_MODES[options['execution_mode']]
+    return session_options
+
+
+def get_optimized_model_path(model_path: str, cache_directory_path: str, providers: List[str], options: Dict[str, Any]) -> str:
+    """Cache file of the optimized graph, named after everything the optimization depends on."""
+    model_stat = os.stat(model_path)
+    key = '|'.join([os.path.abspath(model_path), str(model_stat.st_size), str(model_stat.st_mtime_ns), onnxruntime.__version__,
+                    ','.join(providers), str(options.get('graph_optimization_level', 'all'))])
+    model_name = os.path.splitext(os.path.basename(model_path))[0]
+    return os.path.join(cache_directory_path, f'{model_name}.{hashlib.md5(key.encode()).hexdigest()[:16]}.onnx')
+
+
+def create_session(model_path: str, options: Dict[str, Any], providers: Optional[List[str]] = None,
+                   cache_directory_path: Optional[str] = None) -> onnxruntime.InferenceSession:
+    """
+    InferenceSession of the model with its options. With optimized_model_cache the first session
+    saves its optimized graph to the cache directory and the next ones load it with the
+    optimizations disabled, so a cold start doesn't optimize the graph again.
+    """
+    providers = providers or onnxruntime.get_available_providers()
+    if not options.get('optimized_model_cache') or cache_directory_path is None:
+        return onnxruntime.InferenceSession(model_path, sess_options=create_session_options(options), providers=providers)
+
+    optimized_model_path = get_optimized_model_path(model_path, cache_directory_path, providers, options)
+    if os.path.isfile(optimized_model_path):
+        session_options = create_session_options(options)
+        session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_DISABLE_ALL
+        try:
+            return onnxruntime.InferenceSession(optimized_model_path, sess_options=session_options, providers=providers)
+        except Exception as e:
+            print(f'Warning: can\'t load {optimized_model_path}, optimizing {model_path} again - {e}')
+
+    os.makedirs(cache_directory_path, exist_ok=True)
+    temp_model_path = f'{optimized_model_path}.{os.getpid()}.tmp'
+    session_options = create_session_options(options)
+    session_options.optimized_model_filepath = temp_model_path
+    try:
+        session = onnxruntime.InferenceSession(model_path, sess_options=session_options, providers=providers)
+    except Exception as e:
+        print(f'Warning: can\'t save the optimized graph of {model_path} - {e}')
+        if os.path.exists(temp_model_path):
+            os.remove(temp_model_path)
+        return onnxruntime.InferenceSession(model_path, sess_options=create_session_options(options), providers=providers)
+    if os.path.exists(temp_model_path):
+        os.replace(temp_model_path, optimized_model_path)
+    return session
+
+
+def load_model(model_path: str, options: Dict[str, Any], providers: Optional[List[str]] = None,
+               cache_directory_path: Optional[str] = None) -> Any:
+    """
+    insightface model of the file on a session with its options, picked like
+    insightface.model_zoo.ModelRouter does. None if the model isn't recognized.
+    The model still parses model_path, the session may run the cached optimized graph.
+    """
+    from insightface.model_zoo.arcface_onnx import ArcFaceONNX
+    from insightface.model_zoo.attribute import Attribute
+    from insightface.model_zoo.inswapper import INSwapper
+    from insightface.model_zoo.landmark import Landmark
+    from insightface.model_zoo.retinaface import RetinaFace
+
+    session = create_session(model_path, options, providers, cache_directory_path)
+    inputs = session.get_inputs()
+    input_shape = inputs[0].shape
+    if len(session.get_outputs()) >= 5:
+        return RetinaFace(model_file=model_path, session=session)
+    if input_shape[2] == 192 and input_shape[3] == 192:
+        return Landmark(model_file=model_path, session=session)
+    if input_shape[2] == 96 and input_shape[3] == 96:
+        return Attribute(model_file=model_path, session=session)
+    if len(inputs) == 2 and input_shape[2] == 128 and input_shape[3] == 128:
+        return INSwapper(model_file=model_path, session=session)
+    if input_shape[2] == input_shape[3] and isinstance(input_shape[2], int) and input_shape[2] >= 112 and input_shape[2] % 16 == 0:
+        return ArcFaceONNX(model_file=model_path, session=session)
+    return None
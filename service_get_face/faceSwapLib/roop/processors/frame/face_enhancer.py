@@ -1,88 +1,158 @@
-from typing import Any, List, Callable
+from typing import Any, List, Callable, Optional
 import cv2
+import os
+import numpy
 import threading
-from gfpgan.utils import GFPGANer
 
-import roop.globals
-import roop.processors.frame.core
-from roop.core import update_status
-from roop.face_analyser import get_many_faces
-from faceSwap_lib.roop.typin import Frame, Face
-from roop.utilities import conditional_download, resolve_relative_path, is_image, is_video
+from faceSwapLib.roop import globals
+from faceSwapLib.roop.processors.frame import core
+from faceSwapLib.roop.core import update_status
+from faceSwapLib.roop.face_analyser import get_many_faces
+from faceSwapLib.roop.typin import Frame, Face
+from faceSwapLib.roop.utilities import conditional_download, is_image, is_video
 
-FACE_ENHANCER = None
 THREAD_SEMAPHORE = threading.Semaphore()
-THREAD_LOCK = threading.Lock()
 NAME = 'ROOP.FACE-ENHANCER'
+FACE_SIZE = 512
+# 5 point FFHQ template of facexlib for 512x512 faces, in the kps order of insightface
+FACE_TEMPLATE = numpy.array([[192.98138, 239.94708], [318.90277, 240.1936], [256.63416, 314.01935],
+                             [201.26117, 371.41043], [313.08905, 371.15118]], dtype=numpy.float32)
+
+
+def get_face_enhancer_config() -> dict:
+    return {'version': '1.4', 'upscale': 1, 'bg_upsampler': None, 'device': get_device(), 'max_batch_size': globals.enhance_batch_size}
 
 
 def get_face_enhancer() -> Any:
-    global FACE_ENHANCER
+    """GFPGAN restorer from the registry of gfpgan.improver, so its eviction and clear_restorer cover it too."""
+    from gfpgan import improver
 
-    with THREAD_LOCK:
-        if FACE_ENHANCER is None:
-            model_path = resolve_relative_path('../models/GFPGANv1.4.pth')
-            # todo: set models path -> https://github.com/TencentARC/GFPGAN/issues/399
-            FACE_ENHANCER = GFPGANer(model_path=model_path, upscale=1, device=get_device())
-    return FACE_ENHANCER
+    return improver.get_restorer(**get_face_enhancer_config())
 
 
 def get_device() -> str:
-    if 'CUDAExecutionProvider' in roop.globals.execution_providers:
+    if 'CUDAExecutionProvider' in globals.execution_providers:
         return 'cuda'
-    if 'CoreMLExecutionProvider' in roop.globals.execution_providers:
+    if 'CoreMLExecutionProvider' in globals.execution_providers:
         return 'mps'
     return 'cpu'
 
 
 def clear_face_enhancer() -> None:
-    global FACE_ENHANCER
+    from gfpgan import improver
 
-    FACE_ENHANCER = None
+    improver.evict_restorer(**get_face_enhancer_config())
 
 
 def pre_check() -> bool:
-    download_directory_path = resolve_relative_path('../models')
-    conditional_download(download_directory_path, ['https://github.com/TencentARC/GFPGAN/releases/download/v1.3.4/GFPGANv1.4.pth'])
+    from gfpgan import improver
+
+    # where the improver looks for the weights before downloading them itself
+    _, _, _, url = improver.get_model_config(get_face_enhancer_config()['version'])
+    conditional_download(os.path.join(improver.ROOT_DIR, 'GFPGAN/weights'), [url])
     return True
 
 
 def pre_start() -> bool:
-    if not is_image(roop.globals.target_path) and not is_video(roop.globals.target_path):
+    if not is_image(globals.target_path) and not is_video(globals.target_path):
         update_status('Select an image or video for target path.', NAME)
         return False
     return True
 
 
+def pre_start_for_multiple() -> bool:
+    return pre_start()
+
+
+def warm_up() -> None:
+    get_face_enhancer()
+
+
 def post_process() -> None:
-    clear_face_enhancer()
-
-
-def enhance_face(target_face: Face, temp_frame: Frame) -> Frame:
-    start_x, start_y, end_x, end_y = map(int, target_face['bbox'])
-    padding_x = int((end_x - start_x) * 0.5)
-    padding_y = int((end_y - start_y) * 0.5)
-    start_x = max(0, start_x - padding_x)
-    start_y = max(0, start_y - padding_y)
-    end_x = max(0, end_x + padding_x)
-    end_y = max(0, end_y + padding_y)
-    temp_face = temp_frame[start_y:end_y, start_x:end_x]
-    if temp_face.size:
-        with THREAD_SEMAPHORE:
-            _, _, temp_face = get_face_enhancer().enhance(
-                temp_face,
-                paste_back=True
-            )
-        temp_frame[start_y:end_y, start_x:end_x] = temp_face
-    return temp_frame
+    if not globals.keep_models_loaded:
+        clear_face_enhancer()
+
+
+def align_face(temp_frame: Frame, target_face: Face) -> tuple[Frame, numpy.ndarray]:
+    """512x512 crop of the face aligned to the FFHQ template, like facexlib does for GFPGAN."""
+    affine_matrix = cv2.estimateAffinePartial2D(target_face.kps.astype(numpy.float32), FACE_TEMPLATE, method=cv2.LMEDS)[0]
+    cropped_face = cv2.warpAffine(temp_frame, affine_matrix, (FACE_SIZE, FACE_SIZE), borderMode=cv2.BORDER_CONSTANT, borderValue=(135, 133, 132))
+    return cropped_face, affine_matrix
+
+
+def restore_faces(cropped_faces: List[Frame]) -> List[Frame]:
+    """Restore aligned 512x512 BGR faces in GFPGAN batches, one batch on the device at a time."""
+    with THREAD_SEMAPHORE:
+        return get_face_enhancer().restore_faces(cropped_faces)
+
+
+def paste_back(temp_frame: Frame, restored_face: Frame, affine_matrix: numpy.ndarray) -> None:
+    """Blend a restored face into temp_frame in place, with the soft mask facexlib uses without face parsing."""
+    height, width = temp_frame.shape[:2]
+    inverse_affine = cv2.invertAffineTransform(affine_matrix)
+    corners = cv2.transform(numpy.array([[[0, 0]], [[FACE_SIZE, 0]], [[FACE_SIZE, FACE_SIZE]], [[0, FACE_SIZE]]], dtype=numpy.float32), inverse_affine).reshape(-1, 2)
+    x1, y1 = numpy.maximum(numpy.floor(corners.min(axis=0)).astype(int) - 2, 0)
+    x2, y2 = numpy.minimum(numpy.ceil(corners.max(axis=0)).astype(int) + 2, [width, height])
+    if x2 <= x1 or y2 <= y1:
+        return
+
+    inverse_affine[0, 2] -= x1
+    inverse_affine[1, 2] -= y1
+    roi_size = (int(x2 - x1), int(y2 - y1))
+    inv_restored = cv2.warpAffine(restored_face, inverse_affine, roi_size)
+    inv_mask = cv2.warpAffine(numpy.ones((FACE_SIZE, FACE_SIZE), dtype=numpy.float32), inverse_affine, roi_size)
+    inv_mask_erosion = cv2.erode(inv_mask, numpy.ones((2, 2), numpy.uint8))
+    w_edge = int(numpy.sum(inv_mask_erosion) ** 0.5) // 20
+    if w_edge == 0:
+        return
+    inv_mask_center = cv2.erode(inv_mask_erosion, numpy.ones((w_edge * 2, w_edge * 2), numpy.uint8))
+    inv_soft_mask = cv2.GaussianBlur(inv_mask_center, (w_edge * 2 + 1, w_edge * 2 + 1), 0)[:, :, numpy.newaxis]
+
+    roi = temp_frame[y1:y2, x1:x2]
+    pasted_face = inv_mask_erosion[:, :, numpy.newaxis] * inv_restored
+    roi[:] = (inv_soft_mask * pasted_face + (1 - inv_soft_mask) * roi.astype(numpy.float32)).astype(numpy.uint8)
+
+
+def enhance_frames(temp_frames: List[Frame], frames_faces: List[Optional[List[Face]]]) -> List[Frame]:
+    """
+    Restore the given faces of many frames in batched GFPGAN passes.
+
+    The faces are aligned from their detected kps, so GFPGAN doesn't detect them again.
+    Frames without faces are returned as they are, the others are copied.
+    """
+    crops = []
+    for frame_index, (temp_frame, faces) in enumerate(zip(temp_frames, frames_faces)):
+        for face in faces or []:
+            cropped_face, affine_matrix = align_face(temp_frame, face)
+            crops.append((frame_index, cropped_face, affine_matrix))
+    if not crops:
+        return list(temp_frames)
+
+    restored_faces = restore_faces([cropped_face for _, cropped_face, _ in crops])
+    results = list(temp_frames)
+    copied = set()
+    for (frame_index, _, affine_matrix), restored_face in zip(crops, restored_faces):
+        if frame_index not in copied:
+            results[frame_index] = results[frame_index].copy()
+            copied.add(frame_index)
+        paste_back(results[frame_index], restored_face, affine_matrix)
+    return results
+
+
+def process_window(source_faces: Any, window: core.FrameWindow) -> None:
+    """
+    FrameChain step: restore the faces the swapper replaced, or every detected face when
+    no swapper ran before, all faces of the window in one batch.
+    """
+    if window.swapped_faces is not None:
+        frames_faces = window.swapped_faces
+    else:
+        frames_faces = [window.get_faces(index) for index in range(len(window))]
+    window.frames = enhance_frames(window.frames, frames_faces)
 
 
 def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame) -> Frame:
-    many_faces = get_many_faces(temp_frame)
-    if many_faces:
-        for target_face in many_faces:
-            temp_frame = enhance_face(target_face, temp_frame)
-    return temp_frame
+    return enhance_frames([temp_frame], [get_many_faces(temp_frame)])[0]
 
 
 def process_frames(source_path: str, temp_frame_paths: List[str], update: Callable[[], None]) -> None:
@@ -101,4 +171,4 @@ def process_image(source_path: str, target_path: str, output_path: str) -> None:
 
 
 def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
-    roop.processors.frame.core.process_video(None, temp_frame_paths, process_frames)
+    core.process_video(None, temp_frame_paths, process_frames)
@@ -6,33 +6,56 @@ class CDN:
     def __init__(self, base_url):
         self.base_url = base_url
 
-    def upload_to_cdn(self, file_path, cdn_file_path):
+    def get_content_type(self, file_path):
         """
-        Upload file on the CDN.
+        Get the content type of the file by its extension.
 
         Args:
             file_path (str)
-            cdn_file_path (str)
         Returns:
-            bool
+            str
         """
         if file_path.endswith('.mp4'):
-            file_type = "video/mp4"
+            return "video/mp4"
         elif file_path.endswith('.png'):
-            file_type = "image/png"
+            return "image/png"
         elif file_path.endswith('.jpg') or file_path.endswith('.jpeg'):
-            file_type = "image/jpg"
+            return "image/jpg"
         elif file_path.endswith('.webp'):
-            file_type = "image/webp"
+            return "image/webp"
+        return "application/octet-stream"
+
+    def upload_to_cdn(self, file_path, cdn_file_path):
+        """
+        Upload file on the CDN.
+
+        Args:
+            file_path (str)
+            cdn_file_path (str)
+        Returns:
+            bool
+        """
+        with open(file_path, "rb") as f:
+            return self.upload_bytes_to_cdn(f, cdn_file_path, self.get_content_type(file_path))
+
+    def upload_bytes_to_cdn(self, data, cdn_file_path, file_type=None):
+        """
+        Upload in-memory data on the CDN without writing it to disk first.
 
+        Args:
+            data (bytes | file-like)
+            cdn_file_path (str)
+            file_type (str) = None : Content type, guessed from cdn_file_path when not set
+        Returns:
+            bool
+        """
         headers = {
-            "Content-Type": file_type,
+            "Content-Type": file_type or self.get_content_type(cdn_file_path),
         }
 
-        with open(file_path, "rb") as f:
-            response = requests.put(
-                self.base_url + re.sub(r'^(\.\/)', '', cdn_file_path), headers=headers, data=f
-            )
+        response = requests.put(
+            self.base_url + re.sub(r'^(\.\/)', '', cdn_file_path), headers=headers, data=data
+        )
         return response.status_code == 200
 
     def download_from_cdn(self, file_name):
@@ -1,6 +1,6 @@
 from utilities import task_manage, db_manage
 from utilities.cdn_manager import CDN
-import multiprocessing
+from swap_worker import EXECUTION_PROVIDER, SwapWorkerPool, suggest_slots
 import re
 import os
 import time
@@ -34,26 +34,44 @@ RESULT_PATH = os.path.join(DATA_PATH, PATHS_CONFIG['result_path'])
 SOURCE_PATH = os.path.join(DATA_PATH, PATHS_CONFIG['source_path'])
 WATERMARK_PATH = os.path.join(DATA_PATH, PATHS_CONFIG['watermark_path'])
 
-IMPROVER_BG_TILE = 800
+# Models stay loaded between tasks, isolation in a child process is an opt-in crash guard
+SWAP_WORKER_ISOLATED = os.environ.get('swap_worker_isolated', 'false').lower() in ('1', 'true', 'yes')
+SWAP_WORKER_MAX_TASKS = int(os.environ.get('swap_worker_max_tasks', 200))
+# Only applies to isolated workers, their child process is restarted once its RSS passes it
+SWAP_WORKER_MAX_RSS_MB = int(os.environ.get('swap_worker_max_rss_mb', 16384))
+# Tasks run side by side, each on an isolated worker with its own models. 0 derives them
+# from the cores, the memory and, with CUDA, the GPU memory budget, the 0 of those means the whole node
+SWAP_SLOTS = int(os.environ.get('swap_slots', 0))
+SWAP_SLOT_GPU_MEMORY_MB = int(os.environ.get('swap_slot_gpu_memory_mb', 4096)) if 'cuda' in EXECUTION_PROVIDER else 0
 
 
-def swap_face(face_source, source_path, swaper_output_path, watermark, watermark_path, is_image):
-    from faceSwapLib.roop import core
-    core.run_multiple(face_source, source_path, swaper_output_path, watermark, watermark_path, is_it_image=is_image, execution_provider=['cuda'])
-
-def improve(swaper_output_path, output_file_path, bg_tile=400):
-    from gfpgan import improver
-    improver.improve(input=swaper_output_path, output=output_file_path, bg_tile=bg_tile)
-    os.remove(swaper_output_path)
+def get_swap_slots():
+    # Called by the consumer only, so the spawned swap workers don't query nvidia-smi again on import
+    return SWAP_SLOTS or suggest_slots(cpu_cores=int(os.environ.get('swap_cpu_cores', 0)),
+                                       slot_cpu_cores=int(os.environ.get('swap_slot_cpu_cores', 4)),
+                                       memory_budget_mb=int(os.environ.get('swap_memory_budget_mb', 0)),
+                                       slot_memory_mb=int(os.environ.get('swap_slot_memory_mb', 6144)),
+                                       gpu_memory_budget_mb=int(os.environ.get('swap_gpu_memory_budget_mb', 0)),
+                                       slot_gpu_memory_mb=SWAP_SLOT_GPU_MEMORY_MB)
 
 
 class Consumer():
 
     def __init__(self, rabbit_config_path='config/rabbit.cnf', mysql_config_path='config/mysql.cnf'):
-        self.task_manager = task_manage.TaskManager(rabbit_config_path)  
+        self.swap_slots = get_swap_slots()
+        # Tasks taken from the queue at a time: the slots, plus room for the videos waiting on the
+        # slots - 1 videos may use, so an image behind them is still delivered
+        self.swap_prefetch = 2 * self.swap_slots - 1
+        # One consumer thread per prefetched task, a slot is free again as soon as the swap
+        # is done, so the upload of a task runs while the next one swaps
+        self.task_manager = task_manage.TaskManager(rabbit_config_path, max_workers=self.swap_prefetch)
         self.db = db_manage.MySQLDB(mysql_config_path)
         self.cdn_result_upload = CDN(CDN_RESULT_UPLOAD_PATH)
         self.cdn_template_download = CDN(CDN_TEMPLATE_DOWNLOAD_PATH)
+        self.swap_workers = SwapWorkerPool(slots=self.swap_slots,
+                                           isolated=SWAP_WORKER_ISOLATED,
+                                           max_tasks=SWAP_WORKER_MAX_TASKS,
+                                           max_rss_mb=SWAP_WORKER_MAX_RSS_MB)
 
         # Connect to the BD
         self.db.connect()
@@ -64,6 +82,12 @@ class Consumer():
         decoded_img = task["decoded_image"]
         template_id = task['template_id']
         source_extension = task['source_extension']
+        cdn_file_path = f'{str(task_id) + str(source_extension)}'
+        source_path = f"{SOURCE_PATH + str(template_id) + str(source_extension)}"
+
+        query_status = "UPDATE taskApp2 SET status = %s WHERE task_id = %s;"
+        query_timer = "UPDATE taskApp2 SET timer = %s WHERE task_id = %s;"
+        query_source = "UPDATE taskApp2 SET source = %s WHERE task_id = %s;"
 
         try:
             print(f"Processing task: {task}")
@@ -71,23 +95,20 @@ class Consumer():
             from_face = os.listdir(os.path.join(decoded_img, 'from_face'))
             to_face = os.listdir(os.path.join(decoded_img, 'to_face'))
             output_folder_path = f'{RESULT_PATH + str(task_id)}'
-            os.mkdir(output_folder_path)
+            if not task['is_image']:
+                # Image results never touch the disk. A redelivered task finds the folder of its first attempt
+                os.makedirs(output_folder_path, exist_ok=True)
             
-            swaper_output_path = f'{output_folder_path}/{str(template_id)}_temp{str(source_extension)}'
             output_file_path = f'{output_folder_path}/{str(template_id) + str(source_extension)}'
-            cdn_file_path = f'{str(task_id) + str(source_extension)}'
-
-            query_status = "UPDATE taskApp2 SET status = %s WHERE task_id = %s;"
-            query_timer = "UPDATE taskApp2 SET timer = %s WHERE task_id = %s;"
-            query_source = "UPDATE taskApp2 SET source = %s WHERE task_id = %s;"
-
-            source_path = f"{SOURCE_PATH + str(template_id) + str(source_extension)}"
 
             if not os.path.isfile(source_path):
                 video_byt = self.cdn_template_download.download_from_cdn(PATHS_CONFIG['source_path'] + str(template_id) + str(source_extension))
 
-                with open(source_path, 'wb') as f:
+                # Moved in place once written, a task running beside on the same template never reads half of it
+                temp_source_path = f'{source_path}.{task_id}.part'
+                with open(temp_source_path, 'wb') as f:
                     f.write(video_byt)
+                os.replace(temp_source_path, source_path)
 
             self.db.execute_query(query_status, ('in_work', task_id))
 
@@ -107,43 +128,29 @@ class Consumer():
 
                 return False
 
-            if task['is_image']:
-                swap_p = multiprocessing.Process(target=swap_face, 
-                                                 args=(face_source, 
-                                                   source_path, 
-                                                   swaper_output_path, 
-                                                   task['watermark'], 
-                                                   WATERMARK_PATH), 
-                                                 kwargs={"is_image":task['is_image']}
-                                                )
-                swap_p.start()
-                swap_p.join()
-
-                improv_p = multiprocessing.Process(target=improve,
-                                                   args=(swaper_output_path, output_file_path),
-                                                   kwargs={"bg_tile":IMPROVER_BG_TILE}
-                                                   )
-                improv_p.start()
-                improv_p.join()
-
-            else:
-                swap_p = multiprocessing.Process(target=swap_face, 
-                                                 args=(face_source, 
-                                                   source_path, 
-                                                   output_file_path, 
-                                                   task['watermark'], 
-                                                   WATERMARK_PATH), 
-                                                kwargs={"is_image":task['is_image']}
-                                                )
-                swap_p.start()
-                swap_p.join()
+            job = {
+                'face_source': face_source,
+                'source_path': source_path,
+                'output_file_path': output_file_path,
+                'watermark': task['watermark'],
+                'watermark_path': WATERMARK_PATH,
+                'is_image': task['is_image']
+            }
 
+            success, result_data = self.swap_workers.run(job)
+            if not success:
+                # A streamed video that failed half way is still a playable file, it must not be uploaded as the result
+                raise RuntimeError(f'swap worker failed on task {task_id}')
 
             self.db.execute_query(query_timer, (int(time.time())-task['timer'], task_id))
             self.db.execute_query(query_status, ('done', task_id))
             self.db.execute_query(query_source, (f'{CDN_RESULT_DOWNLOAD_PATH + cdn_file_path}', task_id))
 
-            self.cdn_result_upload.upload_to_cdn(output_file_path, cdn_file_path)
+            if result_data is not None:
+                # Image results are encoded once in memory and go straight to the CDN
+                self.cdn_result_upload.upload_bytes_to_cdn(result_data, cdn_file_path)
+            else:
+                self.cdn_result_upload.upload_to_cdn(output_file_path, cdn_file_path)
 
         except Exception as e:
             print(f'Error: unexpected error during face swap: {str(e)}')
@@ -152,13 +159,19 @@ class Consumer():
             self.db.execute_query(query_source, (f'{CDN_RESULT_DOWNLOAD_PATH + cdn_file_path}', task_id))
 
             self.cdn_result_upload.upload_to_cdn(source_path, cdn_file_path)
+            # The task manager nacks the task, it is retried once and then dead-lettered
+            raise
 
 
 
     def start_consuming(self):
-        self.task_manager.listen_for_tasks_1(self.task_swap_face)
+        # Load models before the first task is picked up
+        self.swap_workers.start()
+        print(f"Running {self.swap_slots} swap tasks at a time")
+        self.task_manager.listen_for_tasks_1(self.task_swap_face, prefetch_count=self.swap_prefetch)
         
         # Disconect from BD at the end
+        self.swap_workers.stop()
         self.db.disconnect()
 
 
@@ -0,0 +1,212 @@
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import cv2
+import insightface
+import numpy
+import onnx
+from insightface.app.common import Face
+from insightface.utils import ensure_available
+
+from faceSwapLib.roop.face_analyser import ANALYSER_MODEL, INSIGHTFACE_ROOT, get_analyser_model_name
+from faceSwapLib.roop.processors.frame import face_swapper
+from faceSwapLib.roop.utilities import has_image_extension
+
+# Models of the buffalo_l pack the swap runs, the others are copied to the int8 pack unchanged
+QUANTIZED_ANALYSER_MODELS = ['det_10g.onnx', 'w600k_r50.onnx']
+PROVIDERS = ['CPUExecutionProvider']
+
+
+def quantize_model(input_path: str, output_path: str) -> None:
+    """
+    Dynamic quantization of the weights to uint8, the activations are quantized at run time.
+    ConvInteger of the CPU provider only takes uint8 weights, so QInt8 would not run the convs.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    with tempfile.TemporaryDirectory() as temp_directory_path:
+        preprocessed_path = os.path.join(temp_directory_path, os.path.basename(input_path))
+        try:
+            quant_pre_process(input_path, preprocessed_path)
+        except Exception as e:
+            print(f'Warning: pre-processing of {input_path} failed, quantizing it as it is - {e}')
+            preprocessed_path = input_path
+        quantize_dynamic(preprocessed_path, output_path, weight_type=QuantType.QUInt8)
+
+
+def quantize_inswapper(input_path: str, output_path: str) -> None:
+    """
+    inswapper reads its emap from the last initializer of the graph. The emap isn't used by
+    any node, so the quantizer drops it and it's appended again as it was.
+    """
+    quantize_model(input_path, output_path)
+    emap = onnx.load(input_path).graph.initializer[-1]
+    model = onnx.load(output_path)
+    for initializer in list(model.graph.initializer):
+        if initializer.name == emap.name:
+            model.graph.initializer.remove(initializer)
+    model.graph.initializer.append(emap)
+    onnx.save(model, output_path)
+
+
+def quantize_analyser(input_directory_path: str, output_directory_path: str) -> None:
+    os.makedirs(output_directory_path, exist_ok=True)
+    for file_name in sorted(os.listdir(input_directory_path)):
+        if not file_name.endswith('.onnx'):
+            continue
+        input_path = os.path.join(input_directory_path, file_name)
+        output_path = os.path.join(output_directory_path, file_name)
+        if file_name in QUANTIZED_ANALYSER_MODELS:
+            quantize_model(input_path, output_path)
+        else:
+            shutil.copyfile(input_path, output_path)
+
+
+def check_preprocessing(fp32_path: str, int8_path: str) -> bool:
+    """insightface guesses the input normalization from the first nodes, which the quantizer may change."""
+    fp32_model = insightface.model_zoo.get_model(fp32_path, providers=PROVIDERS)
+    int8_model = insightface.model_zoo.get_model(int8_path, providers=PROVIDERS)
+    for name in ['input_mean', 'input_std', 'input_size']:
+        if getattr(fp32_model, name, None) != getattr(int8_model, name, None):
+            print(f'Error: {int8_path} {name} is {getattr(int8_model, name, None)}, {fp32_path} has {getattr(fp32_model, name, None)}')
+            return False
+    return True
+
+
+def quantize() -> bool:
+    swapper_path = face_swapper.get_face_swapper_path('fp32')
+    int8_swapper_path = os.path.splitext(swapper_path)[0] + '_int8.onnx'
+    analyser_path = ensure_available('models', ANALYSER_MODEL, root=INSIGHTFACE_ROOT)
+    int8_analyser_path = os.path.join(INSIGHTFACE_ROOT, 'models', f'{ANALYSER_MODEL}_int8')
+
+    print(f'Quantizing {swapper_path}')
+    quantize_inswapper(swapper_path, int8_swapper_path)
+    print(f'Quantizing {analyser_path}')
+    quantize_analyser(analyser_path, int8_analyser_path)
+
+    checked = check_preprocessing(swapper_path, int8_swapper_path)
+    for file_name in QUANTIZED_ANALYSER_MODELS:
+        checked = check_preprocessing(os.path.join(analyser_path, file_name), os.path.join(int8_analyser_path, file_name)) and checked
+    return checked
+
+
+def load_models(precision: str) -> tuple:
+    analyser = insightface.app.FaceAnalysis(name=get_analyser_model_name(precision), root=INSIGHTFACE_ROOT,
+                                            allowed_modules=['detection', 'recognition'], providers=PROVIDERS)
+    analyser.prepare(ctx_id=0)
+    swapper = insightface.model_zoo.get_model(face_swapper.get_face_swapper_path(precision), providers=PROVIDERS)
+    return analyser, swapper
+
+
+def read_fixtures(fixtures_path: str) -> list:
+    fixtures = []
+    for file_name in sorted(os.listdir(fixtures_path)):
+        if has_image_extension(file_name):
+            frame = cv2.imread(os.path.join(fixtures_path, file_name))
+            if frame is not None:
+                fixtures.append(frame)
+    return fixtures
+
+
+def psnr(image: numpy.ndarray, reference: numpy.ndarray) -> float:
+    mse = numpy.mean((image.astype(numpy.float64) - reference.astype(numpy.float64)) ** 2)
+    if mse == 0:
+        return float('inf')
+    return float(10 * numpy.log10(255.0 ** 2 / mse))
+
+
+def report_drift(fixtures: list, fp32_models: tuple, int8_models: tuple) -> dict:
+    """
+    Embedding cosine between the recognition models and PSNR between the 128x128 swaps,
+    both on the faces the fp32 detector finds so only the compared model differs.
+    """
+    fp32_analyser, fp32_swapper = fp32_models
+    int8_analyser, int8_swapper = int8_models
+    fixtures_faces = [fp32_analyser.get(frame) for frame in fixtures]
+    source_face = next((faces[0] for faces in fixtures_faces if faces), None)
+    if source_face is None:
+        print('Error: no face found in the fixtures')
+        return {}
+
+    cosines = []
+    psnrs = []
+    detected = [0, 0]
+    for frame, faces in zip(fixtures, fixtures_faces):
+        detected[0] += len(faces)
+        detected[1] += len(int8_analyser.get(frame))
+        for face in faces:
+            # the recognition model writes the embedding to the face it gets
+            int8_face = Face(bbox=face.bbox, kps=face.kps, det_score=face.det_score)
+            int8_analyser.models['recognition'].get(frame, int8_face)
+            cosines.append(float(numpy.dot(face.normed_embedding, int8_face.normed_embedding)))
+            fp32_fake, _ = fp32_swapper.get(frame, face, source_face, paste_back=False)
+            int8_fake, _ = int8_swapper.get(frame, face, source_face, paste_back=False)
+            psnrs.append(psnr(int8_fake, fp32_fake))
+
+    return {
+        'faces': len(cosines),
+        'detected_faces': {'fp32': detected[0], 'int8': detected[1]},
+        'embedding_cosine': {'mean': float(numpy.mean(cosines)), 'min': float(numpy.min(cosines))},
+        'swap_psnr': {'mean': float(numpy.mean(psnrs)), 'min': float(numpy.min(psnrs))},
+    }
+
+
+def measure_throughput(fixtures: list, models: tuple, iterations: int) -> float:
+    """Frames per second of detection, recognition and the swap of every face, after one warm-up pass."""
+    analyser, swapper = models
+    source_face = next((faces[0] for faces in map(analyser.get, fixtures) if faces), None)
+    if source_face is None:
+        return 0.0
+
+    def run() -> None:
+        for frame in fixtures:
+            for face in analyser.get(frame):
+                swapper.get(frame, face, source_face, paste_back=True)
+
+    run()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        run()
+    return len(fixtures) * iterations / (time.perf_counter() - start)
+
+
+def main(args) -> None:
+    if not args.skip_quantize and not quantize():
+        print('Error: the int8 models preprocess their input differently, don\'t use them')
+        return
+
+    fixtures = read_fixtures(args.fixtures)
+    if not fixtures:
+        print(f'Error: no images in {args.fixtures}')
+        return
+
+    fp32_models = load_models('fp32')
+    int8_models = load_models('int8')
+    report = report_drift(fixtures, fp32_models, int8_models)
+    report['frames_per_second'] = {
+        'fp32': measure_throughput(fixtures, fp32_models, args.iterations),
+        'int8': measure_throughput(fixtures, int8_models, args.iterations),
+    }
+    print(json.dumps(report, indent=4))
+    if args.report:
+        with open(args.report, 'w') as report_file:
+            json.dump(report, report_file, indent=4)
+
+
+if __name__ == '__main__':
+    """Make the int8 models of the model_precision switch and report their drift from the fp32 ones on the CPU.
+
+    python -m faceSwapLib.quantize_models --fixtures path/to/faces
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fixtures', type=str, required=True, help='Directory of images with faces the models are compared on')
+    parser.add_argument('--iterations', type=int, default=5, help='Passes over the fixtures for the throughput')
+    parser.add_argument('--report', type=str, default=None, help='Also write the report to this json file')
+    parser.add_argument('--skip_quantize', action='store_true', help='Only report on the int8 models made before')
+    args = parser.parse_args()
+    main(args)
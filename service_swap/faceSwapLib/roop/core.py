@@ -1,9 +1,6 @@
 import os
-from torchvision.transforms import functional
 import sys
 
-sys.modules["torchvision.transforms.functional_tensor"] = functional
-
 from PIL import Image
 
 # single thread doubles cuda performance - needs to be set before torch import
@@ -12,28 +9,31 @@ if any(arg.startswith('--execution-provider') for arg in sys.argv):
 # reduce tensorflow log level
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 import warnings
-from typing import List
+from typing import Any, Dict, List, Optional, Tuple
 import platform
 import shutil
 import onnxruntime
-import tensorflow
-import ffmpeg
 import cv2
 from faceSwapLib.roop import globals
 from faceSwapLib.roop import metadata
-from faceSwapLib.roop import ui
 from faceSwapLib import roop
-from faceSwapLib.roop.face_analyser import get_unique_faces_from_video, get_unique_faces_from_photos
-from faceSwapLib.roop.predictor import predict_image, predict_video
-from faceSwapLib.roop.processors.frame.core import get_frame_processors_modules
+from faceSwapLib.roop.face_analyser import get_unique_faces_from_video, get_unique_faces_from_photos, \
+                            get_face_analyser, clear_face_analyser
+from faceSwapLib.roop.predictor import predict_image, predict_video, predict_frame, get_predictor, clear_predictor
+from faceSwapLib.roop.processors.frame.core import get_frame_processors_modules, get_loaded_frame_processors_modules, \
+                            process_video_stream, process_video, FrameChain, FrameWindow
+from faceSwapLib.roop.face_index import FaceIndex, get_face_index_path, load_face_index, save_face_index
+from faceSwapLib.roop.typin import Face, Frame
 from faceSwapLib.roop.utilities import has_image_extension, is_image, is_video, detect_fps, create_video, \
                             extract_frames, get_temp_frame_paths, restore_audio, create_temp, \
                             move_temp, clean_temp, normalize_output_path, \
-                            normalize_output_path_for_multiple
+                            normalize_output_path_for_multiple, detect_resolution
 
 warnings.filterwarnings('ignore', category=FutureWarning, module='insightface')
 warnings.filterwarnings('ignore', category=UserWarning, module='torchvision')
 
+RESOURCES_LIMITED = False
+
 
 def encode_execution_providers(execution_providers: List[str]) -> List[str]:
     return [execution_provider.replace('ExecutionProvider', '').lower() for execution_provider in execution_providers]
@@ -55,12 +55,12 @@ def suggest_execution_threads() -> int:
 
 
 def limit_resources() -> None:
-    # prevent tensorflow memory leak
-    gpus = tensorflow.config.experimental.list_physical_devices('GPU')
-    for gpu in gpus:
-        tensorflow.config.experimental.set_virtual_device_configuration(gpu, [
-            tensorflow.config.experimental.VirtualDeviceConfiguration(memory_limit=1024)
-        ])
+    global RESOURCES_LIMITED
+
+    # a warm worker limits them once, the tensorflow memory is limited by the predictor when it loads
+    if RESOURCES_LIMITED:
+        return
+    RESOURCES_LIMITED = True
     # limit memory usage
     if roop.globals.max_memory:
         memory = roop.globals.max_memory * 1024 ** 5
@@ -88,6 +88,8 @@ def pre_check() -> bool:
 def update_status(message: str, scope: str = 'ROOP.CORE') -> None:
     print(f'[{scope}] {message}')
     if not roop.globals.headless:
+        from faceSwapLib.roop import ui
+
         ui.update_status(message)
 
 
@@ -170,6 +172,47 @@ def start() -> bool:
         return False
 
 
+def warm_up(frame_processor: list[str] = ['face_swapper'],
+            execution_provider: list[str] = ['cpu'],
+            model_precision: str = 'fp32',
+            session_options: Optional[Dict[str, Dict[str, Any]]] = None) -> bool:
+    """
+    Loads the analyser, predictor and frame processor models once so that following
+    run_multiple calls in the same process reuse them instead of loading them per task.
+    model_precision int8 loads the quantized models made by quantize_models.py,
+    session_options are the onnxruntime options per model of onnx_session.
+    """
+    roop.globals.model_precision = model_precision
+    roop.globals.session_options = session_options or {}
+    roop.globals.headless = True
+    roop.globals.keep_models_loaded = True
+    roop.globals.frame_processors = frame_processor
+    roop.globals.execution_providers = decode_execution_providers(execution_provider)
+    roop.globals.execution_threads = suggest_execution_threads()
+
+    if not pre_check():
+        return False
+    for frame_processor_module in get_frame_processors_modules(roop.globals.frame_processors):
+        if not frame_processor_module.pre_check():
+            return False
+    limit_resources()
+
+    get_face_analyser()
+    get_predictor()
+    for frame_processor_module in get_frame_processors_modules(roop.globals.frame_processors):
+        if hasattr(frame_processor_module, 'warm_up'):
+            frame_processor_module.warm_up()
+    return True
+
+
+def release_models() -> None:
+    roop.globals.keep_models_loaded = False
+    for frame_processor_module in get_loaded_frame_processors_modules():
+        frame_processor_module.post_process()
+    clear_face_analyser()
+    clear_predictor()
+
+
 def destroy() -> None:
     if roop.globals.target_path:
         clean_temp(roop.globals.target_path)
@@ -187,6 +230,8 @@ def process_video_with_audio(original_video_path, watermark_path):
 
     # Extract audio from original video and save in original format (AAC)
     try:
+        import ffmpeg
+
         temp_audio_path = f"{filename}_temp_audio.aac"
         ffmpeg.input(original_video_path).output(temp_audio_path, acodec='copy').run(overwrite_output=True)
         print('extracy audio')
@@ -275,6 +320,42 @@ def add_watermark(video_path, watermark_path, output_path):
     cv2.destroyAllWindows()
 
 
+def blend_watermark(frame: Frame, watermark: Frame, position) -> Frame:
+    """Alpha blend an already loaded watermark into the BGR frame in place."""
+    x, y = position
+    height = min(watermark.shape[0], frame.shape[0] - y)
+    width = min(watermark.shape[1], frame.shape[1] - x)
+    if height <= 0 or width <= 0 or x < 0 or y < 0:
+        return frame
+
+    watermark = watermark[:height, :width]
+    region = frame[y:y + height, x:x + width]
+    if watermark.ndim == 3 and watermark.shape[2] == 4:
+        alpha = watermark[:, :, 3:] / 255.0
+        region[:] = (alpha * watermark[:, :, :3] + (1.0 - alpha) * region).astype(frame.dtype)
+    else:
+        region[:] = watermark[:, :, :3] if watermark.ndim == 3 else watermark[:, :, None]
+    return frame
+
+
+def get_video_watermark_position(frame_number: int, fps: float, frame: Frame, watermark: Frame, margin: int = 50):
+    """Same moving position as add_watermark: the corner changes every 3 seconds."""
+    frame_height, frame_width = frame.shape[:2]
+    watermark_h, watermark_w = watermark.shape[:2]
+    time_per_position = max(int(3 * fps), 1)
+    positions = [(margin, margin),  # Top left
+                 (frame_width - watermark_w - margin, margin),  # Top right
+                 (frame_width - watermark_w - margin, frame_height - watermark_h - margin),  # Bottom right
+                 (margin, frame_height - watermark_h - margin)]  # Bottom left
+    return positions[(frame_number // time_per_position + 1) % len(positions)]
+
+
+def add_watermark_to_frame(frame: Frame, watermark_image_path: str, position=(25, 25)) -> Frame:
+    """In-memory equivalent of add_watermark_to_photo for a BGR frame."""
+    watermark = cv2.imread(watermark_image_path, cv2.IMREAD_UNCHANGED)
+    return blend_watermark(frame, watermark, position)
+
+
 def add_watermark_to_photo(input_image_path, watermark_image_path):
     position = (25, 25)
     original_image = Image.open(input_image_path)
@@ -359,10 +440,33 @@ def run(source_path: str,
         return False
 
 
-def get_referance_faces_from_source(source_path: str, output_path: str, process_every_n_th_frame:int = 6):
+def load_target_face_index(target_path: str) -> Optional[FaceIndex]:
+    """
+    Face index of the template, None if it wasn't built from the frames this swap decodes.
+    Videos are decoded at their own frame rate with keep_fps and at 30 FPS without it.
+    """
+    index_path = get_face_index_path(target_path)
+    if has_image_extension(target_path) or not os.path.isfile(index_path):
+        return load_face_index(index_path)
+    return load_face_index(index_path, fps=detect_fps(target_path) if roop.globals.keep_fps else 30)
+
+
+def get_referance_faces_from_source(source_path: str, output_path: str, process_every_n_th_frame:int = 6, build_face_index: bool = True):
+    """
+    Save unique faces of the template as images into output_path.
+
+    With build_face_index the faces of every frame are stored next to the template
+    (see face_index), so swaps on this template don't need to run the analyser again.
+    """
+    frames_faces = [] if build_face_index else None
+    fps = 0
+    roop.globals.analyser_profile = 'get-face'
     if source_path.endswith('.mp4'):
         try:
-            unique_faces, _ = get_unique_faces_from_video(source_path, every_n_th_frame=process_every_n_th_frame)
+            # the swap decodes the template at its own frame rate, see load_target_face_index
+            fps = detect_fps(source_path)
+            unique_faces, _ = get_unique_faces_from_video(source_path, every_n_th_frame=process_every_n_th_frame, frames_faces=frames_faces,
+                                                          fps=fps)
             for index, unique_face in enumerate(unique_faces):
                 file_name = os.path.join(output_path, f'{str(index)}.png')
                 cv2.imwrite(file_name, unique_face)
@@ -372,7 +476,7 @@ def get_referance_faces_from_source(source_path: str, output_path: str, process_
             return False
     elif source_path.endswith(('.png', '.jpg', '.jpeg')):
         try:
-            unique_faces, _ = get_unique_faces_from_photos(source_path)
+            unique_faces, _ = get_unique_faces_from_photos(source_path, frames_faces=frames_faces)
             for index, unique_face in enumerate(unique_faces):
                 file_name = os.path.join(output_path, f'{str(index)}.png')
                 cv2.imwrite(file_name, unique_face)
@@ -384,6 +488,19 @@ def get_referance_faces_from_source(source_path: str, output_path: str, process_
         print(f"ERROR: wrong files format")
         return False
 
+    if build_face_index:
+        try:
+            if source_path.endswith('.mp4'):
+                resolution = detect_resolution(source_path)
+            else:
+                height, width = cv2.imread(source_path).shape[:2]
+                resolution = (width, height)
+            save_face_index(get_face_index_path(source_path), frames_faces, resolution, fps)
+            print(f'Saved face index of {len(frames_faces)} frames - {get_face_index_path(source_path)}')
+        except Exception as e:
+            print(f"Warning: can't save face index - {e}")
+    return True
+
 def start_multiple() -> bool:
     for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
         if not frame_processor.pre_start_for_multiple():
@@ -393,12 +510,11 @@ def start_multiple() -> bool:
     if has_image_extension(roop.globals.target_path):
         if predict_image(roop.globals.target_path):
             destroy()
-        shutil.copy2(roop.globals.target_path, roop.globals.output_path)
-        # process frame
-        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
-            update_status('Progressing...', frame_processor.NAME)
-            frame_processor.process_image_multy_faces(roop.globals.source_path, roop.globals.output_path, roop.globals.output_path)
-            frame_processor.post_process()
+        # process frame, read and written once for the whole processor chain
+        update_status('Progressing...')
+        chain = FrameChain(get_frame_processors_modules(roop.globals.frame_processors), roop.globals.source_path)
+        cv2.imwrite(roop.globals.output_path, chain.process_frame(cv2.imread(roop.globals.target_path), 0))
+        chain.post_process()
         # validate image
         if is_image(roop.globals.target_path):
             update_status('Processing to image succeed!')
@@ -410,6 +526,10 @@ def start_multiple() -> bool:
     # process image to videos
     if predict_video(roop.globals.target_path):
         destroy()
+
+    if roop.globals.stream_frames:
+        return start_multiple_stream()
+
     update_status('Creating temporary resources...')
     create_temp(roop.globals.target_path)
     # extract frames
@@ -423,11 +543,15 @@ def start_multiple() -> bool:
 
     # process frame
     temp_frame_paths = get_temp_frame_paths(roop.globals.target_path)
+    if roop.globals.face_index is not None and len(roop.globals.face_index) != len(temp_frame_paths):
+        print(f'Warning: face index has {len(roop.globals.face_index)} frames, the swap has {len(temp_frame_paths)}, detecting faces instead')
+        roop.globals.face_index = None
     if temp_frame_paths:
-        for frame_processor in get_frame_processors_modules(roop.globals.frame_processors):
-            update_status('Progressing...', frame_processor.NAME)
-            frame_processor.process_video_multy_faces(roop.globals.source_path, temp_frame_paths)
-            frame_processor.post_process()
+        # every frame goes through all processors in one read and one write
+        update_status('Progressing...')
+        chain = FrameChain(get_frame_processors_modules(roop.globals.frame_processors), roop.globals.source_path)
+        process_video(roop.globals.source_path, temp_frame_paths, chain.process_frames)
+        chain.post_process()
     else:
         update_status('Frames not found...')
         return False
@@ -463,6 +587,92 @@ def start_multiple() -> bool:
         return False
 
 
+def swap_image(source_path: list[list[str]],
+               target_path: str,
+               frame_processor: list[str] = ['face_swapper'],
+               many_faces: bool = True,
+               similar_face_distance: float = 0.85,
+               execution_provider: list[str] = ['cpu']) -> Optional[Tuple[Frame, Optional[List[Face]]]]:
+    """
+    Swap faces on an image template without touching the disk.
+
+    The template is decoded once and the swapped frame is returned so that the caller
+    can keep it in memory through enhancement and watermarking and encode it once.
+    It comes with the faces that were swapped (None if no processor swapped faces), so
+    the enhancement can restore exactly these faces without detecting them again.
+
+    Returns None if the template can't be read, is rejected or processing failed.
+    """
+    try:
+        roop.globals.source_path = source_path
+        roop.globals.target_path = target_path
+        roop.globals.output_path = None
+        roop.globals.headless = True
+        roop.globals.frame_processors = frame_processor
+        roop.globals.many_faces = many_faces
+        roop.globals.similar_face_distance = similar_face_distance
+        roop.globals.execution_providers = decode_execution_providers(execution_provider)
+        roop.globals.execution_threads = suggest_execution_threads()
+        roop.globals.face_index = load_face_index(get_face_index_path(target_path))
+
+        for frame_processor_module in get_frame_processors_modules(roop.globals.frame_processors):
+            if not frame_processor_module.pre_check():
+                return None
+        limit_resources()
+
+        frame = cv2.imread(target_path)
+        if frame is None:
+            update_status('Processing to image failed!')
+            return None
+        if predict_frame(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)):
+            update_status('Image rejected by content filter!')
+            return None
+
+        frame_processors = get_frame_processors_modules(roop.globals.frame_processors)
+        for frame_processor_module in frame_processors:
+            if not frame_processor_module.pre_start_for_multiple():
+                return None
+        update_status('Progressing...')
+        chain = FrameChain(frame_processors, source_path)
+        window = chain.run(FrameWindow([frame], 0))
+        chain.post_process()
+        return window.frames[0], window.swapped_faces[0] if window.swapped_faces is not None else None
+    except Exception as e:
+        print(f"ERROR: {e}")
+        return None
+
+
+def start_multiple_stream() -> bool:
+    """
+    Video branch of start_multiple that streams frames through ffmpeg pipes.
+
+    No frames are written to disk, the audio is muxed by the encoder and the watermark,
+    if requested, is blended into the frames on the way instead of a separate pass.
+    """
+    fps = detect_fps(roop.globals.target_path) if roop.globals.keep_fps else 30
+    chain = FrameChain(get_frame_processors_modules(roop.globals.frame_processors), roop.globals.source_path)
+    watermark = cv2.imread(roop.globals.watermark_path, cv2.IMREAD_UNCHANGED) if roop.globals.watermark_path else None
+
+    def process_frames(frames: List[Frame], window_start: int) -> List[Frame]:
+        # a window holds consecutive frames, so faces can be tracked between keyframes inside it
+        # and the faces of all its frames are swapped in one batch
+        frames = chain.process_window(frames, window_start)
+        if watermark is not None:
+            frames = [blend_watermark(frame, watermark, get_video_watermark_position(frame_number, fps, frame, watermark))
+                      for frame_number, frame in enumerate(frames, window_start)]
+        return frames
+
+    update_status(f'Streaming frames with {fps} FPS...')
+    result = process_video_stream(roop.globals.target_path, roop.globals.output_path, fps, process_frames)
+    chain.post_process()
+
+    if result and is_video(roop.globals.output_path):
+        update_status('Processing to video succeed!')
+        return True
+    update_status('Processing to video failed!')
+    return False
+
+
 def run_multiple(source_path: list[list[str]],
         target_path: str,
         output_path: str,
@@ -482,7 +692,11 @@ def run_multiple(source_path: list[list[str]],
         output_video_encoder: str = 'libx264',
         output_video_quality: int = 35,
         execution_provider: list[str] = ['cpu'],
-        is_it_image: bool = True) -> bool:
+        is_it_image: bool = True,
+        stream_frames: bool = False,
+        frame_queue_size: int = 32,
+        frame_window_size: int = 8,
+        detection_interval: int = 1) -> bool:
 
     try:
         print('get variables')
@@ -506,6 +720,13 @@ def run_multiple(source_path: list[list[str]],
         roop.globals.max_memory = max_memory
         roop.globals.execution_providers = decode_execution_providers(execution_provider)
         roop.globals.execution_threads = suggest_execution_threads()
+        roop.globals.stream_frames = stream_frames and not is_it_image
+        roop.globals.frame_queue_size = frame_queue_size
+        roop.globals.frame_window_size = frame_window_size
+        roop.globals.detection_interval = detection_interval
+        roop.globals.face_index = load_target_face_index(target_path)
+        # the streaming pipeline blends the watermark into the frames itself
+        roop.globals.watermark_path = os.path.abspath(watermark_path) if watermark_flag and roop.globals.stream_frames else None
         print('varibles getted')
         if not pre_check():
             return False
@@ -517,7 +738,7 @@ def run_multiple(source_path: list[list[str]],
         print('frame pre_check source - ', roop.globals.source_path)
         result = start_multiple()
 
-        if watermark_flag:
+        if watermark_flag and not roop.globals.stream_frames:
             print('add watermark')
             if is_it_image:
                 print('is image water')
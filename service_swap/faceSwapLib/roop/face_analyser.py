@@ -1,34 +1,107 @@
+import glob
+import os
 import threading
-from typing import Any, Optional, List
+from typing import Any, Optional, List, Tuple
 import insightface
+import onnxruntime
+from insightface.utils import ensure_available
 import numpy
 import cv2
 import numpy as np
-from sklearn.metrics.pairwise import cosine_distances
 
 from faceSwapLib import roop
 from faceSwapLib.roop import globals
+from faceSwapLib.roop.onnx_session import get_model_options, load_model
 from faceSwapLib.roop.typin import Frame, Face
-from faceSwapLib.roop.utilities import printProgressBar, extract_face_using_bbox
+from faceSwapLib.roop.capturer import get_video_frame_total
+from faceSwapLib.roop.utilities import printProgressBar, extract_face_using_bbox, resolve_relative_path, detect_fps, \
+                                      detect_resolution, read_frames
 
 FACE_ANALYSER = None
+FACE_ANALYSER_KEY = None
 THREAD_LOCK = threading.Lock()
 
-
-def get_face_analyser() -> Any:
-    global FACE_ANALYSER
+# buffalo_l modules each profile needs, None loads all of them (2D/3D landmarks, gender-age).
+# The swap and the template face extraction only use the detection kps and the embedding,
+# checking an image only counts the detected faces.
+ANALYSER_PROFILES = {
+    'swap': ['detection', 'recognition'],
+    'get-face': ['detection', 'recognition'],
+    'check-faces': ['detection'],
+    'full': None,
+}
+ANALYSER_MODEL = 'buffalo_l'
+# Root insightface downloads its model packs to, the int8 pack is built there by quantize_models.py
+INSIGHTFACE_ROOT = os.path.expanduser('~/.insightface')
+# Task of each model file of the buffalo_l packs, its session options are picked before it's loaded
+ANALYSER_MODEL_TASKS = {
+    'det_10g.onnx': 'detection',
+    'w600k_r50.onnx': 'recognition',
+    '1k3d68.onnx': 'landmark_3d_68',
+    '2d106det.onnx': 'landmark_2d_106',
+    'genderage.onnx': 'genderage',
+}
+
+
+class FaceAnalyser(insightface.app.FaceAnalysis):
+    """
+    FaceAnalysis that loads each model with the session options of its task in
+    roop.globals.session_options, and doesn't load the models allowed_modules leaves out.
+    """
+
+    def __init__(self, name: str, root: str, allowed_modules: Optional[List[str]] = None, providers: Optional[List[str]] = None) -> None:
+        onnxruntime.set_default_logger_severity(3)
+        self.models = {}
+        self.model_dir = ensure_available('models', name, root=root)
+        for onnx_file in sorted(glob.glob(os.path.join(self.model_dir, '*.onnx'))):
+            taskname = ANALYSER_MODEL_TASKS.get(os.path.basename(onnx_file))
+            if allowed_modules is not None and taskname not in allowed_modules or taskname in self.models:
+                continue
+            model = load_model(onnx_file, get_model_options(roop.globals.session_options, taskname), providers,
+                               resolve_relative_path('../models/optimized'))
+            if model is None or model.taskname in self.models or allowed_modules is not None and model.taskname not in allowed_modules:
+                continue
+            self.models[model.taskname] = model
+        assert 'detection' in self.models
+        self.det_model = self.models['detection']
+
+
+def get_analyser_model_name(precision: Optional[str] = None) -> str:
+    """buffalo_l, or its int8 variant when the precision asks for it and the pack exists."""
+    precision = precision or roop.globals.model_precision
+    if precision == 'int8':
+        model_name = f'{ANALYSER_MODEL}_int8'
+        if os.path.isdir(os.path.join(INSIGHTFACE_ROOT, 'models', model_name)):
+            return model_name
+        print(f'Warning: {model_name} not found, run faceSwapLib/quantize_models.py - using {ANALYSER_MODEL}')
+    return ANALYSER_MODEL
+
+
+def get_face_analyser(profile: Optional[str] = None) -> Any:
+    """Analyser with the modules of the profile, roop.globals.analyser_profile by default."""
+    global FACE_ANALYSER, FACE_ANALYSER_KEY
+
+    profile = profile or roop.globals.analyser_profile
+    if profile not in ANALYSER_PROFILES:
+        raise ValueError(f'Unknown analyser profile {profile}, use one of {list(ANALYSER_PROFILES)}')
 
     with THREAD_LOCK:
-        if FACE_ANALYSER is None:
-            FACE_ANALYSER = insightface.app.FaceAnalysis(name='buffalo_l', providers=roop.globals.execution_providers)
+        key = (profile, roop.globals.model_precision)
+        if FACE_ANALYSER is None or FACE_ANALYSER_KEY != key:
+            FACE_ANALYSER = FaceAnalyser(name=get_analyser_model_name(),
+                                         root=INSIGHTFACE_ROOT,
+                                         allowed_modules=ANALYSER_PROFILES[profile],
+                                         providers=roop.globals.execution_providers)
             FACE_ANALYSER.prepare(ctx_id=0)
+            FACE_ANALYSER_KEY = key
     return FACE_ANALYSER
 
 
 def clear_face_analyser() -> Any:
-    global FACE_ANALYSER
+    global FACE_ANALYSER, FACE_ANALYSER_KEY
 
     FACE_ANALYSER = None
+    FACE_ANALYSER_KEY = None
 
 
 def get_one_face(frame: Frame, position: int = 0) -> Optional[Face]:
@@ -48,6 +121,123 @@ def get_many_faces(frame: Frame) -> Optional[List[Face]]:
         return None
 
 
+class FaceTracker:
+    """
+    Runs detection and recognition only on keyframes and tracks the faces in between.
+
+    A keyframe is every detect_interval-th frame, a scene cut or a frame where tracking
+    lost confidence. Between keyframes every face is followed with pyramidal Lucas-Kanade
+    optical flow on its kps and corner points inside its bbox, and a similarity transform
+    fitted with RANSAC moves the bbox and kps. The tracked faces keep the embedding of the
+    keyframe, so they keep their identity for the matching.
+
+    Frames must be given in order, one tracker per sequence of consecutive frames.
+    """
+
+    def __init__(self, detect_interval: int = 5, scene_cut_threshold: float = 0.5, min_inlier_ratio: float = 0.6) -> None:
+        self.detect_interval = detect_interval
+        self.scene_cut_threshold = scene_cut_threshold
+        self.min_inlier_ratio = min_inlier_ratio
+        self.faces: Optional[List[Face]] = None
+        self.previous_gray = None
+        self.previous_histogram = None
+        self.frames_since_detection = 0
+
+    def get_faces(self, frame: Frame) -> Optional[List[Face]]:
+        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        histogram = self.get_histogram(gray)
+
+        faces = None
+        if self.faces is not None and self.frames_since_detection + 1 < self.detect_interval and not self.is_scene_cut(histogram):
+            faces = self.track(gray)
+        if faces is None:
+            faces = get_many_faces(frame)
+            self.frames_since_detection = 0
+        else:
+            self.frames_since_detection += 1
+
+        self.faces = faces or []
+        self.previous_gray = gray
+        self.previous_histogram = histogram
+        return faces
+
+    def get_histogram(self, gray: Frame) -> numpy.ndarray:
+        small = cv2.resize(gray, (64, 36), interpolation=cv2.INTER_AREA)
+        histogram = cv2.calcHist([small], [0], None, [32], [0, 256])
+        return cv2.normalize(histogram, histogram)
+
+    def is_scene_cut(self, histogram: numpy.ndarray) -> bool:
+        return cv2.compareHist(self.previous_histogram, histogram, cv2.HISTCMP_CORREL) < self.scene_cut_threshold
+
+    def track(self, gray: Frame) -> Optional[List[Face]]:
+        """Move every face to the new frame, None if any of them can't be tracked reliably."""
+        tracked_faces = []
+        for face in self.faces:
+            tracked_face = self.track_face(face, gray)
+            if tracked_face is None:
+                return None
+            tracked_faces.append(tracked_face)
+        return tracked_faces
+
+    def track_face(self, face: Face, gray: Frame) -> Optional[Face]:
+        height, width = gray.shape[:2]
+        x1, y1, x2, y2 = numpy.clip(face.bbox, 0, [width - 1, height - 1, width - 1, height - 1]).astype(int)
+        if x2 - x1 < 8 or y2 - y1 < 8:
+            return None
+
+        mask = numpy.zeros_like(self.previous_gray)
+        mask[y1:y2, x1:x2] = 255
+        corners = cv2.goodFeaturesToTrack(self.previous_gray, maxCorners=40, qualityLevel=0.01, minDistance=5, mask=mask)
+        points = face.kps.reshape(-1, 1, 2).astype(numpy.float32)
+        if corners is not None:
+            points = numpy.concatenate([points, corners.astype(numpy.float32)])
+
+        next_points, status, _ = cv2.calcOpticalFlowPyrLK(self.previous_gray, gray, points, None, winSize=(21, 21), maxLevel=3)
+        if next_points is None:
+            return None
+        # forward-backward check drops points that drifted
+        back_points, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.previous_gray, next_points, None, winSize=(21, 21), maxLevel=3)
+        error = numpy.linalg.norm((points - back_points).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (error < 1.0)
+        if good.sum() < 4:
+            return None
+
+        matrix, inliers = cv2.estimateAffinePartial2D(points[good], next_points[good], method=cv2.RANSAC, ransacReprojThreshold=3.0)
+        if matrix is None or inliers is None or inliers.sum() < self.min_inlier_ratio * good.sum():
+            return None
+
+        kps = cv2.transform(face.kps.reshape(-1, 1, 2).astype(numpy.float32), matrix).reshape(-1, 2)
+        corners = cv2.transform(numpy.array([[[face.bbox[0], face.bbox[1]]], [[face.bbox[2], face.bbox[1]]],
+                                             [[face.bbox[2], face.bbox[3]]], [[face.bbox[0], face.bbox[3]]]], dtype=numpy.float32), matrix).reshape(-1, 2)
+        tracked_face = Face(face)
+        tracked_face.kps = kps
+        tracked_face.bbox = numpy.concatenate([corners.min(axis=0), corners.max(axis=0)])
+        return tracked_face
+
+
+def get_frame_faces(frame: Frame, frame_number: Optional[int] = None, tracker: Optional[FaceTracker] = None) -> Optional[List[Face]]:
+    """
+    Faces of a template frame.
+
+    Taken from the precomputed face index when it covers the frame, otherwise from the
+    tracker if one is given, otherwise from a full detection.
+    """
+    if frame_number is not None and roop.globals.face_index is not None:
+        faces = roop.globals.face_index.get_faces(frame_number, frame)
+        if faces is not None:
+            return faces
+    if tracker is not None:
+        return tracker.get_faces(frame)
+    return get_many_faces(frame)
+
+
+def create_face_tracker() -> Optional[FaceTracker]:
+    """Tracker for a sequence of consecutive frames, None when detection should run on every frame."""
+    if roop.globals.detection_interval and roop.globals.detection_interval > 1:
+        return FaceTracker(roop.globals.detection_interval)
+    return None
+
+
 def find_similar_face(frame: Frame, reference_face: Face) -> Optional[Face]:
     many_faces = get_many_faces(frame)
     if many_faces:
@@ -59,6 +249,9 @@ def find_similar_face(frame: Frame, reference_face: Face) -> Optional[Face]:
     return None
 
 def check_similar_face2face(face: Face, reference_face: Face, similar_face_distance=0.5) -> Optional[Face]:
+    # sklearn takes most of the import time of roop and only the template face extraction needs it
+    from sklearn.metrics.pairwise import cosine_distances
+
     face = face.reshape(1, -1)
     reference_face = reference_face.reshape(1, -1)
     distance = cosine_distances(face, reference_face)
@@ -66,33 +259,78 @@ def check_similar_face2face(face: Face, reference_face: Face, similar_face_dista
         return True
     return None
 
-def get_unique_faces_from_video(path2target_video: str, every_n_th_frame=5) -> List[Face]:
-    video = cv2.VideoCapture(path2target_video)
+def get_normed_embeddings(faces: List[Face]) -> numpy.ndarray:
+    """Stack face embeddings into one L2 normalized (faces x 512) matrix."""
+    if not faces:
+        return numpy.zeros((0, 512), dtype=numpy.float32)
+    embeddings = numpy.array([face.embedding for face in faces], dtype=numpy.float32)
+    return embeddings / numpy.maximum(numpy.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+def match_faces(faces: List[Face], reference_embeddings: numpy.ndarray, max_distance: float = 0.5) -> List[Tuple[int, int]]:
+    """
+    Assign detected faces to reference identities one to one.
+
+    All cosine distances come from a single matrix product, then the closest pairs under
+    max_distance are taken greedily, so every face and every reference is used at most once.
+
+        return:
+            list: (face index, reference index) pairs
+    """
+    if not faces or not len(reference_embeddings):
+        return []
+    distances = 1.0 - get_normed_embeddings(faces) @ reference_embeddings.T
+    candidates = numpy.argwhere(distances < max_distance)
+    order = numpy.argsort(distances[candidates[:, 0], candidates[:, 1]], kind='stable')
+
+    matches = []
+    used_faces = set()
+    used_references = set()
+    for face_index, reference_index in candidates[order]:
+        if face_index in used_faces or reference_index in used_references:
+            continue
+        used_faces.add(face_index)
+        used_references.add(reference_index)
+        matches.append((int(face_index), int(reference_index)))
+    return matches
+
+def get_unique_faces_from_video(path2target_video: str, every_n_th_frame=5, frames_faces: Optional[list] = None,
+                                fps: Optional[float] = None) -> List[Face]:
+    """
+    Collect unique faces from every n-th frame of the video.
+
+    If frames_faces list is given, detection runs on every frame and the faces of each
+    frame are appended to it, so the same pass builds the template face index. Frames are
+    decoded by ffmpeg at fps (detect_fps if None) like the swap does, so the index numbers
+    them the same way.
+    """
+    fps = fps or detect_fps(path2target_video)
+    width, height = detect_resolution(path2target_video)
     unique_faces = []
     seen_faces = []
     number = 0
 
     # Get the total number of frames in the video
-    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    total_frames = get_video_frame_total(path2target_video)
 
     # Initial call to print 0% progress
     printProgressBar(0, total_frames, prefix = 'Progress:', suffix = 'Complete', length = 20)
 
-    while video.isOpened():
-        ret, frame = video.read()
+    for frame in read_frames(path2target_video, fps, width, height):
         number += 1
 
-        if not ret:
-            break
-
         # Update Progress Bar
         printProgressBar(number, total_frames, prefix = 'Progress:', suffix = 'Complete', length = 20)
 
+        if frames_faces is not None:
+            faces = get_many_faces(frame)
+            frames_faces.append(faces)
+
         # Skip frames that are not multiples of 5
         if number % every_n_th_frame != 0:
             continue
 
-        faces = get_many_faces(frame)
+        if frames_faces is None:
+            faces = get_many_faces(frame)
 
         if faces:
             for face in faces:
@@ -108,12 +346,10 @@ def get_unique_faces_from_video(path2target_video: str, every_n_th_frame=5) -> L
                         unique_faces.append(face_img)
                         seen_faces.append(embedding)
 
-
-    video.release()
     return (unique_faces, seen_faces)
 
 
-def get_unique_faces_from_photos(path_to_photo: str):
+def get_unique_faces_from_photos(path_to_photo: str, frames_faces: Optional[list] = None):
 
     unique_faces = []
     seen_faces = []
@@ -121,6 +357,8 @@ def get_unique_faces_from_photos(path_to_photo: str):
     img = cv2.imread(path_to_photo)
 
     faces = get_many_faces(img)
+    if frames_faces is not None:
+        frames_faces.append(faces)
 
     if faces:
         for face in faces:
@@ -0,0 +1,104 @@
+import os
+from typing import List, Optional, Tuple
+
+import numpy
+
+from faceSwapLib.roop.typin import Face, Frame
+
+FACE_INDEX_EXTENSION = '.faces.npz'
+
+
+class FaceIndex:
+    """
+    Detection results of every frame of a template, computed once at template ingest.
+
+    Faces of frame n are rows offsets[n]:offsets[n + 1] of the bboxes, kps, embeddings and
+    det_scores arrays. Embeddings are stored normed, which is all the swap path needs.
+    Video frames are numbered as ffmpeg decodes them at fps, 0 for images.
+    """
+
+    def __init__(self, offsets: numpy.ndarray, bboxes: numpy.ndarray, kps: numpy.ndarray,
+                 embeddings: numpy.ndarray, det_scores: numpy.ndarray, resolution: Tuple[int, int], fps: float) -> None:
+        self.offsets = offsets
+        self.bboxes = bboxes
+        self.kps = kps
+        self.embeddings = embeddings
+        self.det_scores = det_scores
+        self.resolution = resolution
+        self.fps = fps
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def get_faces(self, frame_number: int, frame: Optional[Frame] = None) -> Optional[List[Face]]:
+        """Faces of the frame, or None if the index doesn't cover it and the frame needs a detection."""
+        if frame_number < 0 or frame_number >= len(self):
+            return None
+        if frame is not None and (frame.shape[1], frame.shape[0]) != self.resolution:
+            return None
+
+        start, end = self.offsets[frame_number], self.offsets[frame_number + 1]
+        return [Face(bbox=self.bboxes[i],
+                     kps=self.kps[i],
+                     det_score=self.det_scores[i],
+                     embedding=self.embeddings[i].astype(numpy.float32))
+                for i in range(start, end)]
+
+
+def get_face_index_path(target_path: str) -> str:
+    return os.path.splitext(target_path)[0] + FACE_INDEX_EXTENSION
+
+
+def save_face_index(index_path: str, frames_faces: List[Optional[List[Face]]], resolution: Tuple[int, int], fps: float = 0) -> None:
+    faces = [face for frame_faces in frames_faces for face in (frame_faces or [])]
+    offsets = numpy.cumsum([0] + [len(frame_faces or []) for frame_faces in frames_faces]).astype(numpy.int32)
+    # write to a temporary file first so a swap never loads a half written index
+    temp_index_path = index_path + '.tmp.npz'
+    numpy.savez_compressed(
+        temp_index_path,
+        offsets=offsets,
+        bboxes=numpy.array([face.bbox for face in faces], dtype=numpy.float32).reshape(-1, 4),
+        kps=numpy.array([face.kps for face in faces], dtype=numpy.float32).reshape(-1, 5, 2),
+        embeddings=numpy.array([face.normed_embedding for face in faces], dtype=numpy.float16) if faces else numpy.zeros((0, 512), dtype=numpy.float16),
+        det_scores=numpy.array([face.det_score for face in faces], dtype=numpy.float32),
+        resolution=numpy.array(resolution, dtype=numpy.int32),
+        fps=numpy.array(fps, dtype=numpy.float64),
+        frame_count=numpy.array(len(frames_faces), dtype=numpy.int32)
+    )
+    os.replace(temp_index_path, index_path)
+
+
+def load_face_index(index_path: str, fps: Optional[float] = None, frame_count: Optional[int] = None) -> Optional[FaceIndex]:
+    """
+    Face index of the file, None if there's none or it doesn't match the frames of the swap.
+
+        args:
+            fps (float): Rate the swap decodes the video at, None skips the check
+            frame_count (int): Frames the swap decodes, None skips the check
+    """
+    if not os.path.isfile(index_path):
+        return None
+    try:
+        with numpy.load(index_path) as data:
+            face_index = FaceIndex(data['offsets'],
+                                   data['bboxes'],
+                                   data['kps'],
+                                   data['embeddings'],
+                                   data['det_scores'],
+                                   tuple(int(value) for value in data['resolution']),
+                                   float(data['fps']))
+            index_frame_count = int(data['frame_count'])
+    except Exception as e:
+        print(f'Warning: can\'t load face index {index_path} - {e}')
+        return None
+
+    if index_frame_count != len(face_index):
+        print(f'Warning: face index {index_path} is damaged, it has {len(face_index)} of {index_frame_count} frames')
+        return None
+    if fps is not None and abs(face_index.fps - fps) > 1e-3:
+        print(f'Warning: face index {index_path} was built at {face_index.fps} FPS, the swap runs at {fps} FPS')
+        return None
+    if frame_count is not None and frame_count != len(face_index):
+        print(f'Warning: face index {index_path} has {len(face_index)} frames, the swap has {frame_count}')
+        return None
+    return face_index
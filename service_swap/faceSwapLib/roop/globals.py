@@ -1,4 +1,4 @@
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 source_path = None
 target_path: Optional[str] = None
@@ -20,3 +20,15 @@ max_memory: Optional[int] = None
 execution_providers: List[str] = []
 execution_threads: Optional[int] = None
 log_level: str = 'error'
+keep_models_loaded: bool = False
+stream_frames: bool = False
+frame_queue_size: Optional[int] = None
+watermark_path: Optional[str] = None
+face_index = None
+detection_interval: int = 1
+frame_window_size: Optional[int] = None
+analyser_profile: str = 'swap'
+swap_batch_size: int = 16
+enhance_batch_size: int = 8
+model_precision: str = 'fp32'
+session_options: Dict[str, Dict[str, Any]] = {}
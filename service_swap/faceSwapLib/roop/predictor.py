@@ -1,21 +1,44 @@
 import threading
+from typing import Any
+import cv2
 import numpy
-import opennsfw2
 from PIL import Image
-from keras import Model
 
 from faceSwapLib.roop.typin import Frame
 
+# opennsfw2 pulls in tensorflow and keras, they are imported with the first predictor
 PREDICTOR = None
+TENSORFLOW_CONFIGURED = False
 THREAD_LOCK = threading.Lock()
 MAX_PROBABILITY = 0.85
+VIDEO_FRAME_INTERVAL = 100
 
 
-def get_predictor() -> Model:
+def configure_tensorflow() -> None:
+    global TENSORFLOW_CONFIGURED
+
+    # tensorflow refuses to reconfigure devices once initialized, so it's done once per process
+    if TENSORFLOW_CONFIGURED:
+        return
+    TENSORFLOW_CONFIGURED = True
+    import tensorflow
+
+    # prevent tensorflow memory leak
+    gpus = tensorflow.config.experimental.list_physical_devices('GPU')
+    for gpu in gpus:
+        tensorflow.config.experimental.set_virtual_device_configuration(gpu, [
+            tensorflow.config.experimental.VirtualDeviceConfiguration(memory_limit=1024)
+        ])
+
+
+def get_predictor() -> Any:
     global PREDICTOR
 
     with THREAD_LOCK:
         if PREDICTOR is None:
+            configure_tensorflow()
+            import opennsfw2
+
             PREDICTOR = opennsfw2.make_open_nsfw_model()
     return PREDICTOR
 
@@ -27,17 +50,37 @@ def clear_predictor() -> None:
 
 
 def predict_frame(target_frame: Frame) -> bool:
+    predictor = get_predictor()
+    import opennsfw2
+
     image = Image.fromarray(target_frame)
     image = opennsfw2.preprocess_image(image, opennsfw2.Preprocessing.YAHOO)
     views = numpy.expand_dims(image, axis=0)
-    _, probability = get_predictor().predict(views)[0]
+    _, probability = predictor.predict(views)[0]
     return probability > MAX_PROBABILITY
 
 
 def predict_image(target_path: str) -> bool:
-    return opennsfw2.predict_image(target_path) > MAX_PROBABILITY
+    image = Image.open(target_path).convert('RGB')
+    return predict_frame(numpy.array(image))
 
 
 def predict_video(target_path: str) -> bool:
-    _, probabilities = opennsfw2.predict_video_frames(video_path=target_path, frame_interval=100)
-    return any(probability > MAX_PROBABILITY for probability in probabilities)
+    # opennsfw2.predict_video_frames builds a new model on every call, sample frames against the cached one
+    video = cv2.VideoCapture(target_path)
+    frame_number = 0
+    try:
+        while video.isOpened():
+            if frame_number % VIDEO_FRAME_INTERVAL:
+                if not video.grab():
+                    break
+            else:
+                has_frame, frame = video.read()
+                if not has_frame:
+                    break
+                if predict_frame(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)):
+                    return True
+            frame_number += 1
+    finally:
+        video.release()
+    return False
@@ -2,15 +2,21 @@ import os
 import sys
 import importlib
 import psutil
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from queue import Queue
 from types import ModuleType
-from typing import Any, List, Callable
+from typing import Any, Dict, Iterator, List, Callable, Optional, Tuple
+import cv2
 from tqdm import tqdm
 
 from faceSwapLib import roop
+from faceSwapLib.roop.capturer import get_video_frame_total
+from faceSwapLib.roop.face_analyser import get_frame_faces, create_face_tracker
+from faceSwapLib.roop.typin import Face, Frame
+from faceSwapLib.roop.utilities import read_frames, open_frame_writer, detect_resolution, get_temp_frame_number
 
-FRAME_PROCESSORS_MODULES: List[ModuleType] = []
+FRAME_PROCESSORS_MODULES: Dict[str, ModuleType] = {}
 FRAME_PROCESSORS_INTERFACE = [
     'pre_check',
     'pre_start',
@@ -20,6 +26,10 @@ FRAME_PROCESSORS_INTERFACE = [
     'process_video',
     'post_process'
 ]
+# Optional methods of a frame processor to run in a FrameChain:
+#   get_source_faces(source_path) -> source prepared once per task, passed to process_window
+#   process_window(source, window) -> None, replaces window.frames with the processed frames
+# A processor without process_window runs its process_frame(source, None, frame) on each frame.
 
 
 def load_frame_processor_module(frame_processor: str) -> Any:
@@ -36,13 +46,94 @@ def load_frame_processor_module(frame_processor: str) -> Any:
 
 
 def get_frame_processors_modules(frame_processors: List[str]) -> List[ModuleType]:
-    global FRAME_PROCESSORS_MODULES
-
-    if not FRAME_PROCESSORS_MODULES:
-        for frame_processor in frame_processors:
-            frame_processor_module = load_frame_processor_module(frame_processor)
-            FRAME_PROCESSORS_MODULES.append(frame_processor_module)
-    return FRAME_PROCESSORS_MODULES
+    """Modules of the requested processors in order, each loaded once per process."""
+    for frame_processor in frame_processors:
+        if frame_processor not in FRAME_PROCESSORS_MODULES:
+            FRAME_PROCESSORS_MODULES[frame_processor] = load_frame_processor_module(frame_processor)
+    return [FRAME_PROCESSORS_MODULES[frame_processor] for frame_processor in frame_processors]
+
+
+def get_loaded_frame_processors_modules() -> List[ModuleType]:
+    return list(FRAME_PROCESSORS_MODULES.values())
+
+
+class FrameWindow:
+    """
+    Consecutive frames going through a FrameChain, with the detections its processors share.
+
+    Faces are detected once on the frames as they came in, from the face index or with a
+    tracker for the window, whichever processor asks first. A processor that changes faces
+    records them in swapped_faces so the next ones can reuse them.
+    """
+
+    def __init__(self, frames: List[Frame], start_frame_number: Optional[int] = None) -> None:
+        self.frames = list(frames)
+        self.start_frame_number = start_frame_number
+        # faces changed per frame, None until a processor records them
+        self.swapped_faces: Optional[List[List[Face]]] = None
+        self.faces: Optional[List[Optional[List[Face]]]] = None
+
+    def __len__(self) -> int:
+        return len(self.frames)
+
+    def get_faces(self, index: int) -> Optional[List[Face]]:
+        if self.faces is None:
+            # without a start the frames aren't consecutive, tracking between them would follow the wrong faces
+            tracker = create_face_tracker() if self.start_frame_number is not None else None
+            self.faces = []
+            for offset, frame in enumerate(self.frames):
+                frame_number = None if self.start_frame_number is None else self.start_frame_number + offset
+                self.faces.append(get_frame_faces(frame, frame_number, tracker))
+        return self.faces[index]
+
+
+class FrameChain:
+    """
+    Frame processors applied one after another to each window of frames in a single traversal,
+    so a frame is decoded and written once whatever the number of processors.
+    """
+
+    def __init__(self, frame_processors: List[ModuleType], source_path: Any) -> None:
+        self.frame_processors = frame_processors
+        self.sources = [frame_processor.get_source_faces(source_path) if hasattr(frame_processor, 'get_source_faces') else None
+                        for frame_processor in frame_processors]
+
+    def process_window(self, frames: List[Frame], start_frame_number: Optional[int] = None) -> List[Frame]:
+        return self.run(FrameWindow(frames, start_frame_number)).frames
+
+    def run(self, window: FrameWindow) -> FrameWindow:
+        for frame_processor, source in zip(self.frame_processors, self.sources):
+            if hasattr(frame_processor, 'process_window'):
+                frame_processor.process_window(source, window)
+            else:
+                window.frames = [frame_processor.process_frame(source, None, frame) for frame in window.frames]
+        return window
+
+    def process_frame(self, frame: Frame, frame_number: Optional[int] = None) -> Frame:
+        return self.process_window([frame], frame_number)[0]
+
+    def process_frames(self, source_path: Any, temp_frame_paths: List[str], update: Callable[[], None]) -> None:
+        """Same signature as the process_frames of a processor, so it runs through process_video."""
+        window_size = max(roop.globals.frame_window_size or 1, 1)
+        for start in range(0, len(temp_frame_paths), window_size):
+            window_paths = temp_frame_paths[start:start + window_size]
+            frames = [cv2.imread(temp_frame_path) for temp_frame_path in window_paths]
+            for temp_frame_path, result in zip(window_paths, self.process_window(frames, get_window_start(window_paths))):
+                cv2.imwrite(temp_frame_path, result)
+                if update:
+                    update()
+
+    def post_process(self) -> None:
+        for frame_processor in self.frame_processors:
+            frame_processor.post_process()
+
+
+def get_window_start(temp_frame_paths: List[str]) -> Optional[int]:
+    """Number of the first frame if the paths are consecutive frames, None otherwise."""
+    frame_numbers = [get_temp_frame_number(temp_frame_path) for temp_frame_path in temp_frame_paths]
+    if None in frame_numbers or frame_numbers != list(range(frame_numbers[0], frame_numbers[0] + len(frame_numbers))):
+        return None
+    return frame_numbers[0]
 
 
 def multi_process_frame(source_path: str, temp_frame_paths: List[str], process_frames: Callable[[str, List[str], Any], None], update: Callable[[], None]) -> None:
@@ -79,6 +170,64 @@ def process_video(source_path: str, frame_paths: list[str], process_frames: Call
         multi_process_frame(source_path, frame_paths, process_frames, lambda: update_progress(progress))
 
 
+def read_frame_windows(target_path: str, fps: float, width: int, height: int, window_size: int) -> Iterator[Tuple[int, List[Frame]]]:
+    """Group decoded frames into windows of consecutive frames together with the number of the first one."""
+    window: List[Frame] = []
+    window_start = 0
+    for frame_number, frame in enumerate(read_frames(target_path, fps, width, height)):
+        if not window:
+            window_start = frame_number
+        window.append(frame)
+        if len(window) == window_size:
+            yield window_start, window
+            window = []
+    if window:
+        yield window_start, window
+
+
+def process_video_stream(target_path: str, output_path: str, fps: float, process_frames: Callable[[List[Frame], int], List[Frame]]) -> bool:
+    """
+    Decode, process and encode the video through ffmpeg pipes without temporary frames on disk.
+
+    Windows of frame_window_size consecutive frames are processed by execution_threads
+    workers, so a window can track faces and batch its work. At most frame_queue_size frames
+    are in flight and they are written to the encoder in their original order, so a small
+    queue shrinks the window and the threads rather than holding more frames.
+    """
+    width, height = detect_resolution(target_path)
+    frame_queue_size = max(roop.globals.frame_queue_size or 1, 1)
+    window_size = max(min(roop.globals.frame_window_size or 1, frame_queue_size), 1)
+    max_pending = max(frame_queue_size // window_size, 1)
+    writer = open_frame_writer(target_path, output_path, fps, width, height)
+    progress_bar_format = '{l_bar}{bar}| {n_fmt}/{total_fmt} [{elapsed}<{remaining}, {rate_fmt}{postfix}]'
+
+    def write_frames(frames: List[Frame], progress: Any) -> None:
+        for frame in frames:
+            writer.stdin.write(frame.tobytes())
+            update_progress(progress)
+
+    try:
+        with tqdm(total=get_video_frame_total(target_path), desc='Processing', unit='frame', dynamic_ncols=True, bar_format=progress_bar_format) as progress, \
+                ThreadPoolExecutor(max_workers=min(roop.globals.execution_threads, max_pending)) as executor:
+            pending: deque = deque()
+            for window_start, frames in read_frame_windows(target_path, fps, width, height, window_size):
+                pending.append(executor.submit(process_frames, frames, window_start))
+                if len(pending) >= max_pending:
+                    write_frames(pending.popleft().result(), progress)
+            while pending:
+                write_frames(pending.popleft().result(), progress)
+    except BrokenPipeError:
+        return False
+    finally:
+        if not writer.stdin.closed:
+            try:
+                writer.stdin.close()
+            except BrokenPipeError:
+                pass
+        writer.wait()
+    return writer.returncode == 0
+
+
 def update_progress(progress: Any = None) -> None:
     process = psutil.Process(os.getpid())
     memory_usage = process.memory_info().rss / 1024 / 1024 / 1024
@@ -1,37 +1,165 @@
-from typing import Any, List, Callable
+from typing import Any, List, Callable, Optional, Tuple, Union
 import cv2
-import insightface
+import numpy
+import onnxruntime
 import threading
 import os
+from functools import lru_cache
+from insightface.utils import face_align
 
 
 from faceSwapLib.roop import globals
 from faceSwapLib.roop.processors.frame import core
 from faceSwapLib.roop.core import update_status
-from faceSwapLib.roop.face_analyser import get_one_face, get_many_faces, find_similar_face, check_similar_face2face
+from faceSwapLib.roop.face_analyser import get_one_face, get_many_faces, get_frame_faces, find_similar_face, get_normed_embeddings, match_faces, \
+                                          create_face_tracker, FaceTracker
+from faceSwapLib.roop.onnx_session import create_session_options, get_model_options, load_model
 from faceSwapLib.roop.face_reference import get_face_reference, set_face_reference, clear_face_reference
 from faceSwapLib.roop.typin import Face, Frame
 from faceSwapLib.roop.utilities import conditional_download, resolve_relative_path, is_image, is_video
 
 FACE_SWAPPER = None
+FACE_SWAPPER_PRECISION = None
+# onnxruntime session of the swapper that takes a batch of crops, False if the model can't
+FACE_SWAPPER_BATCH_SESSION = None
 THREAD_LOCK = threading.Lock()
 NAME = 'ROOP.FACE-SWAPPER'
+SIMILAR_FACE_DISTANCE = 0.5
+# pixels kept around the warped crop, so the erosion and the blur see its edge like on the full frame
+PASTE_BACK_PADDING = 2
+
+
+# PreparedSource of every source face of the current task, keyed by its embedding
+PREPARED_SOURCES = {}
+
+
+class PreparedSource:
+    """A source face with its inswapper latent, computed once and reused for every frame of a task."""
+
+    def __init__(self, face: Face, latent: numpy.ndarray) -> None:
+        self.face = face
+        self.latent = latent
+
+
+class SourceFaces(list):
+    """
+    [reference face, source face] pairs of a task with the reference embeddings stacked
+    once and the source faces prepared for the swapper.
+    """
+
+    def __init__(self, face_pairs: list[list[Face]]) -> None:
+        super().__init__(face_pairs)
+        self.reference_embeddings = get_normed_embeddings([face_pair[0] for face_pair in face_pairs])
+        self.prepared_sources = [prepare_source(face_pair[1]) for face_pair in face_pairs]
+
+
+def get_face_swapper_path(precision: Optional[str] = None) -> str:
+    """inswapper_128.onnx, or its int8 variant when the precision asks for it and the file exists."""
+    precision = precision or globals.model_precision
+    model_path = resolve_relative_path('../models/inswapper_128.onnx')
+    if precision == 'int8':
+        int8_model_path = resolve_relative_path('../models/inswapper_128_int8.onnx')
+        if os.path.isfile(int8_model_path):
+            return int8_model_path
+        print(f'Warning: {int8_model_path} not found, run faceSwapLib/quantize_models.py - using {model_path}')
+    return model_path
 
 
 def get_face_swapper() -> Any:
-    global FACE_SWAPPER
+    global FACE_SWAPPER, FACE_SWAPPER_PRECISION, FACE_SWAPPER_BATCH_SESSION
 
     with THREAD_LOCK:
-        if FACE_SWAPPER is None:
-            model_path = resolve_relative_path('../models/inswapper_128.onnx')
-            FACE_SWAPPER = insightface.model_zoo.get_model(model_path, providers=globals.execution_providers)
+        if FACE_SWAPPER is None or FACE_SWAPPER_PRECISION != globals.model_precision:
+            FACE_SWAPPER = load_model(get_face_swapper_path(), get_model_options(globals.session_options, 'swapper'),
+                                      globals.execution_providers, resolve_relative_path('../models/optimized'))
+            FACE_SWAPPER_PRECISION = globals.model_precision
+            FACE_SWAPPER_BATCH_SESSION = None
+            PREPARED_SOURCES.clear()
     return FACE_SWAPPER
 
 
 def clear_face_swapper() -> None:
-    global FACE_SWAPPER
+    global FACE_SWAPPER, FACE_SWAPPER_PRECISION, FACE_SWAPPER_BATCH_SESSION
 
     FACE_SWAPPER = None
+    FACE_SWAPPER_PRECISION = None
+    FACE_SWAPPER_BATCH_SESSION = None
+    clear_prepared_sources()
+
+
+def prepare_source(source_face: Union[Face, PreparedSource]) -> PreparedSource:
+    """Source face with its latent (normed embedding through the emap of the model, normalized), cached per task."""
+    if isinstance(source_face, PreparedSource):
+        return source_face
+
+    key = source_face.normed_embedding.tobytes()
+    prepared_source = PREPARED_SOURCES.get(key)
+    if prepared_source is None:
+        face_swapper = get_face_swapper()
+        latent = numpy.dot(source_face.normed_embedding.reshape((1, -1)), face_swapper.emap)
+        latent /= numpy.linalg.norm(latent)
+        prepared_source = PreparedSource(source_face, latent.astype(numpy.float32))
+        with THREAD_LOCK:
+            prepared_source = PREPARED_SOURCES.setdefault(key, prepared_source)
+    return prepared_source
+
+
+def clear_prepared_sources() -> None:
+    with THREAD_LOCK:
+        PREPARED_SOURCES.clear()
+
+
+def get_batch_session(face_swapper: Any) -> Optional[Any]:
+    """Session that runs many crops in one call, None if the swapper can only run one face at a time."""
+    global FACE_SWAPPER_BATCH_SESSION
+
+    with THREAD_LOCK:
+        if FACE_SWAPPER_BATCH_SESSION is None:
+            FACE_SWAPPER_BATCH_SESSION = create_batch_session(face_swapper) or False
+    return FACE_SWAPPER_BATCH_SESSION or None
+
+
+def create_batch_session(face_swapper: Any) -> Optional[Any]:
+    """
+    The released inswapper_128.onnx has its batch dimension fixed to 1. The graph itself
+    doesn't depend on it, so the inputs and outputs are made dynamic in memory and the
+    new session is checked against the original one before it is used. It then replaces
+    the session of the swapper, so the weights are loaded once and a single face runs
+    on it as a batch of 1.
+    """
+    inputs = face_swapper.session.get_inputs()
+    if all(not isinstance(model_input.shape[0], int) for model_input in inputs):
+        return face_swapper.session
+
+    try:
+        import onnx
+
+        model = onnx.load(face_swapper.model_file)
+        for value in model.graph.input:
+            if value.name in face_swapper.input_names:
+                value.type.tensor_type.shape.dim[0].dim_param = 'batch'
+        for value in model.graph.output:
+            value.type.tensor_type.shape.dim[0].dim_param = 'batch'
+        del model.graph.value_info[:]
+        session = onnxruntime.InferenceSession(model.SerializeToString(),
+                                               sess_options=create_session_options(get_model_options(globals.session_options, 'swapper')),
+                                               providers=face_swapper.session.get_providers())
+
+        blob = numpy.random.rand(2, 3, face_swapper.input_size[1], face_swapper.input_size[0]).astype(numpy.float32)
+        latent = numpy.random.rand(2, face_swapper.emap.shape[1]).astype(numpy.float32)
+        latent /= numpy.linalg.norm(latent, axis=1, keepdims=True)
+        batch_pred = session.run(face_swapper.output_names, {face_swapper.input_names[0]: blob, face_swapper.input_names[1]: latent})[0]
+        for index in range(2):
+            pred = face_swapper.session.run(face_swapper.output_names, {face_swapper.input_names[0]: blob[index:index + 1],
+                                                                        face_swapper.input_names[1]: latent[index:index + 1]})[0]
+            if not numpy.allclose(batch_pred[index], pred[0], atol=1e-3):
+                print('Warning: batched inswapper output differs, swapping one face at a time')
+                return None
+        face_swapper.session = session
+        return session
+    except Exception as e:
+        print(f'Warning: can\'t run inswapper in batches, swapping one face at a time - {e}')
+        return None
 
 
 def pre_check() -> bool:
@@ -72,13 +200,126 @@ def pre_start_for_multiple() -> bool:
     return True
 
 
+def warm_up() -> None:
+    get_face_swapper()
+
+
 def post_process() -> None:
-    clear_face_swapper()
+    if not globals.keep_models_loaded:
+        clear_face_swapper()
+    clear_prepared_sources()
     clear_face_reference()
 
 
-def swap_face(source_face: Face, target_face: Face, temp_frame: Frame) -> Frame:
-    return get_face_swapper().get(temp_frame, target_face, source_face, paste_back=True)
+def swap_face(source_face: Union[Face, PreparedSource], target_face: Face, temp_frame: Frame) -> Frame:
+    return swap_faces([temp_frame], [[(source_face, target_face)]])[0]
+
+
+def run_face_swapper(face_swapper: Any, crops: List[Frame], latents: numpy.ndarray) -> List[Frame]:
+    """Swapped 128x128 BGR crops, in batches of swap_batch_size when the model allows it."""
+    blob = cv2.dnn.blobFromImages(crops, 1.0 / face_swapper.input_std, face_swapper.input_size,
+                                  (face_swapper.input_mean, face_swapper.input_mean, face_swapper.input_mean), swapRB=True)
+    session = get_batch_session(face_swapper)
+    batch_size = max(globals.swap_batch_size or 1, 1) if session is not None else 1
+    session = session or face_swapper.session
+
+    preds = []
+    for start in range(0, len(blob), batch_size):
+        preds.append(session.run(face_swapper.output_names, {face_swapper.input_names[0]: blob[start:start + batch_size],
+                                                             face_swapper.input_names[1]: latents[start:start + batch_size]})[0])
+    preds = numpy.concatenate(preds).transpose((0, 2, 3, 1))
+    bgr_fakes = numpy.clip(255 * preds, 0, 255).astype(numpy.uint8)[:, :, :, ::-1]
+    return [numpy.ascontiguousarray(bgr_fake) for bgr_fake in bgr_fakes]
+
+
+@lru_cache(maxsize=128)
+def get_erode_kernel(size: int) -> numpy.ndarray:
+    return numpy.ones((size, size), numpy.uint8)
+
+
+@lru_cache(maxsize=128)
+def get_blur_kernel(size: int) -> numpy.ndarray:
+    return cv2.getGaussianKernel(2 * size + 1, 0, ktype=cv2.CV_32F)
+
+
+def paste_back(target_frame: Frame, bgr_fake: Frame, M: numpy.ndarray) -> None:
+    """
+    Blend a swapped crop into target_frame in place, with the mask of INSwapper.get(paste_back=True).
+
+    Only the bounding box of the crop in the frame is warped, eroded and blurred. The erosion
+    and blur kernels depend on the face size only, so they are cached by that size.
+    """
+    height, width = target_frame.shape[:2]
+    crop_size = bgr_fake.shape[0]
+    IM = cv2.invertAffineTransform(M)
+    corners = cv2.transform(numpy.array([[[0, 0]], [[crop_size, 0]], [[crop_size, crop_size]], [[0, crop_size]]], dtype=numpy.float32), IM).reshape(-1, 2)
+    x1, y1 = numpy.maximum(numpy.floor(corners.min(axis=0)).astype(int) - PASTE_BACK_PADDING, 0)
+    x2, y2 = numpy.minimum(numpy.ceil(corners.max(axis=0)).astype(int) + PASTE_BACK_PADDING, [width, height])
+    if x2 <= x1 or y2 <= y1:
+        return
+
+    # the same warp, moved to the top left corner of the roi
+    IM[0, 2] -= x1
+    IM[1, 2] -= y1
+    roi_size = (int(x2 - x1), int(y2 - y1))
+    bgr_fake = cv2.warpAffine(bgr_fake, IM, roi_size, borderValue=0.0)
+    img_mask = cv2.warpAffine(numpy.full((crop_size, crop_size), 255, dtype=numpy.float32), IM, roi_size, borderValue=0.0)
+    img_mask[img_mask > 20] = 255
+
+    mask_h_inds, mask_w_inds = numpy.where(img_mask == 255)
+    if len(mask_h_inds) == 0:
+        return
+    mask_h = numpy.max(mask_h_inds) - numpy.min(mask_h_inds)
+    mask_w = numpy.max(mask_w_inds) - numpy.min(mask_w_inds)
+    mask_size = int(numpy.sqrt(mask_h * mask_w))
+    img_mask = cv2.erode(img_mask, get_erode_kernel(max(mask_size // 10, 10)), iterations=1)
+    blur_kernel = get_blur_kernel(max(mask_size // 20, 5))
+    img_mask = cv2.sepFilter2D(img_mask, -1, blur_kernel, blur_kernel)
+    img_mask /= 255
+
+    img_mask = img_mask[:, :, numpy.newaxis]
+    roi = target_frame[y1:y2, x1:x2]
+    roi[:] = (img_mask * bgr_fake + (1 - img_mask) * roi.astype(numpy.float32)).astype(numpy.uint8)
+
+
+def paste_back_faces(target_frame: Frame, swapped_faces: List[Tuple[Frame, numpy.ndarray]]) -> Frame:
+    """Composite all swapped (crop, alignment matrix) faces of a frame into one copy of it."""
+    if not swapped_faces:
+        return target_frame
+    result = target_frame.copy()
+    for bgr_fake, M in swapped_faces:
+        paste_back(result, bgr_fake, M)
+    return result
+
+
+def swap_faces(frames: List[Frame], frames_swaps: List[List[Tuple[Union[Face, PreparedSource], Face]]]) -> List[Frame]:
+    """
+    Swap many faces over many frames with batched inswapper runs.
+
+        args:
+            frames: Frames to swap
+            frames_swaps: (source face or prepared source, target face) pairs of every frame
+
+        return:
+            The swapped frames, the input frames are not modified
+    """
+    face_swapper = get_face_swapper()
+    crops = []
+    latents = []
+    # all crops of a frame are cut before anything is pasted back into it
+    for frame_index, (frame, swaps) in enumerate(zip(frames, frames_swaps)):
+        for source_face, target_face in swaps:
+            aimg, M = face_align.norm_crop2(frame, target_face.kps, face_swapper.input_size[0])
+            crops.append((frame_index, aimg, M))
+            latents.append(prepare_source(source_face).latent)
+    if not crops:
+        return list(frames)
+
+    bgr_fakes = run_face_swapper(face_swapper, [aimg for _, aimg, _ in crops], numpy.concatenate(latents))
+    frames_swapped_faces = [[] for _ in frames]
+    for (frame_index, _, M), bgr_fake in zip(crops, bgr_fakes):
+        frames_swapped_faces[frame_index].append((bgr_fake, M))
+    return [paste_back_faces(frame, swapped_faces) for frame, swapped_faces in zip(frames, frames_swapped_faces)]
 
 
 def process_frame(source_face: Face, reference_face: Face, temp_frame: Frame) -> Frame:
@@ -120,42 +361,76 @@ def process_video(source_path: str, temp_frame_paths: List[str]) -> None:
     core.process_video(source_path, temp_frame_paths, process_frames)
 
 
-def process_frame_similar_face(source_faces: list[list[Face]], temp_frame: Frame) -> Frame:
-    many_faces = get_many_faces(temp_frame)
+def get_frame_swaps(source_faces: SourceFaces, many_faces: Optional[List[Face]]) -> List[Tuple[PreparedSource, Face]]:
+    """(prepared source, target face) pairs of the faces of a frame that match a reference face."""
+    swaps = []
+    if many_faces:
+        for face_index, source_index in match_faces(many_faces, source_faces.reference_embeddings, SIMILAR_FACE_DISTANCE):
+            swaps.append((source_faces.prepared_sources[source_index], many_faces[face_index]))
+    return swaps
 
-    for face in many_faces:
-        for source_face in source_faces:
-            if check_similar_face2face(face.embedding, source_face[0].embedding, 0.5):
-                temp_frame = swap_face(source_face[1], face, temp_frame)
-                continue
 
-    return temp_frame
+def process_frames_similar_face(source_faces: list[list[Face]], temp_frames: List[Frame], start_frame_number: Optional[int] = None,
+                                tracker: Optional[FaceTracker] = None) -> List[Frame]:
+    """Swap the matched faces of consecutive frames, all faces of the frames go through one batched swap."""
+    if not isinstance(source_faces, SourceFaces):
+        source_faces = SourceFaces(source_faces)
 
-def process_frames_multy_faces(source_pathes: list[list[str]], temp_frame_paths: List[str], update: Callable[[], None]) -> None:
-    source_faces = []
-    for source_path in source_pathes:
-        face_pair = []
-        face_pair.append(get_one_face(cv2.imread(source_path[0])))
-        face_pair.append(get_one_face(cv2.imread(source_path[1])))
-        source_faces.append(face_pair)
+    frames_swaps = []
+    for offset, temp_frame in enumerate(temp_frames):
+        frame_number = None if start_frame_number is None else start_frame_number + offset
+        frames_swaps.append(get_frame_swaps(source_faces, get_frame_faces(temp_frame, frame_number, tracker)))
 
-    for temp_frame_path in temp_frame_paths:
-        temp_frame = cv2.imread(temp_frame_path)
-        result = process_frame_similar_face(source_faces, temp_frame)
-        cv2.imwrite(temp_frame_path, result)
-        if update:
-            update()
+    return swap_faces(temp_frames, frames_swaps)
 
-def process_image_multy_faces(source_pathes: list[list[list[str]]], target_path: str, output_path: str) -> None:
+
+def process_window(source_faces: SourceFaces, window: core.FrameWindow) -> None:
+    """FrameChain step: swap the matched faces of the window with its shared detections."""
+    frames_swaps = [get_frame_swaps(source_faces, window.get_faces(index)) for index in range(len(window))]
+    window.frames = swap_faces(window.frames, frames_swaps)
+    if window.swapped_faces is None:
+        window.swapped_faces = [[] for _ in range(len(window))]
+    for index, swaps in enumerate(frames_swaps):
+        window.swapped_faces[index].extend(target_face for _, target_face in swaps)
+
+
+def process_frame_similar_face(source_faces: list[list[Face]], temp_frame: Frame, frame_number: Optional[int] = None,
+                               tracker: Optional[FaceTracker] = None) -> Frame:
+    return process_frames_similar_face(source_faces, [temp_frame], frame_number, tracker)[0]
+
+def get_source_faces(source_pathes: list[list[str]]) -> SourceFaces:
     source_faces = []
     for source_path in source_pathes:
         face_pair = []
         face_pair.append(get_one_face(cv2.imread(source_path[0])))
         face_pair.append(get_one_face(cv2.imread(source_path[1])))
-        source_faces.append(face_pair)
+        # a pair without a detected face can't be matched or swapped
+        if face_pair[0] is not None and face_pair[1] is not None:
+            source_faces.append(face_pair)
+    return SourceFaces(source_faces)
 
+def process_frames_multy_faces(source_pathes: list[list[str]], temp_frame_paths: List[str], update: Callable[[], None]) -> None:
+    source_faces = get_source_faces(source_pathes)
+    window_size = max(globals.frame_window_size or 1, 1)
+
+    for start in range(0, len(temp_frame_paths), window_size):
+        window_paths = temp_frame_paths[start:start + window_size]
+        temp_frames = [cv2.imread(temp_frame_path) for temp_frame_path in window_paths]
+        # faces are tracked between keyframes only inside a window of consecutive frames
+        window_start = core.get_window_start(window_paths)
+        tracker = create_face_tracker() if window_start is not None else None
+        results = process_frames_similar_face(source_faces, temp_frames, window_start, tracker)
+        for temp_frame_path, result in zip(window_paths, results):
+            cv2.imwrite(temp_frame_path, result)
+            if update:
+                update()
+
+def process_frame_multy_faces(source_pathes: list[list[str]], temp_frame: Frame, frame_number: Optional[int] = None) -> Frame:
+    return process_frame_similar_face(get_source_faces(source_pathes), temp_frame, frame_number)
+
+def process_image_multy_faces(source_pathes: list[list[list[str]]], target_path: str, output_path: str) -> None:
     target_frame = cv2.imread(target_path)
-    result = process_frame_similar_face(source_faces, target_frame)
+    result = process_frame_multy_faces(source_pathes, target_frame)
     cv2.imwrite(output_path, result)
 
 def process_video_multy_faces(source_pathes: list[list[list[str]]], temp_frame_paths: List[str]) -> None:
@@ -1,4 +1,5 @@
 import glob
+import json
 import mimetypes
 import os
 import platform
@@ -7,8 +8,10 @@ import ssl
 import subprocess
 import urllib
 from pathlib import Path
-from typing import List, Optional
+from typing import Iterator, List, Optional, Tuple
 from tqdm import tqdm
+import cv2
+import numpy
 
 from faceSwapLib.roop import globals
 from faceSwapLib import roop
@@ -62,6 +65,54 @@ def create_video(target_path: str, fps: float = 30) -> bool:
     return run_ffmpeg(commands)
 
 
+def detect_resolution(target_path: str) -> Tuple[int, int]:
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'stream=width,height:stream_tags=rotate:stream_side_data=rotation', '-of', 'json', target_path]
+    stream = json.loads(subprocess.check_output(command).decode())['streams'][0]
+    width, height = int(stream['width']), int(stream['height'])
+    # ffmpeg autorotates decoded frames, so the frame size follows the display orientation
+    rotation = stream.get('tags', {}).get('rotate')
+    for side_data in stream.get('side_data_list', []):
+        rotation = side_data.get('rotation', rotation)
+    if rotation is not None and abs(int(float(rotation))) % 180 == 90:
+        return height, width
+    return width, height
+
+
+def read_frames(target_path: str, fps: float, width: int, height: int) -> Iterator[numpy.ndarray]:
+    """Decode the video with ffmpeg into a pipe and yield raw BGR frames one by one."""
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', roop.globals.log_level, '-hwaccel', 'auto', '-i', target_path,
+                '-vf', 'fps=' + str(fps), '-f', 'rawvideo', '-pix_fmt', 'bgr24', 'pipe:1']
+    frame_size = width * height * 3
+    process = subprocess.Popen(commands, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=frame_size)
+    try:
+        while True:
+            buffer = process.stdout.read(frame_size)
+            if len(buffer) < frame_size:
+                break
+            yield numpy.frombuffer(buffer, numpy.uint8).reshape((height, width, 3)).copy()
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+
+def open_frame_writer(target_path: str, output_path: str, fps: float, width: int, height: int) -> subprocess.Popen:
+    """Start an ffmpeg encoder that reads raw BGR frames from stdin and muxes the target audio in the same pass."""
+    output_video_quality = (roop.globals.output_video_quality + 1) * 51 // 100
+    commands = ['ffmpeg', '-hide_banner', '-loglevel', roop.globals.log_level,
+                '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', 'pipe:0']
+    if not roop.globals.skip_audio:
+        commands.extend(['-i', target_path, '-map', '0:v:0', '-map', '1:a:0?', '-c:a', 'copy'])
+    commands.extend(['-c:v', roop.globals.output_video_encoder])
+    if roop.globals.output_video_encoder in ['libx264', 'libx265', 'libvpx']:
+        commands.extend(['-crf', str(output_video_quality)])
+    if roop.globals.output_video_encoder in ['h264_nvenc', 'hevc_nvenc']:
+        commands.extend(['-cq', str(output_video_quality)])
+    commands.extend(['-pix_fmt', 'yuv420p', '-vf', 'colorspace=bt709:iall=bt601-6-625:fast=1', '-y', output_path])
+    return subprocess.Popen(commands, stdin=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+
 def restore_audio(target_path: str, output_path: str) -> None:
     temp_output_path = get_temp_output_path(target_path)
     done = run_ffmpeg(['-i', temp_output_path, '-i', target_path, '-c:v', 'copy', '-map', '0:v:0', '-map', '1:a:0', '-y', output_path])
@@ -71,7 +122,22 @@ def restore_audio(target_path: str, output_path: str) -> None:
 
 def get_temp_frame_paths(target_path: str) -> List[str]:
     temp_directory_path = get_temp_directory_path(target_path)
-    return glob.glob((os.path.join(glob.escape(temp_directory_path), '*.' + roop.globals.temp_frame_format)))
+    temp_frame_paths = glob.glob((os.path.join(glob.escape(temp_directory_path), '*.' + roop.globals.temp_frame_format)))
+    return sorted(temp_frame_paths, key=get_temp_frame_order)
+
+
+def get_temp_frame_number(temp_frame_path: str) -> Optional[int]:
+    # ffmpeg numbers extracted frames from 1
+    try:
+        return int(os.path.splitext(os.path.basename(temp_frame_path))[0]) - 1
+    except ValueError:
+        return None
+
+
+def get_temp_frame_order(temp_frame_path: str) -> Tuple[bool, int, str]:
+    # by frame number, ffmpeg pads the names to 4 digits only, the names that aren't numbers go last
+    frame_number = get_temp_frame_number(temp_frame_path)
+    return frame_number is None, frame_number or 0, temp_frame_path
 
 
 def get_temp_directory_path(target_path: str) -> str:
@@ -142,6 +208,13 @@ def is_video(video_path: str) -> bool:
     return False
 
 
+def encode_image(frame, extension: str) -> bytes:
+    success, buffer = cv2.imencode(extension if extension.startswith('.') else '.' + extension, frame)
+    if not success:
+        raise ValueError(f'Can\'t encode image as {extension}')
+    return buffer.tobytes()
+
+
 def conditional_download(download_directory_path: str, urls: List[str]) -> None:
     if not os.path.exists(download_directory_path):
         os.makedirs(download_directory_path)
@@ -34,8 +34,16 @@ class ModulatedConv2d(nn.Module):
         demodulate (bool): Whether to demodulate in the conv layer. Default: True.
         sample_mode (str | None): Indicating 'upsample', 'downsample' or None. Default: None.
         eps (float): A value added to the denominator for numerical stability. Default: 1e-8.
+
+    Attributes:
+        fused_modconv (bool): Modulate the weights per sample and run one grouped conv (True), or
+            modulate the input and demodulate the output of a plain conv (False). Both give the
+            same result, the unfused path has no batch size baked into the graph, which ONNX
+            export with a dynamic batch needs. Default: True.
     """
 
+    fused_modconv = True
+
     def __init__(self,
                  in_channels,
                  out_channels,
@@ -72,6 +80,9 @@ class ModulatedConv2d(nn.Module):
         Returns:
             Tensor: Modulated tensor after convolution.
         """
+        if not self.fused_modconv:
+            return self._forward_unfused(x, style)
+
         b, c, h, w = x.shape  # c = c_in
         # weight modulation
         style = self.modulation(style).view(b, 1, c, 1, 1)
@@ -98,6 +109,23 @@ class ModulatedConv2d(nn.Module):
 
         return out
 
+    def _forward_unfused(self, x, style):
+        style = self.modulation(style)  # (b, c_in)
+        weight = self.weight[0]  # (c_out, c_in, k, k)
+
+        # upsample or downsample if necessary
+        if self.sample_mode == 'upsample':
+            x = F.interpolate(x, scale_factor=2, mode='bilinear', align_corners=False)
+        elif self.sample_mode == 'downsample':
+            x = F.interpolate(x, scale_factor=0.5, mode='bilinear', align_corners=False)
+
+        out = F.conv2d(x * style.unsqueeze(-1).unsqueeze(-1), weight, padding=self.padding)
+        if self.demodulate:
+            # same as the norm of the modulated weight: sum over c_in, k, k of (weight * style)^2
+            demod = torch.rsqrt(torch.matmul(style.pow(2), weight.pow(2).sum([2, 3]).t()) + self.eps)  # (b, c_out)
+            out = out * demod.unsqueeze(-1).unsqueeze(-1)
+        return out
+
     def __repr__(self):
         return (f'{self.__class__.__name__}(in_channels={self.in_channels}, out_channels={self.out_channels}, '
                 f'kernel_size={self.kernel_size}, demodulate={self.demodulate}, sample_mode={self.sample_mode})')
@@ -1,4 +1,6 @@
 import cv2
+import inspect
+import numpy as np
 import os
 import torch
 from basicsr.utils import img2tensor, tensor2img
@@ -13,6 +15,57 @@ from gfpgan.GFPGAN.archs.gfpganv1_clean_arch import GFPGANv1Clean
 ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+def load_weights(model_path):
+    """Load a checkpoint on the CPU, memory-mapped when torch supports it.
+
+    With torch >= 2.1 the file is mapped instead of read, so processes on one host that load
+    the same weights share the pages. Older torch versions and legacy (non zip) checkpoints
+    are read into memory as before.
+
+    Returns:
+        tuple: (checkpoint, mmapped)
+    """
+    if 'mmap' in inspect.signature(torch.load).parameters:
+        try:
+            return torch.load(model_path, map_location='cpu', mmap=True), True
+        except RuntimeError:
+            pass
+    return torch.load(model_path, map_location='cpu'), False
+
+
+class GFPGANOnnx():
+    """Exported GFPGAN graph run by ONNX Runtime, called like the torch network in GFPGANer.
+
+    Args:
+        onnx_path (str): Graph exported by scripts/export_gfpgan_onnx.py.
+        device (torch.device | str): cuda runs on the CUDA execution provider when it is available.
+        options (dict): Session options with the keys of faceSwapLib/roop/onnx_session.create_session_options,
+            like the other ONNX models of the swap. Default: None.
+        cache_directory_path (str): Where the optimized graph is cached with the optimized_model_cache
+            option. Default: None.
+    """
+
+    def __init__(self, onnx_path, device='cpu', options=None, cache_directory_path=None):
+        import onnxruntime
+        from faceSwapLib.roop.onnx_session import create_session
+
+        providers = ['CPUExecutionProvider']
+        if torch.device(device).type == 'cuda' and 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = create_session(onnx_path, options or {}, providers, cache_directory_path)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, x, return_rgb=False, weight=0.5, **kwargs):
+        output = self.session.run(None, {self.input_name: x.detach().cpu().numpy().astype(np.float32)})[0]
+        return torch.from_numpy(output), []
+
+    def eval(self):
+        return self
+
+    def to(self, device):
+        return self
+
+
 class GFPGANer():
     """Helper for restoration with GFPGAN.
 
@@ -27,16 +80,37 @@ class GFPGANer():
         arch (str): The GFPGAN architecture. Option: clean | original. Default: clean.
         channel_multiplier (int): Channel multiplier for large networks of StyleGAN2. Default: 2.
         bg_upsampler (nn.Module): The upsampler for the background. Default: None.
+        max_batch_size (int): The maximum number of faces restored in one forward pass. Default: 8.
+        backend (str): torch, or onnx to run a graph exported by scripts/export_gfpgan_onnx.py with
+            ONNX Runtime (clean architecture only). Default: torch.
+        onnx_path (str): The exported graph, next to the weights with the .onnx extension by default.
+        onnx_options (dict): Session options of the onnx backend, see GFPGANOnnx. Default: None.
     """
 
-    def __init__(self, model_path, upscale=2, arch='clean', channel_multiplier=2, bg_upsampler=None, device=None):
+    def __init__(self,
+                 model_path,
+                 upscale=2,
+                 arch='clean',
+                 channel_multiplier=2,
+                 bg_upsampler=None,
+                 device=None,
+                 max_batch_size=8,
+                 backend='torch',
+                 onnx_path=None,
+                 onnx_options=None):
         self.upscale = upscale
         self.bg_upsampler = bg_upsampler
+        self.max_batch_size = max_batch_size
+        self.backend = backend
 
         # initialize model
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
         # initialize the GFP-GAN
-        if arch == 'clean':
+        if backend == 'onnx':
+            if arch != 'clean':
+                raise ValueError(f'The onnx backend supports the clean architecture only, not {arch}.')
+            self.gfpgan = None
+        elif arch == 'clean':
             self.gfpgan = GFPGANv1Clean(
                 out_size=512,
                 num_style_feat=512,
@@ -86,25 +160,109 @@ class GFPGANer():
             device=self.device,
             model_rootpath='GFPGAN/weights')
 
+        if backend == 'onnx':
+            if onnx_path is None:
+                if model_path.startswith('https://'):
+                    model_path = os.path.join(ROOT_DIR, 'GFPGAN/weights', os.path.basename(model_path))
+                onnx_path = os.path.splitext(model_path)[0] + '.onnx'
+            if not os.path.isfile(onnx_path):
+                raise FileNotFoundError(f'{onnx_path} not found, export it with gfpgan/scripts/export_gfpgan_onnx.py')
+            self.gfpgan = GFPGANOnnx(onnx_path, self.device, onnx_options,
+                                     os.path.join(os.path.dirname(onnx_path), 'optimized'))
+            return
+
         if model_path.startswith('https://'):
             model_path = load_file_from_url(
                 url=model_path, model_dir=os.path.join(ROOT_DIR, 'GFPGAN/weights'), progress=True, file_name=None)
-        loadnet = torch.load(model_path)
+        loadnet, mmapped = load_weights(model_path)
         if 'params_ema' in loadnet:
             keyname = 'params_ema'
         else:
             keyname = 'params'
-        self.gfpgan.load_state_dict(loadnet[keyname], strict=True)
+        if mmapped and torch.device(self.device).type == 'cpu':
+            # keep the memory-mapped tensors as parameters instead of copying them
+            self.gfpgan.load_state_dict(loadnet[keyname], strict=True, assign=True)
+        else:
+            self.gfpgan.load_state_dict(loadnet[keyname], strict=True)
         self.gfpgan.eval()
         self.gfpgan = self.gfpgan.to(self.device)
 
     @torch.no_grad()
-    def enhance(self, img, has_aligned=False, only_center_face=False, paste_back=True, weight=0.5):
+    def restore_faces(self, cropped_faces, weight=0.5):
+        """Restore aligned 512x512 BGR faces in batches of at most max_batch_size.
+
+        If a batch fails (e.g. out of memory), its faces are restored one by one, and a face
+        that still fails is returned unchanged.
+
+        Args:
+            cropped_faces (list[ndarray]): Aligned faces.
+            weight (float): Passed to the GFPGAN network. Default: 0.5.
+
+        Returns:
+            list[ndarray]: Restored uint8 faces in the input order.
+        """
+        restored_faces = []
+        batch_size = max(self.max_batch_size, 1)
+        for start in range(0, len(cropped_faces), batch_size):
+            batch = cropped_faces[start:start + batch_size]
+            try:
+                restored_faces.extend(self._restore_batch(batch, weight))
+            except RuntimeError as error:
+                if len(batch) > 1:
+                    print(f'\tFailed batch inference for GFPGAN, restoring faces one by one: {error}.')
+                for cropped_face in batch:
+                    try:
+                        restored_faces.extend(self._restore_batch([cropped_face], weight))
+                    except RuntimeError as error:
+                        print(f'\tFailed inference for GFPGAN: {error}.')
+                        restored_faces.append(cropped_face.astype('uint8'))
+        return restored_faces
+
+    def _restore_batch(self, cropped_faces, weight):
+        # prepare data
+        cropped_faces_t = img2tensor([cropped_face / 255. for cropped_face in cropped_faces],
+                                     bgr2rgb=True,
+                                     float32=True)
+        for cropped_face_t in cropped_faces_t:
+            normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
+        cropped_faces_t = torch.stack(cropped_faces_t).to(self.device)
+
+        output = self.gfpgan(cropped_faces_t, return_rgb=False, weight=weight)[0]
+        # convert to images
+        return [tensor2img(face_output, rgb2bgr=True, min_max=(-1, 1)).astype('uint8') for face_output in output]
+
+    @torch.no_grad()
+    def enhance(self,
+                img,
+                has_aligned=False,
+                only_center_face=False,
+                paste_back=True,
+                weight=0.5,
+                face_landmarks=None,
+                face_bboxes=None):
+        """Restore the faces of an image.
+
+        Args:
+            face_landmarks (list[ndarray] | None): 5 point landmarks (eyes, nose, mouth corners) of the
+                faces to restore, e.g. the kps of insightface. If given, faces are not detected again and
+                only these faces are restored. Default: None.
+            face_bboxes (list[ndarray] | None): Bounding boxes matching face_landmarks. Default: None.
+        """
         self.face_helper.clean_all()
 
         if has_aligned:  # the inputs are already aligned
             img = cv2.resize(img, (512, 512))
             self.face_helper.cropped_faces = [img]
+        elif face_landmarks is not None:
+            self.face_helper.read_image(img)
+            self.face_helper.all_landmarks_5 = [
+                np.asarray(landmarks, dtype=np.float32).reshape(5, 2) for landmarks in face_landmarks
+            ]
+            if face_bboxes is not None:
+                self.face_helper.det_faces = [
+                    np.append(np.asarray(bbox, dtype=np.float32)[:4], 1.0) for bbox in face_bboxes
+                ]
+            self.face_helper.align_warp_face()
         else:
             self.face_helper.read_image(img)
             # get face landmarks for each face
@@ -115,26 +273,15 @@ class GFPGANer():
             self.face_helper.align_warp_face()
 
         # face restoration
-        for cropped_face in self.face_helper.cropped_faces:
-            # prepare data
-            cropped_face_t = img2tensor(cropped_face / 255., bgr2rgb=True, float32=True)
-            normalize(cropped_face_t, (0.5, 0.5, 0.5), (0.5, 0.5, 0.5), inplace=True)
-            cropped_face_t = cropped_face_t.unsqueeze(0).to(self.device)
-
-            try:
-                output = self.gfpgan(cropped_face_t, return_rgb=False, weight=weight)[0]
-                # convert to image
-                restored_face = tensor2img(output.squeeze(0), rgb2bgr=True, min_max=(-1, 1))
-            except RuntimeError as error:
-                print(f'\tFailed inference for GFPGAN: {error}.')
-                restored_face = cropped_face
-
-            restored_face = restored_face.astype('uint8')
+        for restored_face in self.restore_faces(self.face_helper.cropped_faces, weight=weight):
             self.face_helper.add_restored_face(restored_face)
 
         if not has_aligned and paste_back:
             # upsample the background
-            if self.bg_upsampler is not None:
+            if self.bg_upsampler is not None and getattr(self.bg_upsampler, 'roi_only', False):
+                # only the areas of the pasted faces go through the upsampler
+                bg_img = self.bg_upsampler.enhance(img, outscale=self.upscale, regions=self._get_face_regions(img))[0]
+            elif self.bg_upsampler is not None:
                 # Now only support RealESRGAN for upsampling background
                 bg_img = self.bg_upsampler.enhance(img, outscale=self.upscale)[0]
             else:
@@ -146,3 +293,18 @@ class GFPGANer():
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, restored_img
         else:
             return self.face_helper.cropped_faces, self.face_helper.restored_faces, None
+
+    def _get_face_regions(self, img):
+        """Bounding boxes (x1, y1, x2, y2) in img of the aligned face crops."""
+        height, width = img.shape[:2]
+        face_width, face_height = self.face_helper.face_size
+        corners = np.array([[[0, 0]], [[face_width, 0]], [[face_width, face_height]], [[0, face_height]]],
+                           dtype=np.float32)
+        regions = []
+        for affine_matrix in self.face_helper.affine_matrices:
+            face_corners = cv2.transform(corners, cv2.invertAffineTransform(affine_matrix)).reshape(-1, 2)
+            x1, y1 = np.maximum(np.floor(face_corners.min(axis=0)), 0).astype(int)
+            x2, y2 = np.minimum(np.ceil(face_corners.max(axis=0)), [width, height]).astype(int)
+            if x2 > x1 and y2 > y1:
+                regions.append((x1, y1, x2, y2))
+        return regions
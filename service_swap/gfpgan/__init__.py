@@ -0,0 +1,5 @@
+import sys
+from torchvision.transforms import functional
+
+# basicsr imports torchvision.transforms.functional_tensor, which newer torchvision releases removed
+sys.modules['torchvision.transforms.functional_tensor'] = functional
@@ -0,0 +1,142 @@
+import cv2
+import math
+import torch
+from realesrgan import RealESRGANer
+
+from gfpgan.GFPGAN.utils import load_weights
+
+
+class BatchedRealESRGANer(RealESRGANer):
+    """RealESRGANer that runs tiles of the same size through the model in batches.
+
+    The output is the same as with RealESRGANer.tile_process, which runs one tile per forward pass.
+    The weights are loaded with load_weights, memory-mapped like those of GFPGANer, instead of
+    the torch.load of RealESRGANer, so model_path has to be a local file.
+
+    Args:
+        tile_batch_size (int): The maximum number of tiles in one forward pass. Default: 4.
+        (others are the same as in RealESRGANer)
+    """
+
+    def __init__(self,
+                 scale,
+                 model_path,
+                 model,
+                 tile=0,
+                 tile_pad=10,
+                 pre_pad=10,
+                 half=False,
+                 device=None,
+                 tile_batch_size=4):
+        self.scale = scale
+        self.tile_size = tile
+        self.tile_pad = tile_pad
+        self.pre_pad = pre_pad
+        self.mod_scale = None
+        self.half = half
+        self.tile_batch_size = tile_batch_size
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu') if device is None else device
+
+        loadnet, mmapped = load_weights(model_path)
+        keyname = 'params_ema' if 'params_ema' in loadnet else 'params'
+        if mmapped and torch.device(self.device).type == 'cpu' and not half:
+            # keep the memory-mapped tensors as parameters instead of copying them
+            model.load_state_dict(loadnet[keyname], strict=True, assign=True)
+        else:
+            model.load_state_dict(loadnet[keyname], strict=True)
+        model.eval()
+        self.model = model.to(self.device)
+        if self.half:
+            self.model = self.model.half()
+
+    def tile_process(self):
+        batch, channel, height, width = self.img.shape
+        self.output = self.img.new_zeros((batch, channel, height * self.scale, width * self.scale))
+        tiles_x = math.ceil(width / self.tile_size)
+        tiles_y = math.ceil(height / self.tile_size)
+
+        # group the tiles by padded size, only those can be stacked into one batch
+        groups = {}
+        for y in range(tiles_y):
+            for x in range(tiles_x):
+                input_start_x = x * self.tile_size
+                input_end_x = min(input_start_x + self.tile_size, width)
+                input_start_y = y * self.tile_size
+                input_end_y = min(input_start_y + self.tile_size, height)
+                input_start_x_pad = max(input_start_x - self.tile_pad, 0)
+                input_end_x_pad = min(input_end_x + self.tile_pad, width)
+                input_start_y_pad = max(input_start_y - self.tile_pad, 0)
+                input_end_y_pad = min(input_end_y + self.tile_pad, height)
+                tile = (input_start_x, input_end_x, input_start_y, input_end_y,
+                        input_start_x_pad, input_end_x_pad, input_start_y_pad, input_end_y_pad)
+                size = (input_end_y_pad - input_start_y_pad, input_end_x_pad - input_start_x_pad)
+                groups.setdefault(size, []).append(tile)
+
+        for tiles in groups.values():
+            for start in range(0, len(tiles), max(self.tile_batch_size, 1)):
+                self._process_tiles(tiles[start:start + max(self.tile_batch_size, 1)])
+
+    def _process_tiles(self, tiles):
+        batch = self.img.shape[0]
+        input_tiles = torch.cat([self.img[:, :, tile[6]:tile[7], tile[4]:tile[5]] for tile in tiles])
+        try:
+            with torch.no_grad():
+                output_tiles = self.model(input_tiles)
+        except RuntimeError as error:
+            if len(tiles) == 1:
+                print('Error', error)
+                return
+            # e.g. out of memory, retry one tile at a time
+            for tile in tiles:
+                self._process_tiles([tile])
+            return
+
+        for index, tile in enumerate(tiles):
+            input_start_x, input_end_x, input_start_y, input_end_y, input_start_x_pad, _, input_start_y_pad, _ = tile
+            output_tile = output_tiles[index * batch:(index + 1) * batch]
+            output_start_x_tile = (input_start_x - input_start_x_pad) * self.scale
+            output_end_x_tile = output_start_x_tile + (input_end_x - input_start_x) * self.scale
+            output_start_y_tile = (input_start_y - input_start_y_pad) * self.scale
+            output_end_y_tile = output_start_y_tile + (input_end_y - input_start_y) * self.scale
+            output_start_x = input_start_x * self.scale
+            output_end_x = input_end_x * self.scale
+            output_start_y = input_start_y * self.scale
+            output_end_y = input_end_y * self.scale
+            self.output[:, :, output_start_y:output_end_y, output_start_x:output_end_x] = \
+                output_tile[:, :, output_start_y_tile:output_end_y_tile, output_start_x_tile:output_end_x_tile]
+
+
+class FaceRegionUpsampler():
+    """Background upsampler that runs the wrapped upsampler only around the restored faces.
+
+    The rest of the image is resized with Lanczos interpolation. GFPGANer passes the regions
+    of the pasted faces to enhance when roi_only is set.
+
+    Args:
+        upsampler (RealESRGANer): The upsampler used inside the face regions.
+        padding (float): Margin added around each region, relative to its size. Default: 0.1.
+    """
+
+    roi_only = True
+
+    def __init__(self, upsampler, padding=0.1):
+        self.upsampler = upsampler
+        self.padding = padding
+
+    def enhance(self, img, outscale=None, regions=None):
+        height, width = img.shape[:2]
+        outscale = outscale or self.upsampler.scale
+        output = cv2.resize(img, (int(width * outscale), int(height * outscale)), interpolation=cv2.INTER_LANCZOS4)
+
+        for x1, y1, x2, y2 in regions or []:
+            pad_x = int((x2 - x1) * self.padding)
+            pad_y = int((y2 - y1) * self.padding)
+            x1, y1 = max(int(x1) - pad_x, 0), max(int(y1) - pad_y, 0)
+            x2, y2 = min(int(x2) + pad_x, width), min(int(y2) + pad_y, height)
+            if x2 <= x1 or y2 <= y1:
+                continue
+            region = self.upsampler.enhance(img[y1:y2, x1:x2], outscale=outscale)[0]
+            output_x, output_y = int(x1 * outscale), int(y1 * outscale)
+            region = region[:output.shape[0] - output_y, :output.shape[1] - output_x]
+            output[output_y:output_y + region.shape[0], output_x:output_x + region.shape[1]] = region
+        return output, None
@@ -1,13 +1,29 @@
 import argparse
 import cv2
+from collections import OrderedDict
 import glob
 import numpy as np
 import os
+import threading
 import torch
 from basicsr.utils import imwrite
+from basicsr.utils.download_util import load_file_from_url
 
 from gfpgan.GFPGAN.utils import GFPGANer
 
+# Restorers built in this process by (version, upscale, bg_upsampler, bg_tile, bg_mode, device, backend, max_batch_size),
+# the least recently used one is evicted past MAX_RESTORERS
+RESTORERS = OrderedDict()
+MAX_RESTORERS = 2
+THREAD_LOCK = threading.Lock()
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+BG_MODES = ('auto', 'roi', 'full')
+BG_TILE_BATCH_SIZE = 4
+# onnxruntime options per model of the onnx backend, the "gfpgan" entry over the "default" one,
+# see faceSwapLib/roop/onnx_session.get_model_options. Set by the swap worker
+SESSION_OPTIONS = {}
+REALESRGAN_URL = 'https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth'
+
 
 def main():
     """Interface demo for GFPGAN (for users).
@@ -21,6 +37,7 @@ def main():
 
     parser.add_argument('--bg_upsampler', type=str, default='realesrgan', help='background upsampler. Default: realesrgan')
     parser.add_argument('--bg_tile', type=int, default=800, help='Tile size for background sampler, 0 for no tile during testing. Default: 800')
+    parser.add_argument('--bg_mode', type=str, default='auto', help='Background upsampling: auto | roi | full, auto skips it when upscale is 1. Default: auto')
     parser.add_argument('--only_center_face', action='store_true', help='Only restore the center face')
     parser.add_argument('--aligned', action='store_true', help='Input are aligned faces')
     parser.add_argument('--extention', type=str, default='auto', help='Image extension. Options: auto | jpg | png, auto means using the same extension as inputs. Default: auto')
@@ -35,10 +52,229 @@ def main():
             args.bg_tile,
             args.only_center_face,
             args.aligned,
-            args.extention,)
+            args.extention,
+            args.bg_mode,)
+
+
+def get_bg_upsampler(bg_upsampler="realesrgan", bg_tile:int=0, bg_mode:str="auto", upscale:int=1, device=None):
+    """
+    Build the background upsampler.
+
+        args:
+            bg_upsampler (str) = "realesrgan" : Name of the background upsampler, anything else disables it
+            bg_tile (int) = 0 : Tile size for background sampler, 0 for no tile
+            bg_mode (str) = "auto" : full - upsample the whole image,
+                                     roi - upsample only around the restored faces,
+                                     auto - skip the upsampling when upscale is 1, full otherwise
+            upscale (int) = 1 : The final upsampling scale of the image
+            device (str) = None : cuda or cpu, cuda when it is available by default
+        
+        return:
+            RealESRGANer: Background upsampler, tiles are run in batches
+            FaceRegionUpsampler: For the roi mode
+            None: If background upsampling is disabled
+    """
+    if bg_mode not in BG_MODES:
+        raise ValueError(f'Wrong background mode {bg_mode}, use one of {BG_MODES}.')
+    if bg_upsampler != 'realesrgan':
+        return None
+    # an x2 super resolution resized back to scale 1 costs the most and changes the least
+    if bg_mode == 'auto' and upscale == 1:
+        return None
+
+    device = get_device(device)
+    if device == 'cpu':  # CPU
+        proccesor_half = False
+    else:
+        proccesor_half = True
+        torch.backends.cudnn.benchmark = False  # Disabling cudnn heuristics might help (optional)
+
+
+    from basicsr.archs.rrdbnet_arch import RRDBNet
+    from gfpgan.bg_upsampler import BatchedRealESRGANer, FaceRegionUpsampler
+    model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
+    upsampler = BatchedRealESRGANer(
+        scale=2,
+        model_path=get_weights_path(REALESRGAN_URL),
+        model=model,
+        tile=bg_tile,
+        tile_pad=10,
+        pre_pad=0,
+        half=proccesor_half,  # need to set False in CPU mode and True in GPU mode
+        device=torch.device(device),
+        tile_batch_size=BG_TILE_BATCH_SIZE)
+
+    if bg_mode == 'roi':
+        return FaceRegionUpsampler(upsampler)
+    return upsampler
+
+
+def get_model_config(version:str="1.3"):
+    """
+    Map GFPGAN model version to its architecture and weights.
+
+        args:
+            version (str) = "1.3" : GFPGAN model version. Option: 1 | 1.2 | 1.3 | 1.4 | RestoreFormer
+        
+        return:
+            tuple: (arch, channel_multiplier, model_name, url)
+    """
+    if version == '1':
+        return 'original', 1, 'GFPGANv1', 'https://github.com/TencentARC/GFPGAN/releases/download/v0.1.0/GFPGANv1.pth'
+    elif version == '1.2':
+        return 'clean', 2, 'GFPGANCleanv1-NoCE-C2', 'https://github.com/TencentARC/GFPGAN/releases/download/v0.2.0/GFPGANCleanv1-NoCE-C2.pth'
+    elif version == '1.3':
+        return 'clean', 2, 'GFPGANv1.3', 'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.3.pth'
+    elif version == '1.4':
+        return 'clean', 2, 'GFPGANv1.4', 'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.4.pth'
+    elif version == 'RestoreFormer':
+        return 'RestoreFormer', 2, 'RestoreFormer', 'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.4/RestoreFormer.pth'
+    raise ValueError(f'Wrong model version {version}.')
+
+
+def get_weights_path(url:str):
+    """
+    Local path of the weights of the url, downloaded to GFPGAN/weights if they are not next to the package.
+    The weights are then memory-mapped, see GFPGAN.utils.load_weights.
+    """
+    file_name = os.path.basename(url)
+    for model_path in (os.path.join(ROOT_DIR, 'GFPGAN/weights', file_name), os.path.join('GFPGAN/weights', file_name)):
+        if os.path.isfile(model_path):
+            return model_path
+    return load_file_from_url(url=url, model_dir=os.path.join(ROOT_DIR, 'GFPGAN/weights'), progress=True, file_name=None)
+
+
+def download_weights(version:str="1.3", upscale:int=1, bg_upsampler="realesrgan", bg_mode:str="auto", backend:str="torch"):
+    """
+    Download the weights a restorer configuration loads, so processes building it later
+    only map the files instead of each downloading them.
+    """
+    if backend == 'torch':
+        get_weights_path(get_model_config(version)[3])
+    if bg_upsampler == 'realesrgan' and not (bg_mode == 'auto' and upscale == 1):
+        get_weights_path(REALESRGAN_URL)
+
+
+def get_onnx_options():
+    from faceSwapLib.roop.onnx_session import get_model_options
+
+    return get_model_options(SESSION_OPTIONS, 'gfpgan')
+
+
+def get_device(device=None):
+    if device is not None:
+        return str(device)
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def build_restorer(version:str="1.3", upscale:int=1, bg_upsampler="realesrgan", bg_tile:int=0, bg_mode:str="auto", device:str="cpu", backend:str="torch",
+                   max_batch_size:int=8):
+    arch, channel_multiplier, model_name, url = get_model_config(version)
+
+    # determine model paths, the weights are downloaded only if they are not next to the package
+    model_path = os.path.join(ROOT_DIR, 'GFPGAN/weights', model_name + '.pth')
+    if not os.path.isfile(model_path):
+        model_path = os.path.join('GFPGAN/weights', model_name + '.pth')
+    if not os.path.isfile(model_path):
+        # download pre-trained models from url
+        model_path = url
+
+    restorer = GFPGANer(
+        model_path=model_path,
+        upscale=upscale,
+        arch=arch,
+        channel_multiplier=channel_multiplier,
+        bg_upsampler=get_bg_upsampler(bg_upsampler, bg_tile, bg_mode, upscale, device),
+        device=torch.device(device),
+        max_batch_size=max_batch_size,
+        backend=backend,
+        onnx_options=get_onnx_options() if backend == 'onnx' else None)
+    restorer.gfpgan.eval()
+    return restorer
 
 
-def improve(input:str="input/" , output:str="result/", version:str="1.3", upscale:int=1, bg_upsampler="realesrgan", bg_tile:int=0, only_center_face:bool=False, aligned:bool=False, extention:str="auto"):
+def get_restorer(version:str="1.3", upscale:int=1, bg_upsampler="realesrgan", bg_tile:int=0, bg_mode:str="auto", device=None, backend:str="torch",
+                 max_batch_size:int=8):
+    """
+    Return a warm GFPGAN restorer for the configuration, building it only the first time.
+
+    Restorers are kept in a process-wide registry so that a long-lived worker doesn't reload
+    GFPGAN and RealESRGAN weights for every image. Only MAX_RESTORERS configurations are
+    kept, see evict_restorer and clear_restorer to free them earlier.
+
+        args:
+            device (str) = None : cuda or cpu, cuda when it is available by default
+            backend (str) = "torch" : torch, or onnx to run the graph exported by scripts/export_gfpgan_onnx.py
+            max_batch_size (int) = 8 : Faces restored in one forward pass by restore_faces
+            (others are the same as in improve)
+    """
+    key = (version, upscale, bg_upsampler, bg_tile, bg_mode, get_device(device), backend, max_batch_size)
+
+    with THREAD_LOCK:
+        restorer = RESTORERS.get(key)
+        if restorer is None:
+            restorer = build_restorer(*key)
+            RESTORERS[key] = restorer
+            while len(RESTORERS) > MAX_RESTORERS:
+                RESTORERS.popitem(last=False)
+        else:
+            RESTORERS.move_to_end(key)
+    return restorer
+
+
+def evict_restorer(version:str="1.3", upscale:int=1, bg_upsampler="realesrgan", bg_tile:int=0, bg_mode:str="auto", device=None, backend:str="torch",
+                   max_batch_size:int=8):
+    """
+    Drop the restorer of one configuration from the registry.
+
+        return:
+            bool: True if it was loaded
+    """
+    key = (version, upscale, bg_upsampler, bg_tile, bg_mode, get_device(device), backend, max_batch_size)
+
+    with THREAD_LOCK:
+        restorer = RESTORERS.pop(key, None)
+    if restorer is not None and torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return restorer is not None
+
+
+def clear_restorer():
+    with THREAD_LOCK:
+        RESTORERS.clear()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def improve_frame(img, version:str="1.3", upscale:int=1, bg_upsampler="realesrgan", bg_tile:int=0, only_center_face:bool=False, aligned:bool=False, face_landmarks=None, face_bboxes=None, bg_mode:str="auto", backend:str="torch"):
+    """
+    Restore faces on an already decoded BGR image.
+
+        args:
+            img (np.ndarray): BGR image
+            face_landmarks (list) = None : 5 point kps of the faces to restore, skips the face detection of GFPGAN
+            face_bboxes (list) = None : Bounding boxes of the same faces
+            (others are the same as in improve)
+        
+        return:
+            np.ndarray: Restored image, or the input image if nothing was restored
+    """
+    restorer = get_restorer(version, upscale, bg_upsampler, bg_tile, bg_mode, backend=backend)
+    _, _, restored_img = restorer.enhance(
+        img,
+        has_aligned=aligned,
+        only_center_face=only_center_face,
+        paste_back=True,
+        weight=0.5,
+        face_landmarks=face_landmarks,
+        face_bboxes=face_bboxes)
+
+    if restored_img is None:
+        return img
+    return restored_img
+
+
+def improve(input:str="input/" , output:str="result/", version:str="1.3", upscale:int=1, bg_upsampler="realesrgan", bg_tile:int=0, only_center_face:bool=False, aligned:bool=False, extention:str="auto", bg_mode:str="auto"):
 
 
     # ------------------------ input & output ------------------------
@@ -56,83 +292,14 @@ def improve(input:str="input/" , output:str="result/", version:str="1.3", upscal
     except Exception as e:
         print(f"Error: can't get files to proccess because of - {e}")
 
-    # ------------------------ set up background upsampler ------------------------
-    try:
-        if bg_upsampler == 'realesrgan':
-
-            if not torch.cuda.is_available():  # CPU
-                proccesor_half = False
-            else:
-                proccesor_half = True
-                torch.backends.cudnn.benchmark = False  # Disabling cudnn heuristics might help (optional)
-
-
-            from basicsr.archs.rrdbnet_arch import RRDBNet
-            from realesrgan import RealESRGANer
-            model = RRDBNet(num_in_ch=3, num_out_ch=3, num_feat=64, num_block=23, num_grow_ch=32, scale=2)
-            bg_upsampler = RealESRGANer(
-                scale=2,
-                model_path='https://github.com/xinntao/Real-ESRGAN/releases/download/v0.2.1/RealESRGAN_x2plus.pth',
-                model=model,
-                tile=bg_tile,
-                tile_pad=10,
-                pre_pad=0,
-                half=proccesor_half)  # need to set False in CPU mode and True in GPU mode
-        else:
-            bg_upsampler = None
-    except Exception as e:
-        print(f"Error: can't set up background upsampler because of - {e}")
-
     # ------------------------ set up GFPGAN restorer ------------------------
     try:
-        if version == '1':
-            arch = 'original'
-            channel_multiplier = 1
-            model_name = 'GFPGANv1'
-            url = 'https://github.com/TencentARC/GFPGAN/releases/download/v0.1.0/GFPGANv1.pth'
-        elif version == '1.2':
-            arch = 'clean'
-            channel_multiplier = 2
-            model_name = 'GFPGANCleanv1-NoCE-C2'
-            url = 'https://github.com/TencentARC/GFPGAN/releases/download/v0.2.0/GFPGANCleanv1-NoCE-C2.pth'
-        elif version == '1.3':
-            arch = 'clean'
-            channel_multiplier = 2
-            model_name = 'GFPGANv1.3'
-            url = 'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.3.pth'
-        elif version == '1.4':
-            arch = 'clean'
-            channel_multiplier = 2
-            model_name = 'GFPGANv1.4'
-            url = 'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.0/GFPGANv1.4.pth'
-        elif version == 'RestoreFormer':
-            arch = 'RestoreFormer'
-            channel_multiplier = 2
-            model_name = 'RestoreFormer'
-            url = 'https://github.com/TencentARC/GFPGAN/releases/download/v1.3.4/RestoreFormer.pth'
-        else:
-            raise ValueError(f'Wrong model version {version}.')
-    except ValueError:
+        restorer = get_restorer(version, upscale, bg_upsampler, bg_tile, bg_mode)
+    except ValueError as e:
         print(f"Error: can't set up GPFGAN network because of wrong version - {e}")
     except Exception as e:
         print(f"Error: can't set up GPFGAN network because of - {e}")
 
-    # determine model paths
-    try:
-        model_path = os.path.join('GFPGAN/weights', model_name + '.pth')
-        if not os.path.isfile(model_path):
-            # download pre-trained models from url
-            model_path = url
-
-        restorer = GFPGANer(
-            model_path=model_path,
-            upscale=upscale,
-            arch=arch,
-            channel_multiplier=channel_multiplier,
-            bg_upsampler=bg_upsampler)
-    except Exception as e:
-        print(f"Error: can't get weights for GPFGAN network because of - {e}")
-
     # ------------------------ restore ------------------------
     # try:
     for img_path in img_list:
@@ -163,8 +330,6 @@ def improve(input:str="input/" , output:str="result/", version:str="1.3", upscal
                 imwrite(restored_img, output)
                 print(f'Results are in the [{output}] file.')
 
-    torch.cuda.empty_cache() 
-
     # except Exception as e:
         # print(f"Error: can't procces and restore photos because of - {e}")
 
@@ -0,0 +1,93 @@
+import argparse
+import os
+import torch
+from torch import nn
+
+from gfpgan.GFPGAN.archs.gfpganv1_clean_arch import GFPGANv1Clean
+from gfpgan.GFPGAN.archs.stylegan2_clean_arch import ModulatedConv2d
+from gfpgan.GFPGAN.utils import load_weights
+
+
+class GFPGANExportWrapper(nn.Module):
+    """Restored image only, with the stored noise instead of random noise so the graph is deterministic."""
+
+    def __init__(self, gfpgan):
+        super(GFPGANExportWrapper, self).__init__()
+        self.gfpgan = gfpgan
+
+    def forward(self, x):
+        return self.gfpgan(x, return_rgb=False, randomize_noise=False)[0]
+
+
+def load_gfpgan_clean(model_path, channel_multiplier=2):
+    """GFPGANv1Clean with the weights of a GFPGANv1.3 / v1.4 checkpoint, in eval mode on the CPU."""
+    gfpgan = GFPGANv1Clean(
+        out_size=512,
+        num_style_feat=512,
+        channel_multiplier=channel_multiplier,
+        decoder_load_path=None,
+        fix_decoder=False,
+        num_mlp=8,
+        input_is_latent=True,
+        different_w=True,
+        narrow=1,
+        sft_half=True)
+    loadnet, _ = load_weights(model_path)
+    keyname = 'params_ema' if 'params_ema' in loadnet else 'params'
+    gfpgan.load_state_dict(loadnet[keyname], strict=True)
+    return gfpgan.eval()
+
+
+def export_gfpgan_onnx(gfpgan, output_path, opset_version=14):
+    """Export a GFPGANv1Clean to ONNX with a dynamic batch dimension.
+
+    The modulated convolutions are switched to their unfused form for the export: the fused one
+    runs a grouped conv with groups equal to the batch size, which would fix the batch in the graph.
+
+    Args:
+        gfpgan (GFPGANv1Clean): The network to export.
+        output_path (str): Path of the ONNX file.
+        opset_version (int): ONNX opset. Default: 14.
+    """
+    modulated_convs = [module for module in gfpgan.modules() if isinstance(module, ModulatedConv2d)]
+    for module in modulated_convs:
+        module.fused_modconv = False
+    try:
+        out_size = 2**gfpgan.log_size
+        dummy_input = torch.rand(1, 3, out_size, out_size)
+        with torch.no_grad():
+            torch.onnx.export(
+                GFPGANExportWrapper(gfpgan).eval(),
+                dummy_input,
+                output_path,
+                input_names=['input'],
+                output_names=['output'],
+                dynamic_axes={'input': {0: 'batch'}, 'output': {0: 'batch'}},
+                opset_version=opset_version,
+                do_constant_folding=True)
+    finally:
+        for module in modulated_convs:
+            module.fused_modconv = True
+
+
+def main(args):
+    gfpgan = load_gfpgan_clean(args.input, args.channel_multiplier)
+    output = args.output or os.path.splitext(args.input)[0] + '.onnx'
+    export_gfpgan_onnx(gfpgan, output, args.opset)
+    print(f'Exported {args.input} to {output}')
+
+
+if __name__ == '__main__':
+    """Export GFPGANv1.3 / v1.4 (clean architecture) to ONNX for the onnx backend of GFPGANer.
+
+    python -m gfpgan.scripts.export_gfpgan_onnx --input gfpgan/GFPGAN/weights/GFPGANv1.4.pth
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--input', type=str, default='GFPGAN/weights/GFPGANv1.4.pth', help='Path to the clean checkpoint')
+    parser.add_argument(
+        '--output', type=str, default=None, help='Path to the ONNX file, next to the checkpoint by default')
+    parser.add_argument('--channel_multiplier', type=int, default=2, help='Channel multiplier of the StyleGAN2 decoder')
+    parser.add_argument('--opset', type=int, default=14, help='ONNX opset version')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,62 @@
+import pytest
+import torch
+
+from gfpgan.bg_upsampler import BatchedRealESRGANer
+from gfpgan.GFPGAN.utils import GFPGANer
+
+
+class CountingGFPGAN(torch.nn.Module):
+    """Stands in for the network: returns its input and records the batch sizes it saw."""
+
+    def __init__(self, fail_batches=False):
+        super().__init__()
+        self.batch_sizes = []
+        self.fail_batches = fail_batches
+
+    def forward(self, x, return_rgb=False, weight=0.5):
+        self.batch_sizes.append(x.shape[0])
+        if self.fail_batches and x.shape[0] > 1:
+            raise RuntimeError('CUDA out of memory')
+        return x, None
+
+
+@pytest.fixture
+def build_restorer():
+    """Returns a factory for GFPGANer instances on the CPU around a CountingGFPGAN."""
+
+    def build(max_batch_size, fail_batches=False):
+        restorer = GFPGANer.__new__(GFPGANer)
+        restorer.gfpgan = CountingGFPGAN(fail_batches=fail_batches)
+        restorer.device = torch.device('cpu')
+        restorer.max_batch_size = max_batch_size
+        return restorer
+
+    return build
+
+
+class NearestUpsampler(torch.nn.Module):
+    """Stands in for RRDBNet: x2 nearest upsampling, records the batch sizes it saw."""
+
+    def __init__(self):
+        super().__init__()
+        self.batch_sizes = []
+
+    def forward(self, x):
+        self.batch_sizes.append(x.shape[0])
+        return torch.nn.functional.interpolate(x, scale_factor=2, mode='nearest')
+
+
+@pytest.fixture
+def build_upsampler():
+    """Returns a factory for x2 BatchedRealESRGANer instances around a NearestUpsampler."""
+
+    def build(tile_size, tile_batch_size):
+        upsampler = BatchedRealESRGANer.__new__(BatchedRealESRGANer)
+        upsampler.model = NearestUpsampler()
+        upsampler.scale = 2
+        upsampler.tile_size = tile_size
+        upsampler.tile_pad = 4
+        upsampler.tile_batch_size = tile_batch_size
+        return upsampler
+
+    return build
@@ -0,0 +1,53 @@
+import numpy as np
+import torch
+
+from gfpgan.bg_upsampler import BatchedRealESRGANer, FaceRegionUpsampler
+
+
+def test_batched_tile_process(build_upsampler):
+    img = torch.rand(1, 3, 50, 70)
+    upsampler = build_upsampler(tile_size=16, tile_batch_size=4)
+    upsampler.img = img
+    upsampler.tile_process()
+
+    assert torch.equal(upsampler.output, torch.nn.functional.interpolate(img, scale_factor=2, mode='nearest'))
+    # 4 x 5 tiles, in fewer forward passes than tiles
+    assert sum(upsampler.model.batch_sizes) == 20
+    assert len(upsampler.model.batch_sizes) < 20
+    assert max(upsampler.model.batch_sizes) <= 4
+
+
+class _RegionUpsampler():
+    scale = 2
+
+    def __init__(self):
+        self.calls = []
+
+    def enhance(self, img, outscale=None):
+        self.calls.append(img.shape)
+        return np.full((img.shape[0] * 2, img.shape[1] * 2, 3), 255, dtype=np.uint8), None
+
+
+def test_face_region_upsampler():
+    img = np.zeros((100, 200, 3), dtype=np.uint8)
+    upsampler = FaceRegionUpsampler(_RegionUpsampler(), padding=0)
+    output, _ = upsampler.enhance(img, outscale=2, regions=[(10, 20, 30, 60)])
+
+    assert output.shape == (200, 400, 3)
+    assert upsampler.upsampler.calls == [(40, 20, 3)]
+    assert (output[40:120, 20:60] == 255).all()
+    assert output[:40].max() == 0 and output[120:].max() == 0
+
+
+def test_batched_realesrganer_loads_local_weights(tmp_path):
+    torch.manual_seed(0)
+    weights = torch.nn.Conv2d(3, 3, 3, padding=1)
+    model_path = str(tmp_path / 'weights.pth')
+    torch.save({'params_ema': weights.state_dict()}, model_path)
+
+    upsampler = BatchedRealESRGANer(
+        scale=1, model_path=model_path, model=torch.nn.Conv2d(3, 3, 3, padding=1), device=torch.device('cpu'))
+    for name, value in weights.state_dict().items():
+        assert torch.equal(upsampler.model.state_dict()[name], value)
+    assert not upsampler.model.training
+    assert upsampler.tile_batch_size == 4
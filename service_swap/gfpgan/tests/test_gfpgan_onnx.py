@@ -0,0 +1,74 @@
+import numpy as np
+import os
+import pytest
+import torch
+
+from gfpgan.GFPGAN.archs.gfpganv1_clean_arch import GFPGANv1Clean
+from gfpgan.GFPGAN.archs.stylegan2_clean_arch import ModulatedConv2d
+from gfpgan.scripts.export_gfpgan_onnx import export_gfpgan_onnx
+from gfpgan.GFPGAN.utils import GFPGANOnnx
+
+
+def _build_gfpgan():
+    torch.manual_seed(0)
+    return GFPGANv1Clean(
+        out_size=32,
+        num_style_feat=512,
+        channel_multiplier=1,
+        decoder_load_path=None,
+        fix_decoder=False,
+        num_mlp=8,
+        input_is_latent=True,
+        different_w=True,
+        narrow=1,
+        sft_half=True).eval()
+
+
+def test_modulated_conv_unfused():
+    """The unfused path used for the export gives the output of the grouped conv."""
+    torch.manual_seed(0)
+    for sample_mode in (None, 'upsample', 'downsample'):
+        conv = ModulatedConv2d(8, 16, 3, num_style_feat=32, demodulate=True, sample_mode=sample_mode)
+        x = torch.rand(3, 8, 16, 16)
+        style = torch.rand(3, 32)
+        with torch.no_grad():
+            fused = conv(x, style)
+            conv.fused_modconv = False
+            unfused = conv(x, style)
+        assert torch.allclose(fused, unfused, atol=1e-5)
+
+
+def test_gfpgan_onnx_parity(tmp_path):
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+
+    gfpgan = _build_gfpgan()
+    onnx_path = str(tmp_path / 'gfpgan.onnx')
+    export_gfpgan_onnx(gfpgan, onnx_path)
+
+    # a batch size other than the one of the export
+    img = torch.rand(3, 3, 32, 32) * 2 - 1
+    with torch.no_grad():
+        expected = gfpgan(img, return_rgb=False, randomize_noise=False)[0]
+    output, _ = GFPGANOnnx(onnx_path)(img)
+
+    assert output.shape == (3, 3, 32, 32)
+    np.testing.assert_allclose(output.numpy(), expected.numpy(), atol=1e-4)
+
+
+def test_gfpgan_onnx_session_options(tmp_path):
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+
+    gfpgan = _build_gfpgan()
+    onnx_path = str(tmp_path / 'gfpgan.onnx')
+    export_gfpgan_onnx(gfpgan, onnx_path)
+
+    # the options of the shared onnx_session helper, the optimized graph is cached for the next session
+    options = {'intra_op_threads': 1, 'optimized_model_cache': True}
+    cache_path = str(tmp_path / 'optimized')
+    img = torch.rand(1, 3, 32, 32) * 2 - 1
+    output, _ = GFPGANOnnx(onnx_path, options=options, cache_directory_path=cache_path)(img)
+    assert len(os.listdir(cache_path)) == 1
+    cached_output, _ = GFPGANOnnx(onnx_path, options=options, cache_directory_path=cache_path)(img)
+    np.testing.assert_allclose(cached_output.numpy(), output.numpy(), atol=1e-5)
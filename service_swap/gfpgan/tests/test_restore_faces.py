@@ -0,0 +1,19 @@
+import numpy as np
+
+
+def test_gfpganer_restore_faces_batch(build_restorer):
+    faces = [np.full((512, 512, 3), value, dtype=np.uint8) for value in (0, 64, 128, 192, 255)]
+
+    restorer = build_restorer(max_batch_size=2)
+    restored_faces = restorer.restore_faces(faces)
+    assert restorer.gfpgan.batch_sizes == [2, 2, 1]
+    assert len(restored_faces) == len(faces)
+    for face, restored_face in zip(faces, restored_faces):
+        assert restored_face.dtype == np.uint8
+        assert np.abs(restored_face.astype(int) - face.astype(int)).max() <= 1
+
+    # a failing batch degrades to one face per forward pass
+    restorer = build_restorer(max_batch_size=4, fail_batches=True)
+    restored_faces = restorer.restore_faces(faces)
+    assert restorer.gfpgan.batch_sizes == [4, 1, 1, 1, 1, 1]
+    assert len(restored_faces) == len(faces)
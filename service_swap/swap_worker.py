@@ -0,0 +1,335 @@
+import gc
+import json
+import multiprocessing
+import os
+import psutil
+import queue
+import subprocess
+import threading
+
+EXECUTION_PROVIDER = ['cuda']
+# Videos get their swapped faces restored by GFPGAN in the same pass over the frames,
+# images are restored afterwards by the improver, which also upsamples the background
+IMAGE_FRAME_PROCESSORS = ['face_swapper']
+VIDEO_FRAME_PROCESSORS = ['face_swapper', 'face_enhancer'] if int(os.environ.get('swap_video_enhance', 1)) else ['face_swapper']
+IMPROVER_BG_TILE = 800
+# auto skips the background super resolution of images at scale 1, roi runs it around the faces only
+IMPROVER_BG_MODE = os.environ.get('swap_improver_bg_mode', 'auto')
+# onnx runs GFPGAN with onnxruntime, the graph has to be exported with gfpgan/scripts/export_gfpgan_onnx.py
+IMPROVER_BACKEND = os.environ.get('swap_improver_backend', 'torch')
+# int8 loads the quantized models of faceSwapLib/quantize_models.py, for CPU-only nodes
+MODEL_PRECISION = os.environ.get('swap_model_precision', 'fp32')
+# onnxruntime options per model as json, e.g. {"default": {"intra_op_threads": 4}, "swapper": {"optimized_model_cache": true}}
+# with the keys of faceSwapLib/roop/onnx_session.create_session_options, so sessions don't fight over the cores.
+# "gfpgan" is the restorer of the onnx improver backend
+SESSION_OPTIONS = json.loads(os.environ.get('swap_session_options', '{}'))
+# Frames in flight between the ffmpeg decoder and encoder of a video task
+FRAME_QUEUE_SIZE = int(os.environ.get('swap_frame_queue_size', 32))
+# Consecutive frames handed to one thread, faces are tracked between keyframes inside it
+FRAME_WINDOW_SIZE = int(os.environ.get('swap_frame_window_size', 8))
+# Run the face detector on every n-th frame only, 1 detects on every frame
+DETECTION_INTERVAL = int(os.environ.get('swap_detection_interval', 5))
+
+
+def load_models():
+    """Load every model a swap task needs so the following tasks reuse them."""
+    from faceSwapLib.roop import core
+    from gfpgan import improver
+
+    improver.SESSION_OPTIONS = SESSION_OPTIONS
+    core.warm_up(frame_processor=VIDEO_FRAME_PROCESSORS, execution_provider=EXECUTION_PROVIDER, model_precision=MODEL_PRECISION,
+                 session_options=SESSION_OPTIONS)
+    improver.get_restorer(bg_tile=IMPROVER_BG_TILE, bg_mode=IMPROVER_BG_MODE, backend=IMPROVER_BACKEND)
+
+
+def download_models():
+    """Download the restorer weights once in this process, before any worker loads them."""
+    from gfpgan import improver
+
+    improver.download_weights(bg_mode=IMPROVER_BG_MODE, backend=IMPROVER_BACKEND)
+    if 'face_enhancer' in VIDEO_FRAME_PROCESSORS:
+        improver.download_weights(version='1.4', bg_upsampler=None)
+
+
+def release_models():
+    from faceSwapLib.roop import core
+    from gfpgan import improver
+
+    core.release_models()
+    improver.clear_restorer()
+    gc.collect()
+
+
+def swap_face(face_source, source_path, swaper_output_path, watermark, watermark_path, is_image):
+    from faceSwapLib.roop import core
+    frame_processor = IMAGE_FRAME_PROCESSORS if is_image else VIDEO_FRAME_PROCESSORS
+    return core.run_multiple(face_source, source_path, swaper_output_path, watermark, watermark_path, frame_processor=frame_processor,
+                             is_it_image=is_image, execution_provider=EXECUTION_PROVIDER,
+                             stream_frames=True, frame_queue_size=FRAME_QUEUE_SIZE,
+                             frame_window_size=FRAME_WINDOW_SIZE, detection_interval=DETECTION_INTERVAL)
+
+
+def swap_image(face_source, source_path, watermark, watermark_path, extension):
+    """
+    Swap, restore and watermark an image template in memory.
+
+        return:
+            bytes: The result encoded once with the template extension
+            None: If the swap failed
+    """
+    from faceSwapLib.roop import core
+    from faceSwapLib.roop.utilities import encode_image
+    from gfpgan import improver
+
+    result = core.swap_image(face_source, source_path, frame_processor=IMAGE_FRAME_PROCESSORS, execution_provider=EXECUTION_PROVIDER)
+    if result is None:
+        return None
+
+    frame, swapped_faces = result
+    # restore only the swapped faces, at the kps the swap already found
+    if swapped_faces is not None:
+        frame = improver.improve_frame(frame, bg_tile=IMPROVER_BG_TILE, bg_mode=IMPROVER_BG_MODE, backend=IMPROVER_BACKEND,
+                                       face_landmarks=[face.kps for face in swapped_faces],
+                                       face_bboxes=[face.bbox for face in swapped_faces])
+    else:
+        frame = improver.improve_frame(frame, bg_tile=IMPROVER_BG_TILE, bg_mode=IMPROVER_BG_MODE, backend=IMPROVER_BACKEND)
+    if watermark:
+        frame = core.add_watermark_to_frame(frame, os.path.abspath(watermark_path))
+    return encode_image(frame, extension)
+
+
+def run_job(job):
+    """
+    Run one swap task with the models that are already loaded in this process.
+
+        args:
+            job (dict): face_source, source_path, output_file_path, watermark, watermark_path, is_image
+
+        return:
+            tuple: (success, data) where data is the encoded image for image templates,
+                   for videos the result is written to output_file_path and data is None
+    """
+    try:
+        if job['is_image']:
+            data = swap_image(job['face_source'],
+                              job['source_path'],
+                              job['watermark'],
+                              job['watermark_path'],
+                              os.path.splitext(job['output_file_path'])[1])
+            return data is not None, data
+
+        result = swap_face(job['face_source'],
+                           job['source_path'],
+                           job['output_file_path'],
+                           job['watermark'],
+                           job['watermark_path'],
+                           is_image=job['is_image'])
+        return result, None
+    # roop calls sys.exit on rejected content, it must not take the worker down with it
+    except (Exception, SystemExit) as e:
+        print(f'Error: swap job failed: {e}')
+        return False, None
+
+
+def serve(connection):
+    """Child process loop of an isolated worker: load models once, then run jobs until told to stop."""
+    load_models()
+
+    while True:
+        job = connection.recv()
+        if job is None:
+            break
+        connection.send(run_job(job))
+
+    connection.close()
+
+
+class SwapWorker():
+    """
+    Long-lived swap worker that keeps models resident across tasks.
+
+    By default jobs run in the calling process. With isolated=True they run in one
+    child process that is reused between tasks and restarted if it crashes. In both
+    modes the worker is recycled after max_tasks jobs, 0 disables the limit. An isolated
+    worker is also recycled once its child's RSS passes max_rss_mb. In the calling process
+    that limit is ignored, releasing the models doesn't give the memory back to the OS,
+    so the RSS would stay over it and the models would be reloaded on every task.
+    """
+
+    def __init__(self, isolated=False, max_tasks=0, max_rss_mb=0, start_method=None):
+        self.isolated = isolated
+        self.max_tasks = max_tasks
+        self.max_rss_mb = max_rss_mb
+        # spawn for workers restarted from threads, a forked child could inherit a lock held by another thread
+        self.context = multiprocessing.get_context(start_method)
+        self.tasks_done = 0
+        self.loaded = False
+        self.process = None
+        self.connection = None
+
+    def start(self):
+        if self.isolated:
+            if self.process is None or not self.process.is_alive():
+                self.connection, child_connection = self.context.Pipe()
+                self.process = self.context.Process(target=serve, args=(child_connection,), daemon=True)
+                self.process.start()
+                child_connection.close()
+        elif not self.loaded:
+            load_models()
+            self.loaded = True
+
+    def stop(self):
+        if self.isolated:
+            if self.process is not None:
+                try:
+                    self.connection.send(None)
+                except (BrokenPipeError, OSError):
+                    pass
+                self.process.join(timeout=30)
+                if self.process.is_alive():
+                    self.process.kill()
+                    self.process.join()
+                self.connection.close()
+            self.process = None
+            self.connection = None
+        elif self.loaded:
+            release_models()
+            self.loaded = False
+        self.tasks_done = 0
+
+    def run(self, job):
+        """
+        Run a job on the warm worker.
+
+            args:
+                job (dict): See run_job
+
+            return:
+                tuple: (success, data), see run_job. success is False if the worker crashed
+        """
+        self.start()
+
+        if self.isolated:
+            try:
+                self.connection.send(job)
+                result = self.connection.recv()
+            except (EOFError, BrokenPipeError, OSError) as e:
+                print(f'Error: swap worker crashed with exit code {self.process.exitcode}: {e}')
+                self.stop()
+                return False, None
+        else:
+            result = run_job(job)
+
+        self.tasks_done += 1
+        if self.need_recycle():
+            print(f'Recycling swap worker after {self.tasks_done} tasks')
+            self.stop()
+        return result
+
+    def rss_mb(self):
+        pid = self.process.pid if self.isolated and self.process is not None else os.getpid()
+        try:
+            return psutil.Process(pid).memory_info().rss / 1024 / 1024
+        except psutil.Error:
+            return 0
+
+    def need_recycle(self):
+        if self.max_tasks and self.tasks_done >= self.max_tasks:
+            return True
+        if self.isolated and self.max_rss_mb and self.rss_mb() > self.max_rss_mb:
+            return True
+        return False
+
+
+def get_gpu_memory_mb():
+    """
+    Memory of the first GPU from nvidia-smi, 0 if there is none. Asking torch would create
+    a CUDA context in this process, which takes GPU memory from the workers.
+    """
+    try:
+        output = subprocess.check_output(['nvidia-smi', '--query-gpu=memory.total', '--format=csv,noheader,nounits'],
+                                         stderr=subprocess.DEVNULL, timeout=10)
+        return int(output.decode().split()[0])
+    except (OSError, subprocess.SubprocessError, ValueError, IndexError):
+        return 0
+
+
+def suggest_slots(cpu_cores=0, slot_cpu_cores=4, memory_budget_mb=0, slot_memory_mb=6144, gpu_memory_budget_mb=0,
+                  slot_gpu_memory_mb=0):
+    """
+    Number of swap tasks a node can run side by side.
+
+        args:
+            cpu_cores (int): Cores the tasks may use, 0 for every core of the node
+            slot_cpu_cores (int): Cores one task keeps busy
+            memory_budget_mb (int): Memory the tasks may use, 0 for 3/4 of the memory of the node
+            slot_memory_mb (int): Memory of one worker with its models loaded
+            gpu_memory_budget_mb (int): GPU memory the tasks may use, 0 for the memory of the first GPU
+            slot_gpu_memory_mb (int): GPU memory of one worker with its models loaded, 0 if they run on the CPU
+
+        return:
+            int: At least 1
+    """
+    cpu_cores = cpu_cores or psutil.cpu_count() or 1
+    memory_budget_mb = memory_budget_mb or psutil.virtual_memory().total / 1024 / 1024 * 3 / 4
+    slots = min(cpu_cores // max(slot_cpu_cores, 1), int(memory_budget_mb // max(slot_memory_mb, 1)))
+    if slot_gpu_memory_mb:
+        # every isolated worker loads its own models and CUDA context on the GPU
+        gpu_memory_budget_mb = gpu_memory_budget_mb or get_gpu_memory_mb()
+        if gpu_memory_budget_mb:
+            slots = min(slots, int(gpu_memory_budget_mb // slot_gpu_memory_mb))
+    return max(1, slots)
+
+
+class SwapWorkerPool():
+    """
+    Runs up to slots jobs side by side, each on its own SwapWorker.
+
+    The roop globals belong to a process, so with more than one slot the workers are isolated
+    and every one loads its own models. Video jobs get at most slots - 1 workers, so an image
+    job finds a free one instead of waiting behind long videos.
+    """
+
+    def __init__(self, slots=1, isolated=False, max_tasks=0, max_rss_mb=0):
+        self.slots = max(slots, 1)
+        isolated = isolated or self.slots > 1
+        self.workers = [SwapWorker(isolated=isolated, max_tasks=max_tasks, max_rss_mb=max_rss_mb,
+                                   start_method='spawn' if isolated else None) for _ in range(self.slots)]
+        # the last released worker is reused first, it's the most likely to be warm
+        self.free_workers = queue.LifoQueue()
+        for worker in self.workers:
+            self.free_workers.put(worker)
+        self.video_slots = threading.BoundedSemaphore(max(self.slots - 1, 1))
+
+    def start(self):
+        # isolated workers would otherwise each download the weights they are missing at the same time
+        download_models()
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+
+    def run(self, job):
+        """
+        Run a job on a free worker, waits for one when all are busy.
+
+            args:
+                job (dict): See run_job
+
+            return:
+                tuple: (success, data), see SwapWorker.run
+        """
+        video_slot = None if job['is_image'] else self.video_slots
+        if video_slot is not None:
+            video_slot.acquire()
+        try:
+            worker = self.free_workers.get()
+            try:
+                return worker.run(job)
+            finally:
+                self.free_workers.put(worker)
+        finally:
+            if video_slot is not None:
+                video_slot.release()
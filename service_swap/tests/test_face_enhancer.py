@@ -0,0 +1,24 @@
+import pytest
+
+pytest.importorskip('insightface')
+pytest.importorskip('torch')
+
+from faceSwapLib.roop import globals
+from faceSwapLib.roop.processors.frame import face_enhancer
+from gfpgan import improver
+
+
+def test_face_enhancer_uses_the_improver_registry(monkeypatch):
+    builds = []
+    monkeypatch.setattr(improver, 'build_restorer', lambda *key: builds.append(key) or object())
+    monkeypatch.setattr(improver, 'RESTORERS', improver.OrderedDict())
+    monkeypatch.setattr(globals, 'execution_providers', ['CPUExecutionProvider'])
+    monkeypatch.setattr(globals, 'enhance_batch_size', 4)
+
+    restorer = face_enhancer.get_face_enhancer()
+    assert face_enhancer.get_face_enhancer() is restorer
+    assert improver.get_restorer(version='1.4', upscale=1, bg_upsampler=None, device='cpu', max_batch_size=4) is restorer
+    assert builds == [('1.4', 1, None, 0, 'auto', 'cpu', 'torch', 4)]
+
+    face_enhancer.clear_face_enhancer()
+    assert not improver.RESTORERS
@@ -0,0 +1,45 @@
+import numpy
+import pytest
+
+pytest.importorskip('insightface')
+
+from faceSwapLib.roop.face_index import load_face_index, save_face_index
+from faceSwapLib.roop.typin import Face
+
+
+def make_face(value):
+    return Face(bbox=numpy.full(4, value, dtype=numpy.float32),
+                kps=numpy.full((5, 2), value, dtype=numpy.float32),
+                det_score=0.9,
+                embedding=numpy.ones(512, dtype=numpy.float32))
+
+
+@pytest.fixture
+def index_path(tmp_path):
+    path = str(tmp_path / 'template.faces.npz')
+    save_face_index(path, [[make_face(1)], None, [make_face(2), make_face(3)]], (64, 48), 25.0)
+    return path
+
+
+def test_face_index_round_trip(index_path):
+    face_index = load_face_index(index_path, fps=25.0, frame_count=3)
+    assert len(face_index) == 3
+    assert face_index.fps == 25.0
+    assert [len(face_index.get_faces(frame_number)) for frame_number in range(3)] == [1, 0, 2]
+    assert face_index.get_faces(2)[1].bbox[0] == 3
+    assert face_index.get_faces(3) is None
+    assert face_index.get_faces(0, numpy.zeros((48, 64, 3), dtype=numpy.uint8)) is not None
+    assert face_index.get_faces(0, numpy.zeros((64, 48, 3), dtype=numpy.uint8)) is None
+
+
+def test_face_index_rejects_other_frames(index_path):
+    assert load_face_index(index_path, fps=30.0) is None
+    assert load_face_index(index_path, frame_count=4) is None
+    assert load_face_index(index_path + '.missing') is None
+
+
+def test_face_index_rejects_index_without_fps(index_path):
+    with numpy.load(index_path) as data:
+        arrays = {name: data[name] for name in data.files if name not in ('fps', 'frame_count')}
+    numpy.savez_compressed(index_path, **arrays)
+    assert load_face_index(index_path) is None
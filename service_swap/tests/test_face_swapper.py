@@ -0,0 +1,46 @@
+from types import SimpleNamespace
+
+import numpy
+import pytest
+
+pytest.importorskip('insightface')
+onnx = pytest.importorskip('onnx')
+onnxruntime = pytest.importorskip('onnxruntime')
+
+from onnx import TensorProto, helper
+
+from faceSwapLib.roop.processors.frame import face_swapper
+
+
+def make_swapper(tmp_path):
+    """Stands in for inswapper: 128x128 crops times the mean of the latent, batch fixed to 1."""
+    graph = helper.make_graph(
+        [helper.make_node('ReduceMean', ['source'], ['mean'], axes=[1], keepdims=1),
+         helper.make_node('Reshape', ['mean', 'shape'], ['scale']),
+         helper.make_node('Mul', ['target', 'scale'], ['output'])],
+        'inswapper',
+        [helper.make_tensor_value_info('target', TensorProto.FLOAT, [1, 3, 128, 128]),
+         helper.make_tensor_value_info('source', TensorProto.FLOAT, [1, 512])],
+        [helper.make_tensor_value_info('output', TensorProto.FLOAT, [1, 3, 128, 128])],
+        [helper.make_tensor('shape', TensorProto.INT64, [4], [-1, 1, 1, 1])])
+    model_path = str(tmp_path / 'inswapper.onnx')
+    onnx.save(helper.make_model(graph, opset_imports=[helper.make_opsetid('', 17)], ir_version=8), model_path)
+    return SimpleNamespace(session=onnxruntime.InferenceSession(model_path, providers=['CPUExecutionProvider']),
+                           model_file=model_path, input_names=['target', 'source'], output_names=['output'],
+                           input_size=(128, 128), emap=numpy.eye(512, dtype=numpy.float32))
+
+
+def test_batch_session_replaces_the_swapper_session(tmp_path):
+    swapper = make_swapper(tmp_path)
+    original_session = swapper.session
+
+    session = face_swapper.create_batch_session(swapper)
+    assert session is not None and session is not original_session
+    # one session with the weights, single faces run on it as a batch of 1
+    assert swapper.session is session
+    assert face_swapper.create_batch_session(swapper) is session
+
+    blob = numpy.random.rand(3, 3, 128, 128).astype(numpy.float32)
+    latent = numpy.full((3, 512), 0.5, dtype=numpy.float32)
+    output = session.run(['output'], {'target': blob, 'source': latent})[0]
+    numpy.testing.assert_allclose(output, blob * 0.5, rtol=1e-5)
@@ -0,0 +1,35 @@
+import os
+
+import numpy
+import pytest
+
+pytest.importorskip('insightface')
+
+from faceSwapLib import roop
+from faceSwapLib.roop import utilities
+from faceSwapLib.roop.processors.frame import core
+
+
+def test_temp_frame_paths_by_number(tmp_path, monkeypatch):
+    names = ['10000.png', '1000.png', '9999.png', '10001.png', 'cover.png', '0001.png']
+    for name in names:
+        (tmp_path / name).touch()
+    monkeypatch.setattr(roop.globals, 'temp_frame_format', 'png')
+    monkeypatch.setattr(utilities, 'get_temp_directory_path', lambda target_path: str(tmp_path))
+
+    temp_frame_paths = utilities.get_temp_frame_paths('template.mp4')
+    assert [os.path.basename(path) for path in temp_frame_paths] == ['0001.png', '1000.png', '9999.png', '10000.png',
+                                                                     '10001.png', 'cover.png']
+    assert core.get_window_start(temp_frame_paths[2:5]) == 9998
+
+
+@pytest.mark.parametrize('start_frame_number, tracked', [(0, True), (None, False)])
+def test_window_tracks_consecutive_frames_only(monkeypatch, start_frame_number, tracked):
+    tracker = object()
+    trackers = []
+    monkeypatch.setattr(core, 'create_face_tracker', lambda: tracker)
+    monkeypatch.setattr(core, 'get_frame_faces', lambda frame, frame_number, face_tracker: trackers.append(face_tracker) or [])
+
+    window = core.FrameWindow([numpy.zeros((4, 4, 3), dtype=numpy.uint8)] * 3, start_frame_number)
+    assert window.get_faces(0) == []
+    assert trackers == [tracker if tracked else None] * 3
@@ -0,0 +1,43 @@
+import os
+import re
+import subprocess
+import sys
+
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Loaded only by the NSFW predictor, the UI, the audio merge, the face enhancer and the
+# template face extraction. onnxruntime isn't one of them, insightface imports it on its own
+LAZY_MODULES = ['tensorflow', 'keras', 'opennsfw2', 'customtkinter', 'tkinterdnd2', 'ffmpeg', 'torch', 'torchvision', 'sklearn']
+# Cumulative import time of faceSwapLib.roop.core in seconds, about twice the 0.6-1.0s it takes
+# with warm file caches, can be raised for slower machines
+IMPORT_TIME_BUDGET = float(os.environ.get('import_time_budget', 2.0))
+
+
+def get_import_times(module):
+    """Cumulative import time in seconds of every module `python -X importtime -c 'import module'` loads."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=SERVICE_DIR, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    import_times = {}
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s*\d+ \|\s*(\d+) \|\s*(\S+)', line)
+        if match:
+            import_times[match.group(2)] = int(match.group(1)) / 1e6
+    return import_times
+
+
+@pytest.fixture(scope='module')
+def core_import_times():
+    for module in ['cv2', 'insightface', 'onnxruntime', 'psutil']:
+        pytest.importorskip(module)
+    return get_import_times('faceSwapLib.roop.core')
+
+
+def test_core_lazy_imports(core_import_times):
+    loaded = sorted(module for module in core_import_times if module.split('.')[0] in LAZY_MODULES)
+    assert not loaded
+
+
+def test_core_import_time_budget(core_import_times):
+    assert core_import_times['faceSwapLib.roop.core'] < IMPORT_TIME_BUDGET
@@ -0,0 +1,54 @@
+import pytest
+
+swap_worker = pytest.importorskip('swap_worker')
+
+
+@pytest.fixture
+def model_loads(monkeypatch):
+    """Replaces the models and the swap with counters, the RSS is always over any limit."""
+    loads = {'load': 0, 'release': 0}
+
+    def load_models():
+        loads['load'] += 1
+
+    def release_models():
+        loads['release'] += 1
+
+    monkeypatch.setattr(swap_worker, 'load_models', load_models)
+    monkeypatch.setattr(swap_worker, 'release_models', release_models)
+    monkeypatch.setattr(swap_worker, 'run_job', lambda job: (True, None))
+    monkeypatch.setattr(swap_worker.SwapWorker, 'rss_mb', lambda self: 1e9)
+    return loads
+
+
+def test_rss_limit_ignored_in_process(model_loads):
+    worker = swap_worker.SwapWorker(max_rss_mb=1)
+    for _ in range(5):
+        assert worker.run({'is_image': True}) == (True, None)
+    assert model_loads == {'load': 1, 'release': 0}
+
+
+def test_task_limit_in_process(model_loads):
+    worker = swap_worker.SwapWorker(max_tasks=2, max_rss_mb=1)
+    for _ in range(5):
+        worker.run({'is_image': True})
+    assert model_loads == {'load': 3, 'release': 2}
+
+
+def test_rss_limit_isolated(model_loads):
+    worker = swap_worker.SwapWorker(isolated=True, max_rss_mb=1)
+    assert worker.need_recycle()
+    worker.max_rss_mb = 0
+    assert not worker.need_recycle()
+
+
+def test_suggest_slots_gpu_budget(monkeypatch):
+    monkeypatch.setattr(swap_worker, 'get_gpu_memory_mb', lambda: 10000)
+    assert swap_worker.suggest_slots(cpu_cores=32, memory_budget_mb=65536) == 8
+    assert swap_worker.suggest_slots(cpu_cores=32, memory_budget_mb=65536, slot_gpu_memory_mb=4096) == 2
+    assert swap_worker.suggest_slots(cpu_cores=32, memory_budget_mb=65536, gpu_memory_budget_mb=24576,
+                                     slot_gpu_memory_mb=4096) == 6
+    assert swap_worker.suggest_slots(cpu_cores=32, memory_budget_mb=65536, slot_gpu_memory_mb=16384) == 1
+    # no GPU found, the cores and the memory decide
+    monkeypatch.setattr(swap_worker, 'get_gpu_memory_mb', lambda: 0)
+    assert swap_worker.suggest_slots(cpu_cores=32, memory_budget_mb=65536, slot_gpu_memory_mb=4096) == 8
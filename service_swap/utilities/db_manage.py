@@ -2,6 +2,7 @@ import pymysql
 import ssl
 from utilities import utils
 import os
+import threading
 import time
 
 DATA_PATH = os.environ.get('data_path', 'data/')
@@ -21,6 +22,8 @@ class MySQLDB:
         self.database = mysql_config['database']
         self.ssl = os.path.join(DATA_PATH, mysql_config['ssl_ca'])
         self.connection = None
+        # One connection is shared by the tasks running side by side, a query holds it until it's committed
+        self.lock = threading.RLock()
 
     def connect(self):
 
@@ -48,23 +51,24 @@ class MySQLDB:
         print("query -- ", query)
         print("param -- ", params)
 
-        with self.connection.cursor() as cursor:
-            try:
-                cursor.execute(query, params)
-                self.connection.commit()
-                print("cursor -- ", cursor)
-                return cursor
-            except Exception as e:
-                print(e)
-                if retries < self.MAX_RETRIES:
-                    self.disconnect()
-                    self.connect()
-                    print(f"Retrying query. Retry count: {retries + 1}")
-                    time.sleep(self.RETRY_DELAY)
-                    return self.execute_query(query, params, retries=retries + 1)
-                else:
-                    print("Max retries reached. Unable to execute query.")
-                    return None
+        with self.lock:
+            with self.connection.cursor() as cursor:
+                try:
+                    cursor.execute(query, params)
+                    self.connection.commit()
+                    print("cursor -- ", cursor)
+                    return cursor
+                except Exception as e:
+                    print(e)
+                    if retries < self.MAX_RETRIES:
+                        self.disconnect()
+                        self.connect()
+                        print(f"Retrying query. Retry count: {retries + 1}")
+                        time.sleep(self.RETRY_DELAY)
+                        return self.execute_query(query, params, retries=retries + 1)
+                    else:
+                        print("Max retries reached. Unable to execute query.")
+                        return None
 
     def fetch_all(self, cursor):
 
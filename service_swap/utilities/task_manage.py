@@ -1,38 +1,73 @@
 import pika
 from concurrent.futures import ThreadPoolExecutor
+import functools
 import json
+import queue
+import threading
 import time
 from utilities import utils
 
 
 class TaskManager:
-    def __init__(self, config_path='./rabbit.cnf'):
-        self.config = utils.load_config(config_path, ['host', 'queue_name_1', 'queue_name_2', 'exchange', 'port', 'username', 'password'])
+    def __init__(self, config_path='./rabbit.cnf', max_workers=4):
+        self.config = utils.load_config(config_path, ['host', 'queue_name_1', 'queue_name_2', 'exchange', 'port', 'username', 'password',
+                                                      'prefetch_count', 'publish_pool_size'])
 
         self.queue_name_1 = self.config['queue_name_1']
         self.queue_name_2 = self.config['queue_name_2']
         self.exchange = self.config['exchange']
+        # Tasks that failed twice are routed to <queue>.dead through this exchange
+        self.dead_letter_exchange = f'{self.exchange}.dlx'
+        # Unacked tasks the broker pushes to one consumer
+        self.prefetch_count = int(self.config['prefetch_count'] or 1)
         self.connection = None
         self.channel = None
-        self.executor = ThreadPoolExecutor(max_workers=4)  # Adjust as needed
+        # Runs the consumed tasks, a consumer running tasks side by side sizes it with its prefetch
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Idle publishing connections kept open between the publishes, the topology is declared by the first one
+        self.publishers = queue.LifoQueue(maxsize=int(self.config['publish_pool_size'] or 4))
+        self.topology_declared = False
+        self.topology_lock = threading.Lock()
+
+    def get_connection_parameters(self):
+        credentials = pika.PlainCredentials(username=self.config['username'], password=self.config['password'])
+        return pika.ConnectionParameters(
+            host=self.config['host'],
+            port=self.config['port'],
+            credentials = credentials
+        )
 
     def connect(self):
         """Establishes a connection to RabbitMQ using the configuration values."""
 
         if not self.connection or not self.connection.is_open:
-            credentials = pika.PlainCredentials(username=self.config['username'], password=self.config['password'])
-            parameters = pika.ConnectionParameters(
-                host=self.config['host'],
-                port=self.config['port'], 
-                credentials = credentials
-            )
-            self.connection = pika.BlockingConnection(parameters)
-            self.channel = self.connection.channel()
-            self.channel.exchange_declare(exchange=self.exchange, durable=True)
-            self.channel.queue_declare(queue=self.queue_name_1, durable=True)
-            self.channel.queue_bind(exchange=self.exchange, queue=self.queue_name_1, routing_key=self.queue_name_1)
-            self.channel.queue_declare(queue=self.queue_name_2, durable=True)
-            self.channel.queue_bind(exchange=self.exchange, queue=self.queue_name_2, routing_key=self.queue_name_2)
+            self.connection = pika.BlockingConnection(self.get_connection_parameters())
+            self.channel = self.declare_topology(self.connection, self.connection.channel())
+
+    def declare_topology(self, connection, channel):
+        """Declares the exchanges and the queues, returns the channel to go on with."""
+
+        channel.exchange_declare(exchange=self.exchange, durable=True)
+        channel.exchange_declare(exchange=self.dead_letter_exchange, durable=True)
+        for queue_name in (self.queue_name_1, self.queue_name_2):
+            channel = self.declare_queue(connection, channel, queue_name)
+            channel.queue_bind(exchange=self.exchange, queue=queue_name, routing_key=queue_name)
+            channel.queue_declare(queue=f'{queue_name}.dead', durable=True)
+            channel.queue_bind(exchange=self.dead_letter_exchange, queue=f'{queue_name}.dead', routing_key=queue_name)
+        return channel
+
+    def declare_queue(self, connection, channel, queue_name):
+        """Declares a durable task queue that dead-letters the rejected tasks, returns the channel to go on with."""
+
+        try:
+            channel.queue_declare(queue=queue_name, durable=True,
+                                  arguments={'x-dead-letter-exchange': self.dead_letter_exchange})
+        except pika.exceptions.ChannelClosedByBroker as e:
+            # A queue declared before keeps its arguments, the broker closes the channel instead
+            print(f"Warning: queue {queue_name} has no dead-letter exchange, set {self.dead_letter_exchange} with a policy - {e}")
+            channel = connection.channel()
+            channel.queue_declare(queue=queue_name, durable=True)
+        return channel
 
 
     def disconnect(self):
@@ -41,88 +76,107 @@ class TaskManager:
         if self.connection and self.connection.is_open:
             self.connection.close()
 
-    def publish_task_1(self, task_data):
-        """Publishes a task to the specified queue."""
-
-        self.connect()  # Ensure connection before publishing
-        self.channel.basic_publish(
-            exchange=self.exchange,
-            routing_key=self.queue_name_1,
-            body=json.dumps(task_data)  # Serialize data to JSON
-        )
-        self.disconnect()  # Close connection after publishing
-
+    def acquire_publisher(self):
+        """An open connection and confirming channel from the pool, or a new one when the pool is empty."""
 
-    def publish_task_2(self, task_data):
-        """Publishes a task to the specified queue."""
+        while True:
+            try:
+                connection, channel = self.publishers.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                # Sends the heartbeats missed while idle and notices a connection the broker closed
+                connection.process_data_events(time_limit=0)
+                if channel.is_open:
+                    return connection, channel
+            except pika.exceptions.AMQPError:
+                pass
+            self.close_publisher(connection)
+
+        connection = pika.BlockingConnection(self.get_connection_parameters())
+        channel = connection.channel()
+        with self.topology_lock:
+            if not self.topology_declared:
+                channel = self.declare_topology(connection, channel)
+                self.topology_declared = True
+        channel.confirm_delivery()
+        return connection, channel
+
+    def release_publisher(self, connection, channel):
+        try:
+            self.publishers.put_nowait((connection, channel))
+        except queue.Full:
+            self.close_publisher(connection)
 
-        self.connect()  # Ensure connection before publishing
-        self.channel.basic_publish(
-            exchange=self.exchange,
-            routing_key=self.queue_name_2,
-            body=json.dumps(task_data)  # Serialize data to JSON
-        )
-        self.disconnect()  # Close connection after publishing
+    @staticmethod
+    def close_publisher(connection):
+        try:
+            if connection.is_open:
+                connection.close()
+        except pika.exceptions.AMQPError:
+            pass
+
+    def publish(self, routing_key, task_data):
+        """
+        Publishes a persistent task on a pooled connection and waits for the broker to confirm it.
+        A connection that was lost while idle in the pool is replaced and the publish retried once.
+        """
+
+        body = json.dumps(task_data)  # Serialize data to JSON
+        properties = pika.BasicProperties(content_type='application/json', delivery_mode=2)
+        for attempt in range(2):
+            connection, channel = self.acquire_publisher()
+            try:
+                channel.basic_publish(exchange=self.exchange, routing_key=routing_key, body=body,
+                                      properties=properties, mandatory=True)
+            except (pika.exceptions.UnroutableError, pika.exceptions.NackError):
+                self.release_publisher(connection, channel)
+                raise
+            except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError) as e:
+                self.close_publisher(connection)
+                if attempt:
+                    raise
+                print(f"Warning: publishing connection lost, retrying: {e}")
+                continue
+            self.release_publisher(connection, channel)
+            return
 
+    def publish_task_1(self, task_data):
+        """Publishes a task to the first queue."""
 
-    def listen_for_tasks_1(self, callback):
-        """Starts consuming tasks from the queue and submits them to the callback one by one."""
+        self.publish(self.queue_name_1, task_data)
 
-        while True:
-            try:
-                self.connect()  # Ensure connection before starting consumer
+    def publish_task_2(self, task_data):
+        """Publishes a task to the second queue."""
 
-                while True:
-                    method, properties, body = self.channel.basic_get(queue=self.queue_name_1, auto_ack=True)
-                    if method:
-                        # Received a message
-                        message = json.loads(body)
-                        try:
-                            # Process the task (instead of submitting to a thread pool)
-                            callback(message)
-                        except Exception as e:
-                            print(f"Error processing task: {message}")
-                            print(e)
-                            # Requeue the message in case of errors (optional)
-                            # self.channel.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=True)
-                    else:
-                        # No message received, take a brief break and check again
-                        time.sleep(0.1)
+        self.publish(self.queue_name_2, task_data)
 
-            except Exception as ex:
-                print(f"Error: {ex}")
-                # Attempt to reconnect
-                self.disconnect()
-                time.sleep(0.5)  # Wait before reconnecting
-
-            finally:
-                self.disconnect()  # Close connection after finishing
+    def consume(self, queue_name, callback, prefetch_count=None):
+        """
+        Consumes the tasks the broker pushes from the queue and submits them to the callback.
 
+        The callbacks run on the executor, so the connection keeps sending heartbeats during
+        long tasks. A task is acked once the callback returned, so it has updated its status in
+        the DB, and a consumer that dies mid-task leaves its tasks to another one. A task whose
+        callback raised is requeued once and dead-lettered when it fails again.
+        """
 
+        def on_message(channel, method, properties, body):
+            try:
+                message = json.loads(body)
+            except ValueError:
+                print(f"Error: task is not json: {body}")
+                channel.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                return
 
-    def listen_for_tasks_2(self, callback):
-        """Starts consuming tasks from the queue and submits them to the callback one by one."""
+            self.executor.submit(self.run_task, channel, method, callback, message)
 
         while True:
             try:
                 self.connect()  # Ensure connection before starting consumer
-
-                while True:
-                    method, properties, body = self.channel.basic_get(queue=self.queue_name_2, auto_ack=True)
-                    if method:
-                        # Received a message
-                        message = json.loads(body)
-                        try:
-                            # Process the task (instead of submitting to a thread pool)
-                            callback(message)
-                        except Exception as e:
-                            print(f"Error processing task: {message}")
-                            print(e)
-                            # Requeue the message in case of errors (optional)
-                            # self.channel.basic_nack(delivery_tag=method_frame.delivery_tag, requeue=True)
-                    else:
-                        # No message received, take a brief break and check again
-                        time.sleep(0.1)
+                self.channel.basic_qos(prefetch_count=prefetch_count or self.prefetch_count)
+                self.channel.basic_consume(queue=queue_name, on_message_callback=on_message)
+                self.channel.start_consuming()
 
             except Exception as ex:
                 print(f"Error: {ex}")
@@ -133,55 +187,65 @@ class TaskManager:
             finally:
                 self.disconnect()  # Close connection after finishing
 
-    def get_queue_tasks_1(self):
-        """Retrieves a list of tasks currently in the queue."""
+    def run_task(self, channel, method, callback, message):
+        """Runs the callback of a task on an executor thread and hands its ack to the connection thread."""
 
-        self.connect()  # Ensure connection before fetching tasks
+        try:
+            callback(message)
+            acknowledge = functools.partial(self.ack, channel, method.delivery_tag)
+        except Exception as e:
+            print(f"Error processing task: {message}")
+            print(e)
+            acknowledge = functools.partial(self.nack, channel, method.delivery_tag, not method.redelivered)
 
         try:
-            method_frame, header_frame, body = self.channel.basic_get(queue=self.queue_name_1)
-            tasks = []
-            while method_frame:
-                # Deserialize task data from JSON
-                task_data = json.loads(body)
-                tasks.append(task_data)
+            # pika channels aren't thread-safe, the ack is sent by the thread of the I/O loop
+            channel.connection.add_callback_threadsafe(acknowledge)
+        except Exception as e:
+            # The connection is closed, the broker has already requeued the task
+            print(f"Error: can't acknowledge task {message}: {e}")
 
-                # Fetch the next message
-                method_frame, header_frame, body = self.channel.basic_get(queue=self.queue_name_1)
+    @staticmethod
+    def ack(channel, delivery_tag):
+        if channel.is_open:
+            channel.basic_ack(delivery_tag=delivery_tag)
 
-            return tasks
+    @staticmethod
+    def nack(channel, delivery_tag, requeue):
+        if channel.is_open:
+            channel.basic_nack(delivery_tag=delivery_tag, requeue=requeue)
 
-        except Exception as e:
-            print(f"Error fetching tasks from queue: {e}")
-            return []  # Return an empty list on error
+    def listen_for_tasks_1(self, callback, prefetch_count=None):
+        """Starts consuming tasks from the first queue, see consume."""
 
-        finally:
-            self.disconnect()  # Close connection after fetching tasks
+        self.consume(self.queue_name_1, callback, prefetch_count)
 
-    def get_queue_tasks_2(self):
-        """Retrieves a list of tasks currently in the queue."""
+    def listen_for_tasks_2(self, callback, prefetch_count=None):
+        """Starts consuming tasks from the second queue, see consume."""
 
-        self.connect()  # Ensure connection before fetching tasks
+        self.consume(self.queue_name_2, callback, prefetch_count)
 
+    def get_queue_depth(self, queue_name):
+        """Number of tasks ready in the queue, from a passive declare that leaves the tasks where they are."""
+
+        connection, channel = self.acquire_publisher()
         try:
-            method_frame, header_frame, body = self.channel.basic_get(queue=self.queue_name_2)
-            tasks = []
-            while method_frame:
-                # Deserialize task data from JSON
-                task_data = json.loads(body)
-                tasks.append(task_data)
+            method = channel.queue_declare(queue=queue_name, passive=True).method
+        except (pika.exceptions.AMQPConnectionError, pika.exceptions.AMQPChannelError):
+            self.close_publisher(connection)
+            raise
+        self.release_publisher(connection, channel)
+        return method.message_count
 
-                # Fetch the next message
-                method_frame, header_frame, body = self.channel.basic_get(queue=self.queue_name_2)
+    def get_queue_depth_1(self):
+        """Number of tasks ready in the first queue."""
 
-            return tasks
+        return self.get_queue_depth(self.queue_name_1)
 
-        except Exception as e:
-            print(f"Error fetching tasks from queue: {e}")
-            return []  # Return an empty list on error
+    def get_queue_depth_2(self):
+        """Number of tasks ready in the second queue."""
 
-        finally:
-            self.disconnect()  # Close connection after fetching tasks
+        return self.get_queue_depth(self.queue_name_2)
 
 
 if __name__ == '__main__':
@@ -190,8 +254,7 @@ if __name__ == '__main__':
     task_manager = TaskManager('node')
     task_manager.publish_task(task_data)
 
-    tasks = task_manager.get_queue_tasks()
-    print(tasks)  # Output: [{task_data}, {task_data}, ... ]
+    print(task_manager.get_queue_depth_1())  # Output: number of tasks ready in the queue
 
     # def process_task(task):
     #     # Implement your task processing logic here